@@ -310,6 +310,12 @@ export async function getVerificationStatus(fingerprintValue) {
     return Boolean(record?.isVerified);
 }
 
+// Messages link attachments through /messages/<chat>/attachments/<blob>; keys stay on the upload URL saved before that.
+function attachmentHistoryKey(url) {
+    const match = /^\/messages\/\d+\/attachments\/(.+)$/.exec(String(url));
+    return `attachment:${match ? `/static/uploads/messages/${match[1]}` : url}`;
+}
+
 export async function saveAttachmentHistory(url, payload) {
     if (!url || !payload?.key) {
         return;
@@ -320,7 +326,7 @@ export async function saveAttachmentHistory(url, payload) {
         key: String(payload.key),
         metadata: payload.metadata || null,
         updatedAt: Date.now()
-    }, `attachment:${url}`);
+    }, attachmentHistoryKey(url));
     scheduleCloudBackupSync();
 }
 
@@ -330,7 +336,7 @@ export async function getAttachmentHistory(url) {
     }
 
     const db = await idbOpen();
-    const record = await db.get("messages", `attachment:${url}`);
+    const record = await db.get("messages", attachmentHistoryKey(url));
     if (!record?.key) {
         return null;
     }
@@ -16,7 +16,7 @@ import {
     restoreCloudBackupIfNeeded,
     resetLocalCryptoState,
     saveVerificationStatus
-} from "./crypto.js?v=20260623b";
+} from "./crypto.js?v=20261018a";
 // Bump module query strings when group E2EE runtime changes so browsers do not reuse stale modules.
 import { authFetch, ensureSession } from "./authClient.js?v=20260601b";
 import {
@@ -25,8 +25,9 @@ import {
     encryptGroupMessage,
     encryptMessage,
     encryptMessageForDevices
-} from "./chatCrypto.js?v=20260623b";
+} from "./chatCrypto.js?v=20261018a";
 import {
+    applyMessageStatusWatermark,
     bindMediaViewerControls,
     bindAttachmentAlertControls,
     bindChatHeaderControls,
@@ -40,20 +41,21 @@ import {
     updateAttachmentComposerState,
     updateMessageStatus,
     updateChatHeaderAvatar
-} from "./messagesUi.js?v=20260623a";
+} from "./messagesUi.js?v=20261018b";
 import {
+    createChatOutbox,
     createChatSocket,
     createUserSocket,
     reloadChatList
-} from "./messagesSockets.js?v=20260612b";
-import { createHistoryController } from "./messagesHistory.js?v=20260623a";
+} from "./messagesSockets.js?v=20261018c";
+import { createHistoryController } from "./messagesHistory.js?v=20261018b";
 import {
     applyChatKeysFlow,
     initializeChatFlow,
     refreshChatKeysFlow,
     refreshSafetyNumberFlow,
     sendCurrentMessage
-} from "./messagesChatFlow.js?v=20260623a";
+} from "./messagesChatFlow.js?v=20261018c";
 import { updateVerificationUiFlow } from "./messagesVerification.js?v=20260420i";
 
 const DEBUG_CHAT = false;
@@ -75,6 +77,8 @@ let deferredLiveMessages = [];
 let currentFingerprint = null;
 let cryptoBootstrapPromise = null;
 let chatSocketOpened = false;
+let chatOutbox = null;
+let rateLimitNoticeShown = false;
 let chatKeysRetryTimer = null;
 let activeMessageContext = null;
 let activeReplyTarget = null;
@@ -455,6 +459,7 @@ window.sendMessage = async function () {
         getInput: () => document.getElementById("messageInput"),
         getAttachmentInput: () => document.getElementById("messageAttachmentInput"),
         getChatSocket: () => window.chatSocket,
+        getChatOutbox: () => chatOutbox,
         getMyIdentityKey: () => myIdentityKeyCache,
         getMyPrivateKey: () => myIdentityPrivateKeyCache,
         getCurrentDeviceId: () => myCurrentDeviceId,
@@ -745,8 +750,10 @@ async function openChatSocket(chatId) {
         onStatus: (data) => {
             setUserStatus(data.is_online);
         },
-        onHistoryComplete: () => {
+        onHistoryComplete: (data) => {
             historySyncInProgress = false;
+            historyController.setHistoryCursor(data);
+            renderLoadOlderMessagesButton();
             updateChatReadiness();
 
             const queuedLiveMessages = sortQueuedMessages(deferredLiveMessages);
@@ -763,17 +770,49 @@ async function openChatSocket(chatId) {
             applyChatMetaPayload(data);
             await loadChats();
         },
+        onRateLimited: (data) => {
+            // The server dropped the frame; the outbox still holds it and sends it again.
+            chatOutbox?.retryLater(data.retry_after_ms);
+            const seconds = Math.max(1, Math.ceil((Number(data.retry_after_ms) || 1000) / 1000));
+            rateLimitNoticeShown = true;
+            setAttachmentFeedback(
+                data.reason === "overloaded"
+                    ? `Сервер перевантажений. Повідомлення буде надіслано повторно за ${seconds} с.`
+                    : `Забагато повідомлень. Повідомлення буде надіслано повторно за ${seconds} с.`,
+                "error"
+            );
+        },
         onMessage: (data) => {
             if (data.type === "message_status") {
                 updateMessageStatus(data.message_id, data.delivery_status, data.read_at || null);
                 return;
             }
 
+            if (data.type === "messages_status") {
+                if (Number(data.user_id) !== meId()) {
+                    applyMessageStatusWatermark(data.up_to_message_id, data.delivery_status, data.read_at || null);
+                }
+                return;
+            }
+
             if (data.type === "message_deleted") {
                 handleMessageDeletedEvent(data);
                 return;
             }
 
+            if (
+                data.type === "message"
+                && !data.historical
+                && data.sender === myUsername
+                && (!data.sender_device_id || data.sender_device_id === myCurrentDeviceId)
+            ) {
+                chatOutbox?.acknowledge();
+                if (rateLimitNoticeShown) {
+                    rateLimitNoticeShown = false;
+                    setAttachmentFeedback("");
+                }
+            }
+
             if (!keysReady) {
                 if (!data.historical) {
                     logChatState("live message queued while keys are not ready", {
@@ -795,6 +834,53 @@ async function openChatSocket(chatId) {
     });
 
     window.chatSocket = chatSocket;
+    chatOutbox = createChatOutbox(chatSocket);
+    rateLimitNoticeShown = false;
+}
+
+function renderLoadOlderMessagesButton() {
+    const chat = document.getElementById("chat");
+    let button = document.getElementById("loadOlderMessagesButton");
+    if (!chat || !historyController.hasOlderMessages()) {
+        button?.remove();
+        return;
+    }
+
+    if (!button) {
+        button = document.createElement("button");
+        button.type = "button";
+        button.id = "loadOlderMessagesButton";
+        button.className = "load-older-messages";
+        button.textContent = "Показати старіші повідомлення";
+        button.addEventListener("click", () => {
+            void loadOlderMessages();
+        });
+    }
+    chat.prepend(button);
+}
+
+async function loadOlderMessages() {
+    if (!keysReady) {
+        return;
+    }
+
+    const button = document.getElementById("loadOlderMessagesButton");
+    if (button) {
+        button.disabled = true;
+    }
+    try {
+        await historyController.loadOlderMessages(async (chatId, beforeMessageId) => {
+            const response = await authFetch(`/chats/${chatId}/messages?before=${encodeURIComponent(beforeMessageId)}`);
+            return response.ok ? response.json() : null;
+        });
+    } catch (error) {
+        console.warn("Loading older messages failed:", error);
+    } finally {
+        if (button) {
+            button.disabled = false;
+        }
+        renderLoadOlderMessagesButton();
+    }
 }
 
 function updateChatReadiness() {
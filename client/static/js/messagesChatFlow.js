@@ -10,12 +10,65 @@ function getFileExtension(filename = "") {
     return dotIndex >= 0 ? filename.slice(dotIndex).toLowerCase() : "";
 }
 
+const RESUMABLE_UPLOAD_THRESHOLD_BYTES = 8 * 1024 * 1024;
+const RESUMABLE_CHUNK_ATTEMPTS = 3;
+
+async function uploadEncryptedAttachment({ authFetch, chatId, encryptedBytes }) {
+    if (encryptedBytes.byteLength <= RESUMABLE_UPLOAD_THRESHOLD_BYTES) {
+        const formData = new FormData();
+        formData.append("chat_id", String(chatId));
+        formData.append("encrypted", "true");
+        formData.append("file", new File([encryptedBytes], "attachment.bin", { type: "application/octet-stream" }));
+        const response = await authFetch("/messages/upload", { method: "POST", body: formData });
+        return { response, payload: await response.json() };
+    }
+
+    // Large media goes up in chunks so a dropped connection only costs the chunk in flight.
+    const sessionForm = new FormData();
+    sessionForm.append("chat_id", String(chatId));
+    sessionForm.append("size", String(encryptedBytes.byteLength));
+    sessionForm.append("encrypted", "true");
+    const sessionResponse = await authFetch("/messages/uploads", { method: "POST", body: sessionForm });
+    const session = await sessionResponse.json();
+    if (!sessionResponse.ok || session?.status !== "ok") {
+        return { response: sessionResponse, payload: session };
+    }
+
+    for (let index = 0; index < session.chunk_count; index += 1) {
+        const offset = index * session.chunk_size;
+        const chunk = encryptedBytes.subarray(offset, Math.min(offset + session.chunk_size, encryptedBytes.byteLength));
+        let chunkResponse = null;
+        for (let attempt = 0; attempt < RESUMABLE_CHUNK_ATTEMPTS; attempt += 1) {
+            try {
+                chunkResponse = await authFetch(
+                    `/messages/uploads/${session.upload_id}/chunks/${index}?offset=${offset}`,
+                    { method: "PUT", body: chunk, headers: { "Content-Type": "application/octet-stream" } }
+                );
+            } catch (error) {
+                chunkResponse = null;
+                console.warn("Chunk upload failed, retrying:", error);
+            }
+            if (chunkResponse && chunkResponse.status < 500) {
+                break;
+            }
+        }
+        if (!chunkResponse?.ok) {
+            const payload = chunkResponse ? await chunkResponse.json().catch(() => null) : null;
+            return { response: chunkResponse || sessionResponse, payload: payload || { detail: "Upload failed" } };
+        }
+    }
+
+    const response = await authFetch(`/messages/uploads/${session.upload_id}/finalize`, { method: "POST" });
+    return { response, payload: await response.json() };
+}
+
 export async function sendCurrentMessage({
     awaitCryptoBootstrap,
     getCurrentChatId,
     getInput,
     getAttachmentInput,
     getChatSocket,
+    getChatOutbox,
     getMyIdentityKey,
     getMyPrivateKey,
     getCurrentDeviceId,
@@ -119,21 +172,11 @@ export async function sendCurrentMessage({
             });
 
             setAttachmentFeedback?.("Uploading media...", "success");
-            const formData = new FormData();
-            formData.append("chat_id", String(chatId));
-            formData.append("encrypted", "true");
-            const encryptedFile = new File(
-                [encryptedAttachment.encryptedBytes],
-                "attachment.bin",
-                { type: "application/octet-stream" }
-            );
-            formData.append("file", encryptedFile);
-
-            const uploadResponse = await authFetch("/messages/upload", {
-                method: "POST",
-                body: formData
+            const { response: uploadResponse, payload: uploadPayload } = await uploadEncryptedAttachment({
+                authFetch,
+                chatId,
+                encryptedBytes: encryptedAttachment.encryptedBytes
             });
-            const uploadPayload = await uploadResponse.json();
 
             if (!uploadResponse.ok || uploadPayload?.status !== "ok" || !uploadPayload?.attachment) {
                 console.error("Attachment upload failed:", uploadPayload);
@@ -175,7 +218,7 @@ export async function sendCurrentMessage({
                 }
             }
 
-            chatSocket.send(JSON.stringify({
+            getChatOutbox().send(JSON.stringify({
                 type: "media_message",
                 reply_to_message_id: replyToMessageId,
                 attachment: {
@@ -280,7 +323,8 @@ export async function sendCurrentMessage({
             payload.reply_to_message_id = replyToMessageId;
         }
 
-        chatSocket.send(JSON.stringify(payload));
+        // Queued until the server echoes it, so clearing the input cannot lose a rate-limited message.
+        getChatOutbox().send(JSON.stringify(payload));
         input.value = "";
         onAttachmentSent?.();
         clearReplyTarget?.();
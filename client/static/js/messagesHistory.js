@@ -8,12 +8,12 @@ import {
     getRatchetState,
     saveCachedMessageText,
     saveLastSeenMessageId
-} from "./crypto.js?v=20260623b";
+} from "./crypto.js?v=20261018a";
 import {
     cacheAttachmentHistoryFromMessageMeta,
     decryptMessage,
     selectPayloadForCurrentUser
-} from "./chatCrypto.js?v=20260612b";
+} from "./chatCrypto.js?v=20261018a";
 
 export function createHistoryController({
     getMyUsername,
@@ -33,11 +33,48 @@ export function createHistoryController({
     let messageProcessingChain = Promise.resolve();
     let renderedMessageIds = new Set();
     let chatTranscript = [];
+    // The socket replays only the newest page; older pages come from GET /chats/{id}/messages.
+    let olderMessagesCursor = null;
+    let loadingOlderMessages = false;
 
     function reset() {
         messageProcessingChain = Promise.resolve();
         renderedMessageIds = new Set();
         chatTranscript = [];
+        olderMessagesCursor = null;
+        loadingOlderMessages = false;
+    }
+
+    function setHistoryCursor(cursor) {
+        olderMessagesCursor = cursor?.has_more && cursor?.before_message_id ? cursor.before_message_id : null;
+    }
+
+    function hasOlderMessages() {
+        return Boolean(olderMessagesCursor);
+    }
+
+    async function loadOlderMessages(fetchPage) {
+        if (!olderMessagesCursor || loadingOlderMessages) {
+            return false;
+        }
+
+        const chatId = getCurrentChatId();
+        loadingOlderMessages = true;
+        try {
+            const page = await fetchPage(chatId, olderMessagesCursor);
+            if (!page || getCurrentChatId() !== chatId) {
+                return false;
+            }
+
+            const chat = document.getElementById("chat");
+            const firstRendered = chat?.querySelector(".chat-message") || null;
+            (page.messages || []).forEach((data) => queueMessageProcessing(data, { insertBefore: firstRendered }));
+            await messageProcessingChain;
+            setHistoryCursor(page);
+            return true;
+        } finally {
+            loadingOlderMessages = false;
+        }
     }
 
     function rememberTranscriptMessage(data) {
@@ -241,7 +278,7 @@ export function createHistoryController({
         }
     }
 
-    async function processMessage(data) {
+    async function processMessage(data, { insertBefore = null } = {}) {
         const chat = document.getElementById("chat");
         if (!chat) return;
 
@@ -315,7 +352,8 @@ export function createHistoryController({
                 deletedForAll: Boolean(data.deleted_for_all),
                 replyTo: await buildReplyPayload(data.reply_to_message_id),
                 createdAt: data.created_at || new Date().toISOString(),
-                readAt: data.read_at || null
+                readAt: data.read_at || null,
+                insertBefore
             });
             renderedMessageIds.add(messageId);
             return;
@@ -381,7 +419,8 @@ export function createHistoryController({
                 deletedForAll: Boolean(data.deleted_for_all),
                 replyTo: await buildReplyPayload(data.reply_to_message_id),
                 createdAt: data.created_at || new Date().toISOString(),
-                readAt: data.read_at || null
+                readAt: data.read_at || null,
+                insertBefore
             });
         } catch (err) {
             console.warn("Decrypt error:", err);
@@ -402,14 +441,15 @@ export function createHistoryController({
                 deletedForAll: Boolean(data.deleted_for_all),
                 replyTo: await buildReplyPayload(data.reply_to_message_id),
                 createdAt: data.created_at || new Date().toISOString(),
-                readAt: data.read_at || null
+                readAt: data.read_at || null,
+                insertBefore
             });
         }
     }
 
-    function queueMessageProcessing(data) {
+    function queueMessageProcessing(data, placement) {
         messageProcessingChain = messageProcessingChain
-            .then(() => processMessage(data))
+            .then(() => processMessage(data, placement))
             .catch((err) => {
                 console.warn("Message queue error:", err);
             });
@@ -417,6 +457,9 @@ export function createHistoryController({
 
     return {
         reset,
-        queueMessageProcessing
+        queueMessageProcessing,
+        setHistoryCursor,
+        hasOlderMessages,
+        loadOlderMessages
     };
 }
@@ -10,7 +10,8 @@ export function createChatSocket({
     onHistoryComplete,
     onMessage,
     onChatDeleted,
-    onChatUpdated
+    onChatUpdated,
+    onRateLimited
 }) {
     const chatSocket = new WebSocket(
         `${getWebSocketProtocol()}://${window.location.host}/ws/${chatId}${buildDeviceQuery()}`
@@ -41,12 +42,22 @@ export function createChatSocket({
             return;
         }
 
+        if (data.type === "rate_limited") {
+            onRateLimited?.(data);
+            return;
+        }
+
         if (data.type === "chat_meta_updated" || data.type === "chat_participants_updated") {
             onChatUpdated?.(data);
             return;
         }
 
-        if (data.type === "message" || data.type === "message_status" || data.type === "message_deleted") {
+        if (
+            data.type === "message"
+            || data.type === "message_status"
+            || data.type === "messages_status"
+            || data.type === "message_deleted"
+        ) {
             onMessage?.(data);
         }
     };
@@ -54,6 +65,56 @@ export function createChatSocket({
     return chatSocket;
 }
 
+export function createChatOutbox(chatSocket, { retryDelayMs = 1000 } = {}) {
+    // Frames stay queued until the server echoes them back, one in flight at a time, so a
+    // rate_limited reply always refers to the frame at the head and can simply be resent.
+    // Frames are already encrypted; resending the same bytes keeps the ratchet in step.
+    const queue = [];
+    let inFlight = false;
+    let retryTimer = null;
+
+    function transmit() {
+        if (inFlight || queue.length === 0 || chatSocket.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        inFlight = true;
+        chatSocket.send(queue[0]);
+    }
+
+    chatSocket.addEventListener("open", transmit);
+    chatSocket.addEventListener("close", () => {
+        window.clearTimeout(retryTimer);
+    });
+
+    return {
+        send(frame) {
+            queue.push(frame);
+            transmit();
+        },
+        acknowledge() {
+            if (!inFlight) {
+                return;
+            }
+            queue.shift();
+            inFlight = false;
+            transmit();
+        },
+        retryLater(retryAfterMs) {
+            if (!inFlight) {
+                return;
+            }
+            window.clearTimeout(retryTimer);
+            retryTimer = window.setTimeout(() => {
+                inFlight = false;
+                transmit();
+            }, Math.max(1, Number(retryAfterMs) || retryDelayMs));
+        },
+        get pendingCount() {
+            return queue.length;
+        }
+    };
+}
+
 export function createUserSocket({
     debug = false,
     onNewChat,
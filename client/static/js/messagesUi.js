@@ -1,5 +1,6 @@
 const renderedMessages = new Map();
 const pendingMessageStatuses = new Map();
+const statusWatermarks = { delivered: 0, read: 0, readAt: null };
 
 function formatMessageTime(value) {
     if (!value) {
@@ -293,6 +294,19 @@ export function bindMediaViewerControls() {
 export function resetRenderedMessages() {
     renderedMessages.clear();
     pendingMessageStatuses.clear();
+    statusWatermarks.delivered = 0;
+    statusWatermarks.read = 0;
+    statusWatermarks.readAt = null;
+}
+
+function getWatermarkStatus(messageId) {
+    if (messageId <= statusWatermarks.read) {
+        return "read";
+    }
+    if (messageId <= statusWatermarks.delivered) {
+        return "delivered";
+    }
+    return null;
 }
 
 export function renderMessage(chat, senderLabel, text, options = {}) {
@@ -304,7 +318,8 @@ export function renderMessage(chat, senderLabel, text, options = {}) {
         deletedForAll = false,
         replyTo = null,
         createdAt = null,
-        readAt = null
+        readAt = null,
+        insertBefore = null
     } = options;
 
     if (messageId && renderedMessages.has(messageId)) {
@@ -359,9 +374,12 @@ export function renderMessage(chat, senderLabel, text, options = {}) {
 
     if (isOwnMessage && messageId) {
         const effectiveStatus = resolveStatus(
-            deliveryStatus,
-            pendingMessageStatuses.get(messageId)
+            resolveStatus(deliveryStatus, pendingMessageStatuses.get(messageId)),
+            getWatermarkStatus(messageId)
         );
+        if (effectiveStatus === "read" && !div.dataset.readAt && statusWatermarks.readAt) {
+            div.dataset.readAt = statusWatermarks.readAt;
+        }
         const status = document.createElement("span");
         status.className = getStatusClass(effectiveStatus);
         status.dataset.messageStatusFor = String(messageId);
@@ -387,8 +405,15 @@ export function renderMessage(chat, senderLabel, text, options = {}) {
     div.appendChild(document.createTextNode(" "));
     div.appendChild(meta);
 
-    chat.appendChild(div);
-    chat.scrollTop = chat.scrollHeight;
+    if (insertBefore && insertBefore.parentNode === chat) {
+        // Older history goes above what is already shown; keep the visible messages where they are.
+        const previousScrollHeight = chat.scrollHeight;
+        chat.insertBefore(div, insertBefore);
+        chat.scrollTop += chat.scrollHeight - previousScrollHeight;
+    } else {
+        chat.appendChild(div);
+        chat.scrollTop = chat.scrollHeight;
+    }
     if (messageId) {
         renderedMessages.set(messageId, div);
     }
@@ -429,6 +454,23 @@ export function markMessageDeletedForAll(messageId) {
     }
 }
 
+export function applyMessageStatusWatermark(upToMessageId, status, readAt = null) {
+    // Receipts arrive as "everything up to this id"; messages rendered later pick the watermark up in renderMessage.
+    const upTo = Number(upToMessageId || 0);
+    if (status === "read" && upTo > statusWatermarks.read) {
+        statusWatermarks.read = upTo;
+        statusWatermarks.readAt = readAt || statusWatermarks.readAt;
+    } else if (status === "delivered" && upTo > statusWatermarks.delivered) {
+        statusWatermarks.delivered = upTo;
+    }
+
+    for (const [messageId, row] of renderedMessages) {
+        if (messageId <= upTo && row.dataset.ownMessage === "1") {
+            updateMessageStatus(messageId, status, readAt);
+        }
+    }
+}
+
 export function updateMessageStatus(messageId, status, readAt = null) {
     const row = renderedMessages.get(messageId) || document.querySelector(`[data-message-id="${messageId}"]`);
     if (!row) {
@@ -52,7 +52,25 @@ def run_migrations_offline() -> None:
         context.run_migrations()
 
 
+def run_online_with_connection(connection) -> None:
+    context.configure(
+        connection=connection,
+        target_metadata=target_metadata,
+        compare_type=True,
+        compare_server_default=True,
+    )
+
+    with context.begin_transaction():
+        context.run_migrations()
+
+
 def run_migrations_online() -> None:
+    # The app's schema bootstrap passes its own connection so a stamp shares its transaction and lock.
+    connection = config.attributes.get("connection")
+    if connection is not None:
+        run_online_with_connection(connection)
+        return
+
     connectable = engine_from_config(
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
@@ -60,15 +78,7 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(
-            connection=connection,
-            target_metadata=target_metadata,
-            compare_type=True,
-            compare_server_default=True,
-        )
-
-        with context.begin_transaction():
-            context.run_migrations()
+        run_online_with_connection(connection)
 
 
 if context.is_offline_mode():
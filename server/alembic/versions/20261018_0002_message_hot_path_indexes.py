@@ -0,0 +1,60 @@
+"""Composite and partial indexes for message hot-path queries.
+
+Revision ID: 20261018_0002
+Revises: 20260620_0001
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0002"
+down_revision = "20260620_0001"
+branch_labels = None
+depends_on = None
+
+
+MESSAGE_INDEXES = [
+    # History replay and keyset pagination: WHERE chat_id = ? ORDER BY id.
+    ("ix_messages_chat_id_id", "messages", ["chat_id", "id"], None),
+    # Clear-history cutoffs: WHERE chat_id = ? AND created_at > ?.
+    ("ix_messages_chat_id_created_at", "messages", ["chat_id", "created_at"], None),
+    # Per-sender delivery bookkeeping.
+    ("ix_messages_sender_id_delivered_at", "messages", ["sender_id", "delivered_at"], None),
+    # mark_chat_messages_read: WHERE chat_id = ? AND sender_id != ? AND read_at IS NULL.
+    ("ix_messages_chat_id_sender_id_unread", "messages", ["chat_id", "sender_id"], "read_at IS NULL"),
+    # mark_messages_delivered_for_user: WHERE chat_id IN (...) AND delivered_at IS NULL.
+    ("ix_messages_chat_id_undelivered", "messages", ["chat_id", "sender_id"], "delivered_at IS NULL"),
+    # load_device_payload_map: WHERE user_id = ? AND device_id = ? AND message_id IN (...).
+    (
+        "ix_message_device_payloads_user_device_message",
+        "message_device_payloads",
+        ["user_id", "device_id", "message_id"],
+        None,
+    ),
+]
+
+
+def upgrade() -> None:
+    # CONCURRENTLY keeps the messages table writable while large indexes build on Postgres.
+    with op.get_context().autocommit_block():
+        for name, table_name, columns, where in MESSAGE_INDEXES:
+            op.create_index(
+                name,
+                table_name,
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                sqlite_where=sa.text(where) if where else None,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table_name, _columns, _where in reversed(MESSAGE_INDEXES):
+            op.drop_index(name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
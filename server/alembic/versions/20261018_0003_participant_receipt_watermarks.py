@@ -0,0 +1,39 @@
+"""Per-participant delivery and read watermarks.
+
+Revision ID: 20261018_0003
+Revises: 20261018_0002
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0003"
+down_revision = "20261018_0002"
+branch_labels = None
+depends_on = None
+
+
+WATERMARK_COLUMNS = [
+    ("last_delivered_message_id", sa.Integer()),
+    ("last_delivered_at", sa.DateTime()),
+    ("last_read_message_id", sa.Integer()),
+    ("last_read_at", sa.DateTime()),
+]
+
+
+def upgrade() -> None:
+    # Nullable columns without defaults are a catalog-only change, no table rewrite on Postgres.
+    # Existing rows keep their per-message delivered_at/read_at, which serialization still honours.
+    with op.batch_alter_table("chat_participants") as batch_op:
+        for name, column_type in WATERMARK_COLUMNS:
+            batch_op.add_column(sa.Column(name, column_type, nullable=True))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("chat_participants") as batch_op:
+        for name, _column_type in reversed(WATERMARK_COLUMNS):
+            batch_op.drop_column(name)
@@ -0,0 +1,43 @@
+"""Reference-counted attachment blobs.
+
+Revision ID: 20261018_0004
+Revises: 20261018_0003
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0004"
+down_revision = "20261018_0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "attachment_blobs",
+        sa.Column("url", sa.String(), primary_key=True),
+        sa.Column("sha256", sa.String(length=64), nullable=False),
+        sa.Column("size", sa.Integer(), nullable=False),
+        sa.Column("ref_count", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+    )
+    # Existing flat uploads are not rehashed; counting their references lets a file shared by
+    # several messages survive until the last of them is deleted.
+    op.execute(
+        """
+        INSERT INTO attachment_blobs (url, sha256, size, ref_count, created_at)
+        SELECT attachment_url, '', COALESCE(MAX(attachment_size), 0), COUNT(*), MIN(created_at)
+        FROM messages
+        WHERE attachment_url IS NOT NULL
+        GROUP BY attachment_url
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("attachment_blobs")
@@ -0,0 +1,42 @@
+"""Partial index for attachment download authorization.
+
+Revision ID: 20261018_0005
+Revises: 20261018_0004
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0005"
+down_revision = "20261018_0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # download_message_attachment: WHERE chat_id = ? AND attachment_url = ?; most messages have no attachment.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_messages_chat_id_attachment_url",
+            "messages",
+            ["chat_id", "attachment_url"],
+            unique=False,
+            postgresql_concurrently=True,
+            postgresql_where=sa.text("attachment_url IS NOT NULL"),
+            sqlite_where=sa.text("attachment_url IS NOT NULL"),
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            "ix_messages_chat_id_attachment_url",
+            table_name="messages",
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
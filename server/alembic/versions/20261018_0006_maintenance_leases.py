@@ -0,0 +1,56 @@
+"""Maintenance job leases and indexes for the scheduled purges.
+
+Revision ID: 20261018_0006
+Revises: 20261018_0005
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0006"
+down_revision = "20261018_0005"
+branch_labels = None
+depends_on = None
+
+
+PURGE_INDEXES = (
+    ("ix_refresh_tokens_expires_at", "refresh_tokens", ["expires_at"], None),
+    ("ix_password_reset_tokens_expires_at", "password_reset_tokens", ["expires_at"], None),
+    ("ix_one_time_prekeys_used_at", "one_time_prekeys", ["used_at"], "used_at IS NOT NULL"),
+    ("ix_device_one_time_prekeys_used_at", "device_one_time_prekeys", ["used_at"], "used_at IS NOT NULL"),
+    ("ix_attachment_blobs_unreferenced_created_at", "attachment_blobs", ["created_at"], "ref_count <= 0"),
+)
+
+
+def upgrade() -> None:
+    op.create_table(
+        "maintenance_leases",
+        sa.Column("job_name", sa.String(), primary_key=True),
+        sa.Column("owner", sa.String(), nullable=False),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.Column("last_run_at", sa.DateTime(), nullable=True),
+    )
+    # Each purge scans for expired rows; without these it reads the whole table every interval.
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in PURGE_INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                sqlite_where=sa.text(where) if where else None,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _columns, _where in PURGE_INDEXES:
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    op.drop_table("maintenance_leases")
@@ -0,0 +1,62 @@
+"""Username search indexes: pg_trgm on Postgres, an FTS5 trigram table on SQLite.
+
+Revision ID: 20261018_0007
+Revises: 20261018_0006
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+
+
+revision = "20261018_0007"
+down_revision = "20261018_0006"
+branch_labels = None
+depends_on = None
+
+
+SQLITE_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username))",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5("
+    "username, content='users', content_rowid='id', tokenize='trigram', detail='none')",
+    "CREATE TRIGGER IF NOT EXISTS users_search_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_search (rowid, username) VALUES (new.id, new.username); END",
+    "CREATE TRIGGER IF NOT EXISTS users_search_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username); END",
+    "CREATE TRIGGER IF NOT EXISTS users_search_au AFTER UPDATE OF username ON users BEGIN "
+    "INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username); "
+    "INSERT INTO users_search (rowid, username) VALUES (new.id, new.username); END",
+    "INSERT INTO users_search (users_search) VALUES ('rebuild')",
+)
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        for statement in SQLITE_DDL:
+            op.execute(statement)
+        return
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_prefix "
+            "ON users (lower(username) text_pattern_ops)"
+        )
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_trgm "
+            "ON users USING gin (lower(username) gin_trgm_ops)"
+        )
+
+
+def downgrade() -> None:
+    if op.get_bind().dialect.name == "sqlite":
+        for trigger in ("users_search_ai", "users_search_ad", "users_search_au"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS users_search")
+        op.execute("DROP INDEX IF EXISTS ix_users_username_prefix")
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_trgm")
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_prefix")
@@ -0,0 +1,35 @@
+"""Shared sliding-window rate limit counters.
+
+Revision ID: 20261018_0008
+Revises: 20261018_0007
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0008"
+down_revision = "20261018_0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "rate_limit_counters",
+        sa.Column("key", sa.String(), primary_key=True),
+        sa.Column("window_index", sa.BigInteger(), nullable=False),
+        sa.Column("current_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("previous_count", sa.Integer(), nullable=False, server_default="0"),
+        sa.Column("last_hit_allowed", sa.Boolean(), nullable=False, server_default=sa.true()),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+    )
+    op.create_index("ix_rate_limit_counters_expires_at", "rate_limit_counters", ["expires_at"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("ix_rate_limit_counters_expires_at", table_name="rate_limit_counters")
+    op.drop_table("rate_limit_counters")
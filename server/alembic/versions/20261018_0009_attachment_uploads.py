@@ -0,0 +1,32 @@
+"""Record who uploaded each attachment blob.
+
+Revision ID: 20261018_0009
+Revises: 20261018_0008
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0009"
+down_revision = "20261018_0008"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Blobs uploaded before this revision have no uploader; they can still be sent to chats
+    # that already reference them.
+    op.create_table(
+        "attachment_uploads",
+        sa.Column("url", sa.String(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), primary_key=True),
+        sa.Column("created_at", sa.DateTime(), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("attachment_uploads")
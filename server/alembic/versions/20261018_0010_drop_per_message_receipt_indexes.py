@@ -0,0 +1,48 @@
+"""Drop the per-message receipt indexes.
+
+Revision ID: 20261018_0010
+Revises: 20261018_0009
+Create Date: 2026-10-18 00:00:00
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "20261018_0010"
+down_revision = "20261018_0009"
+branch_labels = None
+depends_on = None
+
+
+# Receipts are per-participant watermarks now, so nothing filters messages on delivered_at or
+# read_at any more. The watermark scan, max(id) WHERE chat_id = ? AND sender_id <> ?, walks
+# ix_messages_chat_id_id backwards and stops at the first message from someone else.
+RECEIPT_INDEXES = [
+    ("ix_messages_sender_id_delivered_at", ["sender_id", "delivered_at"], None),
+    ("ix_messages_chat_id_sender_id_unread", ["chat_id", "sender_id"], "read_at IS NULL"),
+    ("ix_messages_chat_id_undelivered", ["chat_id", "sender_id"], "delivered_at IS NULL"),
+]
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, _columns, _where in RECEIPT_INDEXES:
+            op.drop_index(name, table_name="messages", postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, columns, where in reversed(RECEIPT_INDEXES):
+            op.create_index(
+                name,
+                "messages",
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+                postgresql_where=sa.text(where) if where else None,
+                sqlite_where=sa.text(where) if where else None,
+                if_not_exists=True,
+            )
@@ -1,11 +1,244 @@
+import logging
+import math
 import os
-from collections import defaultdict
+import threading
 import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Callable
 
-login_attempts = defaultdict(list)
-forgot_password_attempts = defaultdict(list)
+from fastapi import HTTPException, Request
+from sqlalchemy import case, delete
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.db.models import RateLimitCounter
+from app.db.session import SessionLocal
+from app.utils.time import utc_now
+
+
+logger = logging.getLogger("app.rate_limit")
+audit_logger = logging.getLogger("app.audit")
 
 MAX_ATTEMPTS = int(os.getenv("LOGIN_RATE_LIMIT_MAX_ATTEMPTS", 5))
 WINDOW_SECONDS = int(os.getenv("LOGIN_RATE_LIMIT_WINDOW_SECONDS", 60))
 FORGOT_PASSWORD_MAX_ATTEMPTS = int(os.getenv("FORGOT_PASSWORD_RATE_LIMIT_MAX_ATTEMPTS", 5))
 FORGOT_PASSWORD_WINDOW_SECONDS = int(os.getenv("FORGOT_PASSWORD_RATE_LIMIT_WINDOW_SECONDS", 300))
+# Upper bound on keys the in-memory backend tracks; the least recently seen go first.
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100_000))
+
+
+class RateLimit:
+    """At most ``limit`` hits per ``window_seconds`` for each key, usually a client IP."""
+
+    def __init__(self, name: str, limit: int, window_seconds: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.window_seconds = max(1.0, float(window_seconds))
+
+
+LOGIN_RATE_LIMIT = RateLimit("login", MAX_ATTEMPTS, WINDOW_SECONDS)
+FORGOT_PASSWORD_RATE_LIMIT = RateLimit("forgot_password", FORGOT_PASSWORD_MAX_ATTEMPTS, FORGOT_PASSWORD_WINDOW_SECONDS)
+
+
+def window_position(rule: RateLimit, now: float) -> tuple[int, float]:
+    """The fixed window ``now`` falls in, and how far into it we are."""
+    window_index = int(now // rule.window_seconds)
+    return window_index, now - window_index * rule.window_seconds
+
+
+def shift_windows(window_index: int, counted_index: int, current: int, previous: int) -> tuple[int, int]:
+    """Counts as of ``window_index`` for a counter last written during ``counted_index``."""
+    if counted_index == window_index:
+        return current, previous
+    if counted_index == window_index - 1:
+        return 0, current
+    return 0, 0
+
+
+def retry_after_seconds(rule: RateLimit, current: int, previous: int, elapsed: float) -> float:
+    """How long until one more hit fits, assuming nothing else is counted in the meantime."""
+    window = rule.window_seconds
+    if current < rule.limit:
+        # The previous window's share decays linearly; wait until it drops below what is left.
+        return max(window * (1 - (rule.limit - current) / previous) - elapsed, 0.0)
+    # This window is full on its own, so it has to roll over and decay as the previous one.
+    return window - elapsed + window * (1 - rule.limit / current)
+
+
+class MemoryRateLimitBackend:
+    """Sliding-window counters for this process only.
+
+    Each key keeps two counts, the current fixed window and the one before it, and the
+    previous count is weighted by how much of it still overlaps the sliding window. That
+    is O(1) state per key instead of a list of timestamps. Keys are kept in LRU order and
+    dropped once they expire or ``max_keys`` is reached.
+    """
+
+    def __init__(self, *, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max(1, max_keys)
+        # key -> (window_index, current, previous, expires_at)
+        self._counters: OrderedDict[str, tuple[int, int, int, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"evicted": 0}
+
+    def hit(self, rule: RateLimit, key: str, now: float) -> tuple[bool, float]:
+        window_index, elapsed = window_position(rule, now)
+        with self._lock:
+            counter = self._counters.get(key)
+            current, previous = (
+                shift_windows(window_index, counter[0], counter[1], counter[2]) if counter else (0, 0)
+            )
+            allowed = previous * (1 - elapsed / rule.window_seconds) + current < rule.limit
+            if allowed:
+                current += 1
+            self._counters[key] = (window_index, current, previous, (window_index + 2) * rule.window_seconds)
+            self._counters.move_to_end(key)
+            self._evict(now)
+        return allowed, 0.0 if allowed else retry_after_seconds(rule, current, previous, elapsed)
+
+    def _evict(self, now: float):
+        while self._counters:
+            oldest = next(iter(self._counters.values()))
+            if len(self._counters) <= self.max_keys and oldest[3] > now:
+                return
+            self._counters.popitem(last=False)
+            self.stats["evicted"] += 1
+
+    def get_metrics(self) -> dict:
+        with self._lock:
+            return {"keys": len(self._counters), **self.stats}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+
+
+class DatabaseRateLimitBackend:
+    """Sliding-window counters in ``rate_limit_counters``, shared by every worker and node.
+
+    A hit is one upsert that rolls the windows forward, decides, and counts in the same
+    statement, so two workers racing on one key cannot both take the last slot. Expired
+    rows are removed by the ``rate_limit_counters`` maintenance job.
+    """
+
+    def __init__(self, session_factory=SessionLocal):
+        self.session_factory = session_factory
+        self.stats = {"errors": 0}
+
+    def hit(self, rule: RateLimit, key: str, now: float) -> tuple[bool, float]:
+        window_index, elapsed = window_position(rule, now)
+        same_window = RateLimitCounter.window_index == window_index
+        current = case((same_window, RateLimitCounter.current_count), else_=0)
+        previous = case(
+            (same_window, RateLimitCounter.previous_count),
+            (RateLimitCounter.window_index == window_index - 1, RateLimitCounter.current_count),
+            else_=0,
+        )
+        allowed = previous * (1 - elapsed / rule.window_seconds) + current < rule.limit
+        expires_at = utc_now() + timedelta(seconds=2 * rule.window_seconds - elapsed)
+
+        try:
+            with self.session_factory() as db:
+                dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+                statement = dialect_insert(RateLimitCounter).values(
+                    key=key,
+                    window_index=window_index,
+                    current_count=1,
+                    previous_count=0,
+                    last_hit_allowed=True,
+                    expires_at=expires_at,
+                )
+                statement = statement.on_conflict_do_update(
+                    index_elements=[RateLimitCounter.key],
+                    set_={
+                        "window_index": window_index,
+                        "current_count": current + case((allowed, 1), else_=0),
+                        "previous_count": previous,
+                        "last_hit_allowed": allowed,
+                        "expires_at": expires_at,
+                    },
+                ).returning(
+                    RateLimitCounter.current_count,
+                    RateLimitCounter.previous_count,
+                    RateLimitCounter.last_hit_allowed,
+                )
+                current_count, previous_count, hit_allowed = db.execute(statement).one()
+                db.commit()
+        except SQLAlchemyError:
+            # Fail open: an unreachable limiter should not lock everyone out of logging in.
+            self.stats["errors"] += 1
+            logger.exception("rate_limit_backend_failed rule=%s", rule.name)
+            return True, 0.0
+        if hit_allowed:
+            return True, 0.0
+        return False, retry_after_seconds(rule, current_count, previous_count, elapsed)
+
+    def get_metrics(self) -> dict:
+        return dict(self.stats)
+
+    def clear(self):
+        with self.session_factory() as db:
+            db.execute(delete(RateLimitCounter))
+            db.commit()
+
+
+class RateLimiter:
+    def __init__(self, backend, *, clock: Callable[[], float] = time.time):
+        self.backend = backend
+        # Wall-clock time, so workers on different nodes agree on window boundaries.
+        self.clock = clock
+        self.stats = {"allowed": 0, "denied": 0}
+
+    def hit(self, rule: RateLimit, key: str) -> tuple[bool, float]:
+        """Count one hit for ``key`` under ``rule``; returns (allowed, retry_after_seconds)."""
+        allowed, retry_after = self.backend.hit(rule, f"{rule.name}:{key}", self.clock())
+        self.stats["allowed" if allowed else "denied"] += 1
+        return allowed, retry_after
+
+    def get_metrics(self) -> dict:
+        return {
+            **{f"rate_limit_{name}": value for name, value in self.stats.items()},
+            **{f"rate_limit_backend_{name}": value for name, value in self.backend.get_metrics().items()},
+        }
+
+    def clear(self):
+        self.backend.clear()
+        for name in self.stats:
+            self.stats[name] = 0
+
+
+def create_rate_limit_backend_from_env():
+    backend = os.getenv("RATE_LIMIT_BACKEND", "memory").strip().lower()
+    if backend in {"", "memory", "inprocess", "in-process"}:
+        return MemoryRateLimitBackend()
+    if backend in {"database", "db", "postgres", "postgresql"}:
+        return DatabaseRateLimitBackend()
+    raise RuntimeError(f"Unknown RATE_LIMIT_BACKEND backend: {backend}")
+
+
+rate_limiter = RateLimiter(create_rate_limit_backend_from_env())
+
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def rate_limit(rule: RateLimit, *, detail: str, key: Callable[[Request], str] = client_ip):
+    """A dependency that answers 429 with ``Retry-After`` once a key goes over ``rule``.
+
+        @router.post("/login", dependencies=[Depends(rate_limit(LOGIN_RATE_LIMIT, detail="..."))])
+    """
+
+    def check_rate_limit(request: Request):
+        allowed, retry_after = rate_limiter.hit(rule, key(request))
+        if not allowed:
+            audit_logger.warning("%s_rate_limited ip=%s", rule.name, client_ip(request))
+            raise HTTPException(
+                status_code=429,
+                detail=detail,
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+            )
+
+    return check_rate_limit
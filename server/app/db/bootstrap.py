@@ -0,0 +1,147 @@
+import ast
+import logging
+import os
+import re
+from pathlib import Path
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from app.db.base import Base
+from app.db.search_index import ensure_user_search_index
+
+
+logger = logging.getLogger("app.db.bootstrap")
+
+ALEMBIC_SCRIPT_DIR = Path(__file__).resolve().parents[2] / "alembic"
+# auto: skip all introspection when the alembic stamp is at head, otherwise fall back to the legacy bootstrap.
+# true: always run the legacy bootstrap. false: never touch the schema, only report a stale stamp.
+DB_AUTO_BOOTSTRAP = os.getenv("DB_AUTO_BOOTSTRAP", "auto").strip().lower()
+BOOTSTRAP_LOCK_ID = 7_320_451
+
+ensure_schema_sql = [
+    ("users", "account_instance_id", "ALTER TABLE users ADD COLUMN account_instance_id TEXT"),
+    ("users", "avatar_filename", "ALTER TABLE users ADD COLUMN avatar_filename TEXT"),
+    ("users", "signed_prekey", "ALTER TABLE users ADD COLUMN signed_prekey TEXT"),
+    ("users", "signed_prekey_signature", "ALTER TABLE users ADD COLUMN signed_prekey_signature TEXT"),
+    ("users", "signed_prekey_key_id", "ALTER TABLE users ADD COLUMN signed_prekey_key_id INTEGER"),
+    ("chats", "is_group", "ALTER TABLE chats ADD COLUMN is_group BOOLEAN NOT NULL DEFAULT FALSE"),
+    ("chats", "title", "ALTER TABLE chats ADD COLUMN title TEXT"),
+    ("chats", "avatar_filename", "ALTER TABLE chats ADD COLUMN avatar_filename TEXT"),
+    ("chats", "creator_id", "ALTER TABLE chats ADD COLUMN creator_id INTEGER"),
+    ("chats", "group_key_epoch", "ALTER TABLE chats ADD COLUMN group_key_epoch INTEGER NOT NULL DEFAULT 1"),
+    ("chats", "user1_hidden", "ALTER TABLE chats ADD COLUMN user1_hidden BOOLEAN NOT NULL DEFAULT FALSE"),
+    ("chats", "user2_hidden", "ALTER TABLE chats ADD COLUMN user2_hidden BOOLEAN NOT NULL DEFAULT FALSE"),
+    ("chats", "user1_cleared_at", "ALTER TABLE chats ADD COLUMN user1_cleared_at TIMESTAMP"),
+    ("chats", "user2_cleared_at", "ALTER TABLE chats ADD COLUMN user2_cleared_at TIMESTAMP"),
+    ("chat_participants", "last_delivered_message_id", "ALTER TABLE chat_participants ADD COLUMN last_delivered_message_id INTEGER"),
+    ("chat_participants", "last_delivered_at", "ALTER TABLE chat_participants ADD COLUMN last_delivered_at TIMESTAMP"),
+    ("chat_participants", "last_read_message_id", "ALTER TABLE chat_participants ADD COLUMN last_read_message_id INTEGER"),
+    ("chat_participants", "last_read_at", "ALTER TABLE chat_participants ADD COLUMN last_read_at TIMESTAMP"),
+    ("messages", "delivered_at", "ALTER TABLE messages ADD COLUMN delivered_at TIMESTAMP"),
+    ("messages", "read_at", "ALTER TABLE messages ADD COLUMN read_at TIMESTAMP"),
+    ("messages", "attachment_kind", "ALTER TABLE messages ADD COLUMN attachment_kind TEXT"),
+    ("messages", "attachment_url", "ALTER TABLE messages ADD COLUMN attachment_url TEXT"),
+    ("messages", "attachment_name", "ALTER TABLE messages ADD COLUMN attachment_name TEXT"),
+    ("messages", "attachment_mime_type", "ALTER TABLE messages ADD COLUMN attachment_mime_type TEXT"),
+    ("messages", "attachment_size", "ALTER TABLE messages ADD COLUMN attachment_size INTEGER"),
+    ("messages", "attachment_meta", "ALTER TABLE messages ADD COLUMN attachment_meta TEXT"),
+    ("messages", "sender_device_id", "ALTER TABLE messages ADD COLUMN sender_device_id TEXT"),
+    ("messages", "reply_to_message_id", "ALTER TABLE messages ADD COLUMN reply_to_message_id INTEGER"),
+    ("messages", "deleted_for_all_at", "ALTER TABLE messages ADD COLUMN deleted_for_all_at TIMESTAMP"),
+    ("messages", "deleted_for_all_by_user_id", "ALTER TABLE messages ADD COLUMN deleted_for_all_by_user_id INTEGER"),
+]
+
+
+REVISION_PATTERN = re.compile(r"^(revision|down_revision)\s*=\s*(.+)$", re.MULTILINE)
+
+
+def get_head_revisions() -> set[str]:
+    # Read the identifiers straight from the version files; loading alembic's ScriptDirectory
+    # imports every migration module and costs more than the rest of the start-up check.
+    revisions = set()
+    parents = set()
+    for path in (ALEMBIC_SCRIPT_DIR / "versions").glob("*.py"):
+        values = dict(REVISION_PATTERN.findall(path.read_text(encoding="utf-8")))
+        if "revision" not in values:
+            continue
+        revisions.add(ast.literal_eval(values["revision"]))
+        down_revision = ast.literal_eval(values.get("down_revision", "None"))
+        if isinstance(down_revision, str):
+            parents.add(down_revision)
+        elif down_revision:
+            parents.update(down_revision)
+    return revisions - parents
+
+
+def get_current_revisions(engine: Engine) -> set[str]:
+    try:
+        with engine.connect() as connection:
+            return {row[0] for row in connection.execute(text("SELECT version_num FROM alembic_version"))}
+    except (OperationalError, ProgrammingError):
+        return set()
+
+
+def stamp_schema_head(connection):
+    """Record the schema built by ``bootstrap_schema`` as current, on the caller's connection."""
+    config = Config()
+    config.set_main_option("script_location", str(ALEMBIC_SCRIPT_DIR))
+    config.attributes["connection"] = connection
+    command.stamp(config, "head", purge=True)
+
+
+def bootstrap_schema(engine: Engine):
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # Workers starting together would otherwise race on the same DDL; released on commit.
+            connection.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": BOOTSTRAP_LOCK_ID})
+
+        # Let SQLAlchemy create all missing tables with dialect-correct types first.
+        Base.metadata.create_all(bind=connection)
+
+        inspector = inspect(connection)
+        existing_tables = set(inspector.get_table_names())
+        for table_name, column_name, ddl in ensure_schema_sql:
+            if table_name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table_name)}
+            if column_name not in existing_columns:
+                try:
+                    connection.execute(text(ddl))
+                except OperationalError as error:
+                    if "duplicate column name" not in str(error).lower():
+                        raise
+
+        # create_all only fires the users table's DDL hooks when it creates the table.
+        ensure_user_search_index(connection)
+
+        # The tables now match head; without the stamp a later `alembic upgrade head` would
+        # replay 0001 onward against them and fail.
+        stamp_schema_head(connection)
+
+
+def prepare_schema(engine: Engine, mode: str = DB_AUTO_BOOTSTRAP) -> str:
+    if mode in {"1", "true", "yes", "on"}:
+        bootstrap_schema(engine)
+        return "bootstrapped"
+
+    current = get_current_revisions(engine)
+    heads = get_head_revisions()
+    if current and current == heads:
+        logger.info("schema_current revision=%s", ",".join(sorted(current)))
+        return "current"
+
+    if mode in {"0", "false", "no", "off"}:
+        logger.warning(
+            "schema_not_at_head current=%s head=%s; run `alembic upgrade head`",
+            ",".join(sorted(current)) or "none",
+            ",".join(sorted(heads)),
+        )
+        return "stale"
+
+    logger.info("schema_bootstrap_fallback current=%s", ",".join(sorted(current)) or "none")
+    bootstrap_schema(engine)
+    return "bootstrapped"
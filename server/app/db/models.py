@@ -1,10 +1,11 @@
 from datetime import datetime
 import uuid
 
-from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String, Text, UniqueConstraint
+from sqlalchemy import BigInteger, Boolean, DateTime, ForeignKey, Index, Integer, String, Text, UniqueConstraint, text
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from .base import Base
+from .search_index import install_user_search_index
 from app.utils.time import utc_now
 
 
@@ -29,6 +30,9 @@ class User(Base):
     signed_prekey_key_id: Mapped[int] = mapped_column(Integer, nullable=True)
 
 
+install_user_search_index(User.__table__)
+
+
 class Device(Base):
     __tablename__ = "devices"
 
@@ -54,7 +58,7 @@ class RefreshToken(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     token: Mapped[str] = mapped_column(String, unique=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"))
-    expires_at: Mapped[datetime] = mapped_column(DateTime)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
 
     user_agent: Mapped[str] = mapped_column(String, nullable=True)
     ip_address: Mapped[str] = mapped_column(String, nullable=True)
@@ -77,7 +81,7 @@ class PasswordResetToken(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     token_id: Mapped[str] = mapped_column(String, unique=True, index=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
-    expires_at: Mapped[datetime] = mapped_column(DateTime)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime, default=utc_now)
     used_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
 
@@ -119,6 +123,11 @@ class ChatParticipant(Base):
     hidden: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
     cleared_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
     joined_at: Mapped[datetime] = mapped_column(DateTime, default=utc_now)
+    # Receipts are watermarks: every message from someone else with an id up to these is delivered/read.
+    last_delivered_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    last_delivered_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    last_read_message_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    last_read_at: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
 
     __table_args__ = (
         UniqueConstraint("chat_id", "user_id"),
@@ -149,6 +158,47 @@ class Message(Base):
     deleted_for_all_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     deleted_for_all_by_user_id: Mapped[int] = mapped_column(Integer, nullable=True)
 
+    __table_args__ = (
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at"),
+        Index(
+            "ix_messages_chat_id_attachment_url",
+            "chat_id",
+            "attachment_url",
+            postgresql_where=text("attachment_url IS NOT NULL"),
+            sqlite_where=text("attachment_url IS NOT NULL"),
+        ),
+    )
+
+
+class AttachmentBlob(Base):
+    __tablename__ = "attachment_blobs"
+
+    # Keyed by the URL stored in Message.attachment_url; ref_count is the number of messages using it.
+    url: Mapped[str] = mapped_column(String, primary_key=True)
+    sha256: Mapped[str] = mapped_column(String(64), nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    ref_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utc_now)
+
+    __table_args__ = (
+        Index(
+            "ix_attachment_blobs_unreferenced_created_at",
+            "created_at",
+            postgresql_where=text("ref_count <= 0"),
+            sqlite_where=text("ref_count <= 0"),
+        ),
+    )
+
+
+class AttachmentUpload(Base):
+    __tablename__ = "attachment_uploads"
+
+    # Who uploaded a blob; only they may attach it to a message until it is referenced in a chat.
+    url: Mapped[str] = mapped_column(String, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=utc_now)
+
 
 class MessageDevicePayload(Base):
     __tablename__ = "message_device_payloads"
@@ -163,6 +213,7 @@ class MessageDevicePayload(Base):
 
     __table_args__ = (
         UniqueConstraint("message_id", "device_id", "payload_role"),
+        Index("ix_message_device_payloads_user_device_message", "user_id", "device_id", "message_id"),
     )
 
 
@@ -193,6 +244,12 @@ class OneTimePreKey(Base):
 
     __table_args__ = (
         UniqueConstraint("user_id", "key_id"),
+        Index(
+            "ix_one_time_prekeys_used_at",
+            "used_at",
+            postgresql_where=text("used_at IS NOT NULL"),
+            sqlite_where=text("used_at IS NOT NULL"),
+        ),
     )
 
 
@@ -208,4 +265,32 @@ class DeviceOneTimePreKey(Base):
 
     __table_args__ = (
         UniqueConstraint("device_id", "key_id"),
+        Index(
+            "ix_device_one_time_prekeys_used_at",
+            "used_at",
+            postgresql_where=text("used_at IS NOT NULL"),
+            sqlite_where=text("used_at IS NOT NULL"),
+        ),
     )
+
+
+class MaintenanceLease(Base):
+    __tablename__ = "maintenance_leases"
+
+    # One row per scheduled job; whoever holds an unexpired lease runs the job, everyone else skips it.
+    job_name: Mapped[str] = mapped_column(String, primary_key=True)
+    owner: Mapped[str] = mapped_column(String, nullable=False)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    last_run_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+
+class RateLimitCounter(Base):
+    __tablename__ = "rate_limit_counters"
+
+    # Sliding-window counter for one rate-limited key, shared by every worker; see app/core/rate_limit.py.
+    key: Mapped[str] = mapped_column(String, primary_key=True)
+    window_index: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    current_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    previous_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_hit_allowed: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
@@ -0,0 +1,63 @@
+import logging
+
+from sqlalchemy import Table, event, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
+
+logger = logging.getLogger("app.db.search_index")
+
+# Substring search over usernames. Postgres uses pg_trgm on lower(username); SQLite keeps an FTS5
+# trigram table in step with `users` through triggers. Prefix search on both uses a plain index on
+# lower(username), created here too because SQLite and Postgres need different operator classes.
+POSTGRES_USER_SEARCH_DDL = (
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)",
+)
+
+SQLITE_USER_SEARCH_DDL = (
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username))",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_search USING fts5("
+    "username, content='users', content_rowid='id', tokenize='trigram', detail='none')",
+    "CREATE TRIGGER IF NOT EXISTS users_search_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_search (rowid, username) VALUES (new.id, new.username); END",
+    "CREATE TRIGGER IF NOT EXISTS users_search_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username); END",
+    "CREATE TRIGGER IF NOT EXISTS users_search_au AFTER UPDATE OF username ON users BEGIN "
+    "INSERT INTO users_search (users_search, rowid, username) VALUES ('delete', old.id, old.username); "
+    "INSERT INTO users_search (rowid, username) VALUES (new.id, new.username); END",
+)
+
+
+def ensure_user_search_index(connection: Connection, *, rebuild: bool = False):
+    """Create the username search indexes if they are missing; safe to run on every bootstrap."""
+    if connection.dialect.name == "postgresql":
+        for statement in POSTGRES_USER_SEARCH_DDL:
+            connection.execute(text(statement))
+        return
+    if connection.dialect.name != "sqlite":
+        return
+
+    existed = bool(
+        connection.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_search'")).first()
+    )
+    try:
+        for statement in SQLITE_USER_SEARCH_DDL:
+            connection.execute(text(statement))
+    except OperationalError:
+        # Builds without FTS5 or the trigram tokenizer (SQLite < 3.34) fall back to scanning.
+        logger.warning("user_search_index_unavailable dialect=sqlite", exc_info=True)
+        return
+    if rebuild or not existed:
+        connection.execute(text("INSERT INTO users_search (users_search) VALUES ('rebuild')"))
+
+
+def drop_user_search_index(connection: Connection):
+    if connection.dialect.name == "sqlite":
+        connection.execute(text("DROP TABLE IF EXISTS users_search"))
+
+
+def install_user_search_index(users_table: Table):
+    event.listen(users_table, "after_create", lambda _table, connection, **_kw: ensure_user_search_index(connection))
+    event.listen(users_table, "before_drop", lambda _table, connection, **_kw: drop_user_search_index(connection))
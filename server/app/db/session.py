@@ -1,10 +1,9 @@
+import asyncio
 import os
-import time
 import logging
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.exc import OperationalError
 from app.utils.logging_config import setup_logging
 
 
@@ -76,26 +75,27 @@ if IS_SQLITE:
 
 
 # 🔁 ЧЕКАЄМО ПОКИ БД СТАРТУЄ
-def wait_for_db(max_retries: int = 10, delay: int = 2):
-    if DB_URL_SYNC.startswith("sqlite"):
-        return
+async def check_db_ready() -> bool:
+    try:
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+        return True
+    except Exception:
+        return False
+
 
+async def wait_for_db_async(max_retries: int = 10, delay: float = 2):
     for attempt in range(max_retries):
-        try:
-            with engine.connect():
-                logger.info("Database connected")
-                return
-        except OperationalError:
-            logger.warning("Database not ready (attempt %s/%s)", attempt + 1, max_retries)
-            time.sleep(delay)
+        if await check_db_ready():
+            logger.info("Database connected")
+            return
+        logger.warning("Database not ready (attempt %s/%s)", attempt + 1, max_retries)
+        await asyncio.sleep(delay)
 
     logger.error("Could not connect to database after multiple attempts")
     raise RuntimeError("Could not connect to database after multiple attempts")
 
 
-wait_for_db()
-
-
 def get_db():
     db: Session = SessionLocal()
     try:
@@ -1,24 +1,42 @@
-from fastapi import Depends, Cookie, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import Cookie, HTTPException
+from sqlalchemy import select
 from app.utils.jwt import decode_access_token
-from app.db.session import get_db
+from app.utils.user_cache import user_cache
+from app.db.session import AsyncSessionLocal
 from app.db.models import User
 
-def get_current_user(
-    access_token: str = Cookie(None),
-    db: Session = Depends(get_db)
-):
+
+async def get_user_for_token_payload(payload: dict) -> User | None:
+    email = payload.get("sub")
+    account_instance_id = payload.get("aid")
+    cache_key = (email, account_instance_id)
+
+    user = user_cache.get(cache_key)
+    if user is not None:
+        return user
+
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(User).where(User.email == email))
+        user = result.scalar_one_or_none()
+
+    # A token minted for an earlier account with the same email must not resolve to the new one.
+    if not user or (account_instance_id and user.account_instance_id != account_instance_id):
+        return None
+
+    user_cache.set(cache_key, user)
+    return user
+
+
+async def get_current_user(access_token: str = Cookie(None)):
     if not access_token:
         raise HTTPException(status_code=401, detail="Не авторизовано")
-    
+
     payload = decode_access_token(access_token)
 
     if payload is None:
         raise HTTPException(status_code=401, detail="Невірний токен")
 
-    email = payload.get("sub")
-
-    user = db.query(User).filter(User.email == email).first()
+    user = await get_user_for_token_payload(payload)
 
     if not user:
         raise HTTPException(status_code=401, detail="Користувач не існує")
@@ -1,32 +1,62 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from collections import defaultdict
-from time import time
+from contextlib import asynccontextmanager
+from time import monotonic, time
+import asyncio
 import os
 import logging
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
+from app.core.rate_limit import rate_limiter
 from app.routers import auth, messages
-from app.db.base import Base
-from app.db.session import engine
-from sqlalchemy import inspect, text
-from sqlalchemy.exc import OperationalError
+from app.db.bootstrap import prepare_schema
+from app.db.session import check_db_ready, engine, wait_for_db_async
 from fastapi.staticfiles import StaticFiles
+from app.utils.admission import admission
 from app.utils.csrf import attach_csrf_cookie, configure_templates, get_or_create_csrf_token
 from app.utils.logging_config import setup_logging
+from app.utils.maintenance import MaintenanceJob, MaintenanceScheduler, default_maintenance_jobs
+from app.utils.websocket_manager import manager
 # ---------------------- Конфіг ----------------------
-login_attempts = defaultdict(list)
-MAX_ATTEMPTS = 5
-WINDOW_SECONDS = 60
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+READINESS_CACHE_SECONDS = float(os.getenv("READINESS_CACHE_SECONDS", 2))
 
 # Абсолютний шлях всередині контейнера
 templates = configure_templates(Jinja2Templates(directory=os.getenv("TEMPLATES_DIR", "/code/client/templates")))
 setup_logging()
 logger = logging.getLogger("app.main")
+maintenance = MaintenanceScheduler(
+    [*default_maintenance_jobs(), MaintenanceJob("orphan_uploads", messages.purge_orphan_uploads)]
+)
 
 # ---------------------- FastAPI ----------------------
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    await wait_for_db_async()
+    # Checks one alembic stamp; the legacy create_all/introspection bootstrap only runs when it is behind.
+    application.state.schema_state = await asyncio.to_thread(prepare_schema, engine)
+    application.state.readiness = (0.0, False)
+    await manager.start()
+    await maintenance.start()
+    await admission.start()
+    try:
+        yield
+    finally:
+        await admission.stop()
+        await maintenance.stop()
+        await manager.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# Matched before the /static mount: message attachments are only served by the route that checks chat membership.
+@app.api_route("/static/uploads/messages/{path:path}", methods=["GET", "HEAD"], include_in_schema=False)
+async def hide_message_uploads(path: str):
+    raise HTTPException(status_code=404, detail="Not found")
+
+
 app.mount(
     "/static",
     StaticFiles(directory=os.getenv("STATIC_DIR", "/code/client/static")),
@@ -58,9 +88,9 @@ async def handle_http_exception(request: Request, exc: StarletteHTTPException):
         )
 
     if "application/json" in request.headers.get("accept", ""):
-        return JSONResponse({"detail": exc.detail}, status_code=exc.status_code)
+        return JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
 
-    return PlainTextResponse(str(exc.detail), status_code=exc.status_code)
+    return PlainTextResponse(str(exc.detail), status_code=exc.status_code, headers=exc.headers)
 
 
 @app.middleware("http")
@@ -97,54 +127,6 @@ async def add_security_headers(request: Request, call_next):
         )
     return response
 
-# ---------------------- DB ----------------------
-ensure_schema_sql = [
-    ("users", "account_instance_id", "ALTER TABLE users ADD COLUMN account_instance_id TEXT"),
-    ("users", "avatar_filename", "ALTER TABLE users ADD COLUMN avatar_filename TEXT"),
-    ("users", "signed_prekey", "ALTER TABLE users ADD COLUMN signed_prekey TEXT"),
-    ("users", "signed_prekey_signature", "ALTER TABLE users ADD COLUMN signed_prekey_signature TEXT"),
-    ("users", "signed_prekey_key_id", "ALTER TABLE users ADD COLUMN signed_prekey_key_id INTEGER"),
-    ("chats", "is_group", "ALTER TABLE chats ADD COLUMN is_group BOOLEAN NOT NULL DEFAULT FALSE"),
-    ("chats", "title", "ALTER TABLE chats ADD COLUMN title TEXT"),
-    ("chats", "avatar_filename", "ALTER TABLE chats ADD COLUMN avatar_filename TEXT"),
-    ("chats", "creator_id", "ALTER TABLE chats ADD COLUMN creator_id INTEGER"),
-    ("chats", "group_key_epoch", "ALTER TABLE chats ADD COLUMN group_key_epoch INTEGER NOT NULL DEFAULT 1"),
-    ("chats", "user1_hidden", "ALTER TABLE chats ADD COLUMN user1_hidden BOOLEAN NOT NULL DEFAULT FALSE"),
-    ("chats", "user2_hidden", "ALTER TABLE chats ADD COLUMN user2_hidden BOOLEAN NOT NULL DEFAULT FALSE"),
-    ("chats", "user1_cleared_at", "ALTER TABLE chats ADD COLUMN user1_cleared_at TIMESTAMP"),
-    ("chats", "user2_cleared_at", "ALTER TABLE chats ADD COLUMN user2_cleared_at TIMESTAMP"),
-    ("messages", "delivered_at", "ALTER TABLE messages ADD COLUMN delivered_at TIMESTAMP"),
-    ("messages", "read_at", "ALTER TABLE messages ADD COLUMN read_at TIMESTAMP"),
-    ("messages", "attachment_kind", "ALTER TABLE messages ADD COLUMN attachment_kind TEXT"),
-    ("messages", "attachment_url", "ALTER TABLE messages ADD COLUMN attachment_url TEXT"),
-    ("messages", "attachment_name", "ALTER TABLE messages ADD COLUMN attachment_name TEXT"),
-    ("messages", "attachment_mime_type", "ALTER TABLE messages ADD COLUMN attachment_mime_type TEXT"),
-    ("messages", "attachment_size", "ALTER TABLE messages ADD COLUMN attachment_size INTEGER"),
-    ("messages", "attachment_meta", "ALTER TABLE messages ADD COLUMN attachment_meta TEXT"),
-    ("messages", "sender_device_id", "ALTER TABLE messages ADD COLUMN sender_device_id TEXT"),
-    ("messages", "reply_to_message_id", "ALTER TABLE messages ADD COLUMN reply_to_message_id INTEGER"),
-    ("messages", "deleted_for_all_at", "ALTER TABLE messages ADD COLUMN deleted_for_all_at TIMESTAMP"),
-    ("messages", "deleted_for_all_by_user_id", "ALTER TABLE messages ADD COLUMN deleted_for_all_by_user_id INTEGER"),
-]
-
-# Let SQLAlchemy create all missing tables with dialect-correct types first.
-Base.metadata.create_all(bind=engine)
-
-inspector = inspect(engine)
-existing_tables = set(inspector.get_table_names())
-
-with engine.begin() as connection:
-    for table_name, column_name, ddl in ensure_schema_sql:
-        if table_name not in existing_tables:
-            continue
-        existing_columns = {column["name"] for column in inspector.get_columns(table_name)}
-        if column_name not in existing_columns:
-            try:
-                connection.execute(text(ddl))
-            except OperationalError as error:
-                if "duplicate column name" not in str(error).lower():
-                    raise
-
 # ---------------------- Роутери ----------------------
 app.include_router(auth.router)
 app.include_router(messages.router)
@@ -153,3 +135,35 @@ app.include_router(messages.router)
 @app.get("/")
 def index(request: Request):
     return templates.TemplateResponse(request, "index.html", {"request": request})
+
+
+@app.get("/internal/metrics/websockets")
+def websocket_metrics(request: Request):
+    # Hidden unless an operator configured a token for the scraper.
+    if not METRICS_TOKEN or request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=404, detail="Not found")
+    return {
+        **manager.get_metrics(),
+        **{f"chat_write_{name}": value for name, value in messages.chat_writer.stats.items()},
+        **maintenance.get_metrics(),
+        **rate_limiter.get_metrics(),
+        **admission.get_metrics(),
+    }
+
+
+@app.get("/health/live")
+def liveness():
+    return {"status": "ok"}
+
+
+@app.get("/health/ready")
+async def readiness():
+    checked_at, ready = getattr(app.state, "readiness", (0.0, False))
+    if monotonic() - checked_at > READINESS_CACHE_SECONDS:
+        ready = await check_db_ready()
+        app.state.readiness = (monotonic(), ready)
+
+    schema_state = getattr(app.state, "schema_state", None)
+    if not ready or schema_state == "stale":
+        return JSONResponse({"status": "unavailable", "database": ready, "schema": schema_state}, status_code=503)
+    return {"status": "ok", "database": ready, "schema": schema_state}
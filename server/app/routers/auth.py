@@ -5,7 +5,6 @@ import uuid
 import logging
 from datetime import timedelta
 from pathlib import Path
-from time import time
 from typing import List
 
 from fastapi import APIRouter, Cookie, Depends, File, Form, HTTPException, Request, UploadFile
@@ -15,18 +14,11 @@ from pydantic import BaseModel, EmailStr, Field, TypeAdapter, ValidationError
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from app.core.rate_limit import (
-    FORGOT_PASSWORD_MAX_ATTEMPTS,
-    FORGOT_PASSWORD_WINDOW_SECONDS,
-    MAX_ATTEMPTS,
-    WINDOW_SECONDS,
-    forgot_password_attempts,
-    login_attempts,
-)
+from app.core.rate_limit import FORGOT_PASSWORD_RATE_LIMIT, LOGIN_RATE_LIMIT, rate_limit
 from app.db.models import Device, DeviceOneTimePreKey, EncryptedKeyBackup, OneTimePreKey, PasswordResetToken, RefreshToken, User
 from app.db.session import SessionLocal
 from app.dependencies.auth import get_current_user
-from app.utils.avatar import build_avatar_props
+from app.utils.avatar import build_avatar_props, get_avatar_storage
 from app.utils.csrf import configure_templates, require_csrf
 from app.utils.jwt import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
@@ -40,6 +32,8 @@ from app.utils.jwt import (
 from app.utils.mail import is_mail_configured, send_password_reset_email
 from app.utils.security import hash_password, verify_password
 from app.utils.time import utc_now
+from app.utils.user_search import user_search_cache
+from app.utils.websocket_manager import manager
 
 
 email_adapter = TypeAdapter(EmailStr)
@@ -52,6 +46,10 @@ AVATAR_UPLOAD_DIR = Path(os.getenv("AVATAR_UPLOAD_DIR", "client/static/uploads/a
 MAX_AVATAR_SIZE_BYTES = int(os.getenv("MAX_AVATAR_SIZE_BYTES", 2 * 1024 * 1024))
 ALLOWED_AVATAR_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
 audit_logger = logging.getLogger("app.audit")
+login_rate_limit = rate_limit(LOGIN_RATE_LIMIT, detail="Забагато спроб. Спробуйте пізніше.")
+forgot_password_rate_limit = rate_limit(
+    FORGOT_PASSWORD_RATE_LIMIT, detail="Too many password reset attempts. Try again later."
+)
 DEFAULT_DEVICE_NAME = "Browser device"
 
 
@@ -87,6 +85,7 @@ def ensure_account_instance_id(user: User, db: Session) -> str:
     user.account_instance_id = uuid.uuid4().hex
     db.commit()
     db.refresh(user)
+    manager.invalidate_user(user.id)
     return user.account_instance_id
 
 
@@ -153,9 +152,8 @@ def save_avatar_file(upload: UploadFile) -> str:
     if len(content) > MAX_AVATAR_SIZE_BYTES:
         raise ValueError("Файл завеликий. Максимум 2 МБ")
 
-    AVATAR_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
     filename = f"{secrets.token_hex(16)}{extension}"
-    (AVATAR_UPLOAD_DIR / filename).write_bytes(content)
+    get_avatar_storage(AVATAR_UPLOAD_DIR).put_bytes(filename, content, content_type=upload.content_type)
     return filename
 
 
@@ -163,9 +161,7 @@ def remove_avatar_file(filename: str | None):
     if not filename:
         return
 
-    path = AVATAR_UPLOAD_DIR / filename
-    if path.exists():
-        path.unlink()
+    get_avatar_storage(AVATAR_UPLOAD_DIR).delete(filename)
 
 
 def set_auth_cookies(response, access_token: str, refresh_token: str):
@@ -235,6 +231,7 @@ def register(request: Request, email: str = Form(...), password: str = Form(...)
         db.flush()
         user.username = f"user{user.id}"
         db.commit()
+        user_search_cache.invalidate_user(username=user.username)
         audit_logger.info("register_success ip=%s user_id=%s email=%s", request.client.host, user.id, valid_email)
     except IntegrityError:
         db.rollback()
@@ -267,18 +264,13 @@ def login_page(request: Request):
     )
 
 
-@router.post("/forgot-password", response_class=HTMLResponse)
+@router.post(
+    "/forgot-password",
+    response_class=HTMLResponse,
+    dependencies=[Depends(forgot_password_rate_limit)],
+)
 def forgot_password_submit(request: Request, email: str = Form(...)):
     ip = request.client.host
-    now = time()
-    attempts = forgot_password_attempts[ip]
-    forgot_password_attempts[ip] = [
-        attempt for attempt in attempts if now - attempt < FORGOT_PASSWORD_WINDOW_SECONDS
-    ]
-    if len(forgot_password_attempts[ip]) >= FORGOT_PASSWORD_MAX_ATTEMPTS:
-        audit_logger.warning("forgot_password_rate_limited ip=%s", ip)
-        raise HTTPException(status_code=429, detail="Too many password reset attempts. Try again later.")
-    forgot_password_attempts[ip].append(now)
 
     try:
         valid_email = str(email_adapter.validate_python(email))
@@ -427,6 +419,7 @@ def reset_password_submit(
         token_record.used_at = utc_now()
         db.query(PasswordResetToken).filter(PasswordResetToken.user_id == user.id).delete()
         db.commit()
+        manager.invalidate_user(user.id)
         audit_logger.info("password_reset_success ip=%s user_id=%s email=%s", request.client.host, user.id, user.email)
     finally:
         db.close()
@@ -434,17 +427,9 @@ def reset_password_submit(
     return RedirectResponse("/login", status_code=303)
 
 
-@router.post("/login")
+@router.post("/login", dependencies=[Depends(login_rate_limit)])
 def login(request: Request, email: str = Form(...), password: str = Form(...)):
     ip = request.client.host
-    now = time()
-
-    attempts = login_attempts[ip]
-    login_attempts[ip] = [attempt for attempt in attempts if now - attempt < WINDOW_SECONDS]
-    if len(login_attempts[ip]) >= MAX_ATTEMPTS:
-        audit_logger.warning("login_rate_limited ip=%s", ip)
-        raise HTTPException(status_code=429, detail="Забагато спроб. Спробуйте пізніше.")
-    login_attempts[ip].append(now)
 
     try:
         valid_email = str(email_adapter.validate_python(email))
@@ -469,8 +454,8 @@ def login(request: Request, email: str = Form(...), password: str = Form(...)):
                 status_code=400,
             )
 
-        ensure_account_instance_id(user, db)
-        access_token = create_access_token({"sub": user.email})
+        account_instance_id = ensure_account_instance_id(user, db)
+        access_token = create_access_token({"sub": user.email, "aid": account_instance_id})
         refresh_token = create_refresh_token()
         hashed_refresh = hash_refresh_token(refresh_token)
 
@@ -522,7 +507,7 @@ def refresh_token_route(request: Request, refresh_token: str = Cookie(None)):
             audit_logger.warning("refresh_user_missing ip=%s user_id=%s", request.client.host, token_record.user_id)
             raise HTTPException(status_code=401, detail="Користувач не існує")
 
-        ensure_account_instance_id(user, db)
+        account_instance_id = ensure_account_instance_id(user, db)
         user_email = user.email
         token_record.expires_at = utc_now() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
         db.commit()
@@ -530,7 +515,7 @@ def refresh_token_route(request: Request, refresh_token: str = Cookie(None)):
     finally:
         db.close()
 
-    new_access_token = create_access_token({"sub": user_email})
+    new_access_token = create_access_token({"sub": user_email, "aid": account_instance_id})
     wants_json = (
         request.headers.get("x-requested-with") == "fetch"
         or "application/json" in request.headers.get("accept", "")
@@ -595,11 +580,17 @@ def update_profile(
             old_avatar_filename = user.avatar_filename
             user.avatar_filename = new_avatar_filename
             db.commit()
+            manager.invalidate_user(user.id)
+            user_search_cache.invalidate_user(user.id, username=user.username)
+            manager.invalidate_chat_lists(user_id=user.id)
             remove_avatar_file(old_avatar_filename)
             audit_logger.info("profile_avatar_updated user_id=%s", user.id)
             return RedirectResponse("/profile", status_code=303)
 
         db.commit()
+        manager.invalidate_user(user.id)
+        user_search_cache.invalidate_user(user.id, username=user.username)
+        manager.invalidate_chat_lists(user_id=user.id)
         audit_logger.info("profile_updated user_id=%s", user.id)
     except ValueError as exc:
         db.rollback()
@@ -662,6 +653,8 @@ def upload_x3dh_keys_legacy(data: PublicKeySchema, current_user: User = Depends(
             )
 
         db.commit()
+        manager.invalidate_user(user.id)
+        manager.invalidate_chat_lists(user_id=user.id)
         audit_logger.info("x3dh_keys_uploaded user_id=%s one_time_prekeys=%s", user.id, len(data.one_time_prekeys))
     except Exception as exc:
         db.rollback()
@@ -715,6 +708,8 @@ def upload_x3dh_keys(data: PublicKeySchema, current_user: User = Depends(get_cur
             )
 
         db.commit()
+        manager.invalidate_user(user.id)
+        manager.invalidate_chat_lists(user_id=user.id)
         audit_logger.info(
             "x3dh_keys_uploaded user_id=%s device_id=%s one_time_prekeys=%s",
             user.id,
@@ -783,6 +778,7 @@ def revoke_device(device_id: str, current_user: User = Depends(get_current_user)
         device.revoked_at = utc_now()
         db.query(DeviceOneTimePreKey).filter(DeviceOneTimePreKey.device_id == normalized_device_id).delete()
         db.commit()
+        manager.invalidate_user(current_user.id)
         audit_logger.info("device_revoked user_id=%s device_id=%s", current_user.id, normalized_device_id)
         return {"status": "ok"}
     finally:
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 import logging
@@ -6,28 +7,60 @@ from datetime import datetime, timedelta
 from pathlib import Path
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import and_, or_, select
+from sqlalchemy import and_, case, delete, func, insert, or_, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from app.db.models import Chat, ChatParticipant, DeletedMessage, Device, DeviceOneTimePreKey, Message, MessageDevicePayload, OneTimePreKey, User
+from app.db.models import AttachmentBlob, AttachmentUpload, Chat, ChatParticipant, DeletedMessage, Device, Message, MessageDevicePayload, OneTimePreKey, User
 from app.db.session import AsyncSessionLocal, SessionLocal
-from app.dependencies.auth import get_current_user
+from app.dependencies.auth import get_current_user, get_user_for_token_payload
 from app.routers.auth import ensure_account_instance_id
-from app.utils.avatar import build_avatar_props, build_chat_avatar_props
+from app.utils.admission import (
+    admission,
+    new_connection_frame_bucket,
+    rate_limited_frame,
+    retry_after_header,
+    upload_buckets,
+    user_frame_buckets,
+)
+from app.utils.attachment_download import attachment_access_cache, build_attachment_response
+from app.utils.avatar import build_avatar_props, build_chat_avatar_props, get_avatar_storage
+from app.utils.blob_store import (
+    ContentAddressedBlobStore,
+    acquire_attachment_refs,
+    forget_attachment_blobs,
+    register_attachment_blob,
+    release_attachment_refs,
+)
+from app.utils.chat_list_cache import chat_list_cache
+from app.utils.chat_writer import ChatWriteQueue
 from app.utils.csrf import configure_templates, require_csrf
 from app.utils.jwt import decode_access_token
+from app.utils.prekeys import claim_device_prekeys, claim_user_prekey, peek_device_prekeys
 from app.utils.time import utc_now
+from app.utils.user_search import USER_SEARCH_LIMIT, search_usernames
+from app.utils.resumable_uploads import ResumableUploadStore, UploadSessionError, UploadSessionNotFound
+from app.utils.storage import build_storage, purge_stale_spool_files
+from app.utils.uploads import UploadTooLargeError, receive_multipart_upload
+from app.utils.websocket_frame import Frame
 from app.utils.websocket_manager import manager
 
 
 router = APIRouter(dependencies=[Depends(require_csrf)])
 templates = configure_templates(Jinja2Templates(directory=os.getenv("TEMPLATES_DIR", "/code/client/templates")))
-USED_PREKEY_RETENTION_DAYS = 7
 MESSAGE_UPLOAD_DIR = Path(os.getenv("MESSAGE_UPLOAD_DIR", "client/static/uploads/messages"))
+MESSAGE_UPLOAD_URL_PREFIX = "/static/uploads/messages/"
 MAX_MESSAGE_UPLOAD_SIZE_BYTES = int(os.getenv("MAX_MESSAGE_UPLOAD_SIZE_BYTES", 50 * 1024 * 1024))
+# Partially uploaded attachments; kept outside the static directory so unfinished chunks are never served.
+UPLOAD_SESSION_DIR = Path(os.getenv("UPLOAD_SESSION_DIR", "uploads/sessions"))
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", 24 * 60 * 60))
+# Blobs are registered before the message that uses them is sent; this is how long that may take.
+ORPHAN_UPLOAD_GRACE_SECONDS = int(os.getenv("ORPHAN_UPLOAD_GRACE_SECONDS", 24 * 60 * 60))
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 200))
+MAX_HISTORY_PAGE_SIZE = int(os.getenv("MAX_HISTORY_PAGE_SIZE", 500))
 GROUP_AVATAR_UPLOAD_DIR = Path(os.getenv("AVATAR_UPLOAD_DIR", "client/static/uploads/avatars"))
 MAX_GROUP_AVATAR_SIZE_BYTES = int(os.getenv("MAX_AVATAR_SIZE_BYTES", 2 * 1024 * 1024))
 ALLOWED_GROUP_AVATAR_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
@@ -158,20 +191,49 @@ def set_chat_cleared_for_user(chat: Chat, user_id: int, cleared_at: datetime | N
         chat.user2_cleared_at = cleared_at
 
 
-def is_message_cleared_for_user(message: Message, chat: Chat, user_id: int, participant: ChatParticipant | None = None) -> bool:
-    cutoff = get_chat_clear_cutoff(chat, user_id, participant)
-    return bool(cutoff and message.created_at and message.created_at <= cutoff)
+RECEIPT_WATERMARK_COLUMNS = {
+    "delivered": (ChatParticipant.last_delivered_message_id, ChatParticipant.last_delivered_at),
+    "read": (ChatParticipant.last_read_message_id, ChatParticipant.last_read_at),
+}
 
 
-def get_delivery_status(message: Message) -> str:
-    if message.read_at:
-        return "read"
-    if message.delivered_at:
-        return "delivered"
-    return "sent"
+def get_message_receipt(message: Message, participants=()) -> tuple[str, datetime | None]:
+    # A message is read/delivered once any other participant's watermark covers it. The per-message
+    # columns are only written by older releases and still count for the rows they touched.
+    read_at = message.read_at
+    delivered = message.delivered_at is not None
+    for participant in participants:
+        if participant.user_id == message.sender_id:
+            continue
+        if (participant.last_read_message_id or 0) >= message.id:
+            if read_at is None or (participant.last_read_at and participant.last_read_at < read_at):
+                read_at = participant.last_read_at
+            delivered = True
+        elif (participant.last_delivered_message_id or 0) >= message.id:
+            delivered = True
+
+    if read_at:
+        return "read", read_at
+    if delivered:
+        return "delivered", None
+    return "sent", None
 
 
-def serialize_message(message: Message, sender_name: str, *, historical: bool) -> dict:
+def build_attachment_download_url(chat_id: int, attachment_url: str) -> str:
+    # Stored URLs stay the blob key; clients fetch through the route that checks chat membership.
+    if chat_id and attachment_url.startswith(MESSAGE_UPLOAD_URL_PREFIX):
+        return f"/messages/{chat_id}/attachments/{attachment_url[len(MESSAGE_UPLOAD_URL_PREFIX):]}"
+    return attachment_url
+
+
+def serialize_message(
+    message: Message,
+    sender_name: str,
+    *,
+    historical: bool,
+    receipt: tuple[str, datetime | None] | None = None,
+) -> dict:
+    delivery_status, read_at = receipt or get_message_receipt(message)
     attachment_meta = None
     if message.attachment_meta:
         try:
@@ -183,7 +245,7 @@ def serialize_message(message: Message, sender_name: str, *, historical: bool) -
     if message.attachment_kind and message.attachment_url:
         attachment_payload = {
             "kind": message.attachment_kind,
-            "url": message.attachment_url,
+            "url": build_attachment_download_url(message.chat_id, message.attachment_url),
             "name": message.attachment_name,
             "mime_type": message.attachment_mime_type,
             "size": message.attachment_size,
@@ -200,25 +262,34 @@ def serialize_message(message: Message, sender_name: str, *, historical: bool) -
         "content": message.content,
         "historical": historical,
         "created_at": message.created_at.isoformat() if message.created_at else None,
-        "read_at": message.read_at.isoformat() if message.read_at else None,
-        "delivery_status": get_delivery_status(message),
+        "read_at": read_at.isoformat() if read_at else None,
+        "delivery_status": delivery_status,
         "attachment": attachment_payload,
         "deleted_for_all": False,
     }
 
 
-def serialize_message_for_content(message: Message, sender_name: str, *, historical: bool, content: str) -> dict:
-    payload = serialize_message(message, sender_name, historical=historical)
+def serialize_message_for_content(
+    message: Message,
+    sender_name: str,
+    *,
+    historical: bool,
+    content: str,
+    receipt: tuple[str, datetime | None] | None = None,
+) -> dict:
+    payload = serialize_message(message, sender_name, historical=historical, receipt=receipt)
     payload["content"] = content
     return payload
 
 
-def build_message_status_event(message: Message) -> dict:
+def build_receipt_event(chat_id: int, user_id: int, delivery_status: str, up_to_message_id: int, at: datetime) -> dict:
     return {
-        "type": "message_status",
-        "message_id": message.id,
-        "read_at": message.read_at.isoformat() if message.read_at else None,
-        "delivery_status": get_delivery_status(message),
+        "type": "messages_status",
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "delivery_status": delivery_status,
+        "up_to_message_id": up_to_message_id,
+        "read_at": at.isoformat() if delivery_status == "read" else None,
     }
 
 
@@ -238,17 +309,6 @@ def build_chat_deleted_event(chat_id: int, *, delete_for_all: bool) -> dict:
     }
 
 
-def get_user_by_email_sync(email: str | None) -> User | None:
-    if not email:
-        return None
-
-    db: Session = SessionLocal()
-    try:
-        return db.query(User).filter(User.email == email).first()
-    finally:
-        db.close()
-
-
 def ensure_direct_chat_participants_sync(chat: Chat, db: Session):
     if chat.is_group:
         return
@@ -282,6 +342,19 @@ async def ensure_direct_chat_participants_async(chat: Chat, db: AsyncSession):
     await db.commit()
 
 
+async def ensure_user_direct_chat_participants_async(user_id: int, db: AsyncSession):
+    expected_participants = case((Chat.user2_id.is_(None), 1), else_=2)
+    result = await db.execute(
+        select(Chat)
+        .outerjoin(ChatParticipant, ChatParticipant.chat_id == Chat.id)
+        .where(Chat.is_group.is_(False), or_(Chat.user1_id == user_id, Chat.user2_id == user_id))
+        .group_by(Chat.id)
+        .having(func.count(ChatParticipant.id) < expected_participants)
+    )
+    for chat in result.scalars().all():
+        await ensure_direct_chat_participants_async(chat, db)
+
+
 def get_chat_participants_sync(chat_id: int, db: Session) -> list[ChatParticipant]:
     return db.query(ChatParticipant).filter(ChatParticipant.chat_id == chat_id).all()
 
@@ -345,242 +418,386 @@ def get_chat_display_item(chat: Chat, current_user_id: int, participants: list[C
     }
 
 
-async def resolve_reply_target_id(chat_id: int, raw_reply_to_message_id, db: AsyncSession) -> int | None:
-    if raw_reply_to_message_id in (None, "", 0, "0"):
-        return None
+async def resolve_reply_target_ids(chat_id: int, raw_reply_to_message_ids: list, db: AsyncSession) -> list:
+    """Validate reply targets of a message batch: an id, ``None`` or the ``HTTPException`` per entry."""
+    resolved: list = []
+    for raw_reply_to_message_id in raw_reply_to_message_ids:
+        if raw_reply_to_message_id in (None, "", 0, "0"):
+            resolved.append(None)
+            continue
+        try:
+            resolved.append(int(raw_reply_to_message_id))
+        except (TypeError, ValueError):
+            resolved.append(HTTPException(status_code=400, detail="Invalid reply target"))
 
-    try:
-        reply_to_message_id = int(raw_reply_to_message_id)
-    except (TypeError, ValueError):
-        raise HTTPException(status_code=400, detail="Invalid reply target") from None
+    requested_ids = {value for value in resolved if isinstance(value, int)}
+    if not requested_ids:
+        return resolved
 
     result = await db.execute(
-        select(Message).where(
-            Message.id == reply_to_message_id,
+        select(Message.id).where(
+            Message.id.in_(requested_ids),
             Message.chat_id == chat_id,
             Message.deleted_for_all_at.is_(None),
         )
     )
-    reply_message = result.scalar_one_or_none()
-    if not reply_message:
-        raise HTTPException(status_code=400, detail="Reply target not found")
-
-    return reply_to_message_id
-
-
-def get_chat_for_user_sync(chat_id: int, user_id: int) -> Chat | None:
-    db: Session = SessionLocal()
-    try:
-        chat = db.query(Chat).filter(Chat.id == chat_id).first()
-        if not chat:
-            return None
-        ensure_direct_chat_participants_sync(chat, db)
-        participant = get_chat_participant_sync(chat.id, user_id, db)
-        if not participant and user_id not in [chat.user1_id, chat.user2_id]:
-            return None
-        return chat
-    finally:
-        db.close()
-
-
-def chat_has_visible_messages_sync(db: Session, chat: Chat, user_id: int, participant: ChatParticipant | None = None) -> bool:
-    query = db.query(Message.id).filter(Message.chat_id == chat.id)
-    cutoff = get_chat_clear_cutoff(chat, user_id, participant)
-    if cutoff is not None:
-        query = query.filter(Message.created_at > cutoff)
-    return query.first() is not None
+    existing_ids = set(result.scalars().all())
+    return [
+        HTTPException(status_code=400, detail="Reply target not found")
+        if isinstance(value, int) and value not in existing_ids
+        else value
+        for value in resolved
+    ]
 
 
-async def notify_message_status(db: AsyncSession, messages: list[Message]):
-    if not messages:
-        return
+async def get_chat_for_user_async(chat_id: int, user_id: int, db: AsyncSession) -> Chat | None:
+    result = await db.execute(select(Chat).where(Chat.id == chat_id))
+    chat = result.scalar_one_or_none()
+    if not chat:
+        return None
+    await ensure_direct_chat_participants_async(chat, db)
+    participant = await get_chat_participant_async(chat.id, user_id, db)
+    if not participant and user_id not in [chat.user1_id, chat.user2_id]:
+        return None
+    return chat
+
+
+def get_chats_with_visible_messages_sync(db: Session, user_id: int, chat_ids: list[int]) -> set[int]:
+    if not chat_ids:
+        return set()
+    rows = (
+        db.query(Message.chat_id)
+        .join(ChatParticipant, and_(ChatParticipant.chat_id == Message.chat_id, ChatParticipant.user_id == user_id))
+        .filter(
+            Message.chat_id.in_(chat_ids),
+            or_(ChatParticipant.cleared_at.is_(None), Message.created_at > ChatParticipant.cleared_at),
+        )
+        .distinct()
+        .all()
+    )
+    return {chat_id for (chat_id,) in rows}
 
-    for message in messages:
-        result = await db.execute(select(Chat).where(Chat.id == message.chat_id))
-        chat = result.scalar_one_or_none()
-        if not chat:
-            continue
 
-        await manager.broadcast_chat(message.chat_id, build_message_status_event(message))
+async def notify_receipt_events(events: list[dict]):
+    for event in events:
+        await manager.broadcast_chat(event["chat_id"], event)
 
 
-async def mark_messages_delivered_for_user(user_id: int, db: AsyncSession) -> list[Message]:
+async def advance_receipt_watermarks(
+    db: AsyncSession,
+    chat_id: int,
+    user_ids,
+    delivery_status: str,
+    up_to_message_id,
+    at: datetime,
+) -> list[tuple[int, int]]:
+    """Move the watermarks of ``user_ids`` forward to ``up_to_message_id``, never backwards.
+
+    Returns ``(user_id, watermark)`` for the rows that actually moved.
+    """
+    message_id_column, at_column = RECEIPT_WATERMARK_COLUMNS[delivery_status]
     result = await db.execute(
-        select(Message, Chat)
-        .join(Chat, Chat.id == Message.chat_id)
+        update(ChatParticipant)
         .where(
-            Message.sender_id != user_id,
-            Message.delivered_at.is_(None),
-            or_(Chat.user1_id == user_id, Chat.user2_id == user_id),
+            ChatParticipant.chat_id == chat_id,
+            ChatParticipant.user_id.in_(list(user_ids)),
+            func.coalesce(message_id_column, 0) < up_to_message_id,
         )
+        .values({message_id_column: up_to_message_id, at_column: at})
+        .returning(ChatParticipant.user_id, message_id_column)
+        .execution_options(synchronize_session=False)
     )
+    return [tuple(row) for row in result.all()]
 
-    updated_messages = []
-    now = utc_now()
-    for message, _chat in result.all():
-        message.delivered_at = now
-        updated_messages.append(message)
-
-    if updated_messages:
-        await db.commit()
-        for message in updated_messages:
-            await db.refresh(message)
-
-    return updated_messages
 
+async def mark_messages_delivered_for_user(user_id: int, db: AsyncSession) -> list[dict]:
+    await ensure_user_direct_chat_participants_async(user_id, db)
 
-async def mark_chat_messages_read(chat_id: int, user_id: int, db: AsyncSession) -> list[Message]:
+    # Every chat the user belongs to, direct or group, in one statement; only watermarks that move come back.
+    latest_incoming_message_id = (
+        select(func.max(Message.id))
+        .where(Message.chat_id == ChatParticipant.chat_id, Message.sender_id != user_id)
+        .correlate(ChatParticipant)
+        .scalar_subquery()
+    )
+    now = utc_now()
     result = await db.execute(
-        select(Message)
+        update(ChatParticipant)
         .where(
-            Message.chat_id == chat_id,
-            Message.sender_id != user_id,
-            Message.read_at.is_(None),
+            ChatParticipant.user_id == user_id,
+            func.coalesce(ChatParticipant.last_delivered_message_id, 0) < latest_incoming_message_id,
+            func.coalesce(ChatParticipant.last_read_message_id, 0) < latest_incoming_message_id,
         )
-        .order_by(Message.created_at)
+        .values(last_delivered_message_id=latest_incoming_message_id, last_delivered_at=now)
+        .returning(ChatParticipant.chat_id, ChatParticipant.last_delivered_message_id)
+        .execution_options(synchronize_session=False)
     )
-    messages = result.scalars().all()
-
-    if not messages:
+    moved = result.all()
+    if not moved:
         return []
 
-    now = utc_now()
-    for message in messages:
-        if message.delivered_at is None:
-            message.delivered_at = now
-        message.read_at = now
-
     await db.commit()
-    for message in messages:
-        await db.refresh(message)
+    return [
+        build_receipt_event(chat_id, user_id, "delivered", up_to_message_id, now)
+        for chat_id, up_to_message_id in moved
+    ]
 
-    return messages
 
+async def mark_chat_messages_read(chat_id: int, user_id: int, db: AsyncSession) -> dict | None:
+    # One statement regardless of how many messages are unread: only the reader's watermark moves.
+    latest_incoming_message_id = (
+        select(func.max(Message.id))
+        .where(Message.chat_id == chat_id, Message.sender_id != user_id)
+        .scalar_subquery()
+    )
+    now = utc_now()
+    moved = await advance_receipt_watermarks(db, chat_id, [user_id], "read", latest_incoming_message_id, now)
+    if not moved:
+        return None
 
-def save_message_attachment(upload: UploadFile, *, encrypted: bool = False) -> dict:
-    if encrypted:
-        content = upload.file.read(MAX_MESSAGE_UPLOAD_SIZE_BYTES + 1)
-        if len(content) > MAX_MESSAGE_UPLOAD_SIZE_BYTES:
-            raise ValueError("Attachment is too large")
+    await db.commit()
+    return build_receipt_event(chat_id, user_id, "read", moved[0][1], now)
 
-        MESSAGE_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-        filename = f"{secrets.token_hex(16)}.bin"
-        (MESSAGE_UPLOAD_DIR / filename).write_bytes(content)
 
+def resolve_message_attachment_details(filename: str | None, content_type: str | None, *, encrypted: bool) -> dict:
+    if encrypted:
+        # Encrypted media hides the real name and type from the server.
         return {
+            "extension": ".bin",
             "kind": "encrypted",
-            "url": f"/static/uploads/messages/{filename}",
             "name": "encrypted-media.bin",
             "mime_type": "application/octet-stream",
-            "size": len(content),
         }
 
-    extension = Path(upload.filename or "").suffix.lower()
+    extension = Path(filename or "").suffix.lower()
     attachment_kind = ALLOWED_MESSAGE_ATTACHMENT_EXTENSIONS.get(extension)
     if not attachment_kind:
         raise ValueError("Unsupported attachment type")
+    return {
+        "extension": extension,
+        "kind": attachment_kind,
+        "name": filename,
+        "mime_type": content_type or "application/octet-stream",
+    }
 
-    content = upload.file.read(MAX_MESSAGE_UPLOAD_SIZE_BYTES + 1)
-    if len(content) > MAX_MESSAGE_UPLOAD_SIZE_BYTES:
-        raise ValueError("Attachment is too large")
-
-    MESSAGE_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-    filename = f"{secrets.token_hex(16)}{extension}"
-    (MESSAGE_UPLOAD_DIR / filename).write_bytes(content)
 
+def build_message_attachment(url: str, details: dict, *, size: int, sha256: str) -> dict:
     return {
-        "kind": attachment_kind,
-        "url": f"/static/uploads/messages/{filename}",
-        "name": upload.filename or filename,
-        "mime_type": upload.content_type or "application/octet-stream",
-        "size": len(content),
+        "kind": details["kind"],
+        "url": url,
+        "name": details["name"],
+        "mime_type": details["mime_type"],
+        "size": size,
+        "sha256": sha256,
     }
 
 
-def remove_message_attachment_file(attachment_url: str | None):
-    if not attachment_url:
-        return
+def get_message_blob_store() -> ContentAddressedBlobStore:
+    storage = build_storage("messages", MESSAGE_UPLOAD_DIR, MESSAGE_UPLOAD_URL_PREFIX)
+    return ContentAddressedBlobStore(storage, MESSAGE_UPLOAD_URL_PREFIX)
 
-    prefix = "/static/uploads/messages/"
-    if not str(attachment_url).startswith(prefix):
-        return
 
-    filename = Path(str(attachment_url)[len(prefix):]).name
-    if not filename:
-        return
+async def store_message_blob(incoming: Path, details: dict, *, size: int, sha256: str, uploaded_by: int) -> dict:
+    """Store a fully received upload at its content address; identical bytes share one object."""
+    store = get_message_blob_store()
+    url = store.url_for(store.relative_name(sha256, details["extension"]))
+    try:
+        # The row goes in first so a blob file never exists untracked; unreferenced rows mark it for cleanup.
+        async with AsyncSessionLocal() as db:
+            await register_attachment_blob(db, url, sha256, size, uploaded_by=uploaded_by)
+            await db.commit()
+        await run_in_threadpool(
+            store.adopt, incoming, sha256, details["extension"], content_type=details["mime_type"]
+        )
+    except BaseException:
+        incoming.unlink(missing_ok=True)
+        raise
+    return build_message_attachment(url, details, size=size, sha256=sha256)
 
-    path = MESSAGE_UPLOAD_DIR / filename
-    if path.exists():
-        path.unlink()
 
+async def receive_message_attachment(request: Request, user_id: int) -> tuple[int, dict]:
+    """Receive a ``/messages/upload`` body and store it, returning the chat id and the attachment.
+
+    The chat and the file type are checked from the fields and part headers that precede the
+    file, so a refused upload is answered before its bytes are received.
+    """
+    incoming = get_message_blob_store().incoming_path("")
+    upload = {}
+
+    async def check_upload(fields: dict[str, str], filename: str | None, content_type: str | None):
+        try:
+            chat_id = int(fields["chat_id"])
+        except (KeyError, ValueError):
+            raise HTTPException(status_code=400, detail="chat_id must be sent before the file") from None
+        roster = await manager.chat_rosters.get(chat_id)
+        if roster is None or user_id not in roster:
+            raise HTTPException(status_code=403, detail="Access denied")
+        encrypted = fields.get("encrypted", "").strip().lower() in {"1", "true", "yes", "on"}
+        upload["chat_id"] = chat_id
+        upload["details"] = resolve_message_attachment_details(filename, content_type, encrypted=encrypted)
 
-@router.get("/messages", response_class=HTMLResponse)
-def messages_page(request: Request, current_user: User = Depends(get_current_user)):
-    db: Session = SessionLocal()
     try:
-        all_chats = db.query(Chat).all()
-        for chat in all_chats:
-            ensure_direct_chat_participants_sync(chat, db)
-
-        participant_rows = (
-            db.query(ChatParticipant)
-            .filter(ChatParticipant.user_id == current_user.id)
-            .all()
+        received = await receive_multipart_upload(
+            request,
+            incoming,
+            max_bytes=MAX_MESSAGE_UPLOAD_SIZE_BYTES,
+            before_file=check_upload,
         )
-        participant_by_chat_id = {row.chat_id: row for row in participant_rows}
-        chat_ids = [row.chat_id for row in participant_rows]
-        chats = db.query(Chat).filter(Chat.id.in_(chat_ids)).all() if chat_ids else []
-
-        chat_id = request.query_params.get("chat_id")
-        other_identity_key = None
-        other_identity_signing_key = None
-        selected_chat_user = None
-        chat_items = []
-        users_by_id = {
-            user.id: user
-            for user in db.query(User).all()
-        }
+    except UploadTooLargeError:
+        raise ValueError("Attachment is too large") from None
+    attachment = await store_message_blob(
+        incoming, upload["details"], size=received.size, sha256=received.sha256, uploaded_by=user_id
+    )
+    return upload["chat_id"], attachment
 
-        if chat_id:
-            chat = db.query(Chat).filter(Chat.id == int(chat_id)).first()
-            if chat and int(chat_id) in participant_by_chat_id:
-                selected_participants = get_chat_participants_sync(chat.id, db)
-                if chat.is_group:
-                    selected_chat_user = build_group_payload(chat, selected_participants, users_by_id, current_user.id)
-                else:
-                    other_user_id = get_direct_other_user_id(chat, current_user.id)
-                    selected_user_model = users_by_id.get(other_user_id) if other_user_id else None
-                    if selected_user_model:
-                        selected_chat_user = {
-                            "username": selected_user_model.username,
-                            "is_group": False,
-                            **build_avatar_props(selected_user_model),
-                        }
-                        other_identity_key = selected_user_model.identity_key
-                        other_identity_signing_key = selected_user_model.identity_signing_key
-
-        for chat in chats:
-            participant = participant_by_chat_id.get(chat.id)
-            if not participant:
-                continue
-            if is_chat_hidden_for_user(chat, current_user.id, participant) and not chat_has_visible_messages_sync(db, chat, current_user.id, participant):
-                continue
 
-            chat_participants = get_chat_participants_sync(chat.id, db)
-            chat_item = get_chat_display_item(chat, current_user.id, chat_participants, users_by_id)
-            if chat_item:
-                chat_items.append(chat_item)
+def get_upload_session_store() -> ResumableUploadStore:
+    return ResumableUploadStore(UPLOAD_SESSION_DIR)
+
+
+async def purge_orphan_uploads(batch_size: int, max_batches: int) -> int:
+    """Maintenance job: unreferenced blobs past the grace period, stale upload sessions and spool files."""
+    store = get_message_blob_store()
+    cutoff = utc_now() - timedelta(seconds=ORPHAN_UPLOAD_GRACE_SECONDS)
+    removed = 0
+    for _ in range(max(1, max_batches)):
+        batch = (
+            select(AttachmentBlob.url)
+            .where(AttachmentBlob.ref_count <= 0, AttachmentBlob.created_at < cutoff)
+            .limit(batch_size)
+        )
+        async with AsyncSessionLocal() as db:
+            # ref_count is checked again by the DELETE itself, so a blob that was just attached survives.
+            result = await db.execute(
+                delete(AttachmentBlob)
+                .where(AttachmentBlob.url.in_(batch.scalar_subquery()), AttachmentBlob.ref_count <= 0)
+                .returning(AttachmentBlob.url)
+                .execution_options(synchronize_session=False)
+            )
+            urls = list(result.scalars().all())
+            await forget_attachment_blobs(db, urls)
+            await db.commit()
+        await run_in_threadpool(store.remove, urls)
+        removed += len(urls)
+        if len(urls) < batch_size:
+            break
+
+    file_limit = batch_size * max(1, max_batches)
+    removed += await run_in_threadpool(
+        get_upload_session_store().purge_stale, UPLOAD_SESSION_TTL_SECONDS, limit=file_limit
+    )
+    removed += await run_in_threadpool(
+        purge_stale_spool_files, store.storage.spool_dir, ORPHAN_UPLOAD_GRACE_SECONDS, limit=file_limit
+    )
+    return removed
+
+
+def ensure_user_direct_chat_participants_sync(user_id: int, db: Session):
+    expected_participants = case((Chat.user2_id.is_(None), 1), else_=2)
+    legacy_chats = (
+        db.query(Chat)
+        .outerjoin(ChatParticipant, ChatParticipant.chat_id == Chat.id)
+        .filter(Chat.is_group.is_(False), or_(Chat.user1_id == user_id, Chat.user2_id == user_id))
+        .group_by(Chat.id)
+        .having(func.count(ChatParticipant.id) < expected_participants)
+        .all()
+    )
+    for chat in legacy_chats:
+        ensure_direct_chat_participants_sync(chat, db)
+
 
-        chat_items.sort(key=lambda item: item["id"])
+def load_chat_list_sync(user_id: int, db: Session) -> tuple[dict, set[int], set[int]]:
+    ensure_user_direct_chat_participants_sync(user_id, db)
+
+    rows = (
+        db.query(Chat, ChatParticipant)
+        .join(ChatParticipant, and_(ChatParticipant.chat_id == Chat.id, ChatParticipant.user_id == user_id))
+        .order_by(Chat.id)
+        .all()
+    )
+    chat_ids = [chat.id for chat, _participant in rows]
+    visible_hidden_chat_ids = get_chats_with_visible_messages_sync(
+        db,
+        user_id,
+        [chat.id for chat, participant in rows if is_chat_hidden_for_user(chat, user_id, participant)],
+    )
+
+    participants_by_chat_id: dict[int, list[ChatParticipant]] = {chat_id: [] for chat_id in chat_ids}
+    if chat_ids:
+        for participant in db.query(ChatParticipant).filter(ChatParticipant.chat_id.in_(chat_ids)).all():
+            participants_by_chat_id[participant.chat_id].append(participant)
+
+    referenced_user_ids = {
+        participant.user_id
+        for participants in participants_by_chat_id.values()
+        for participant in participants
+    }
+    referenced_user_ids.update(
+        other_user_id
+        for chat, _participant in rows
+        if not chat.is_group and (other_user_id := get_direct_other_user_id(chat, user_id))
+    )
+    users_by_id = {
+        user.id: user
+        for user in (db.query(User).filter(User.id.in_(referenced_user_ids)).all() if referenced_user_ids else [])
+    }
+
+    chat_items = []
+    selectable = {}
+    for chat, participant in rows:
+        chat_participants = participants_by_chat_id[chat.id]
+        if chat.is_group:
+            selectable[chat.id] = (build_group_payload(chat, chat_participants, users_by_id, user_id), None, None)
+        else:
+            other_user_id = get_direct_other_user_id(chat, user_id)
+            other_user = users_by_id.get(other_user_id) if other_user_id else None
+            if other_user:
+                selectable[chat.id] = (
+                    {"username": other_user.username, "is_group": False, **build_avatar_props(other_user)},
+                    other_user.identity_key,
+                    other_user.identity_signing_key,
+                )
+            else:
+                selectable[chat.id] = (None, None, None)
+
+        if is_chat_hidden_for_user(chat, user_id, participant) and chat.id not in visible_hidden_chat_ids:
+            continue
+        chat_item = get_chat_display_item(chat, user_id, chat_participants, users_by_id)
+        if chat_item:
+            chat_items.append(chat_item)
+
+    return {"chats": chat_items, "selectable": selectable}, set(chat_ids), referenced_user_ids
+
+
+def get_chat_list_sync(user_id: int) -> dict:
+    snapshot = chat_list_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+
+    db: Session = SessionLocal()
+    try:
+        snapshot, chat_ids, user_ids = load_chat_list_sync(user_id, db)
     finally:
         db.close()
+    chat_list_cache.set(user_id, snapshot, chat_ids=chat_ids, user_ids=user_ids)
+    return snapshot
+
+
+@router.get("/messages", response_class=HTMLResponse)
+def messages_page(request: Request, current_user: User = Depends(get_current_user)):
+    chat_list = get_chat_list_sync(current_user.id)
+
+    chat_id = request.query_params.get("chat_id")
+    selected_chat_user, other_identity_key, other_identity_signing_key = (
+        chat_list["selectable"].get(int(chat_id), (None, None, None)) if chat_id else (None, None, None)
+    )
 
     return templates.TemplateResponse(
         request,
         "messages.html",
         {
             "request": request,
-            "chats": chat_items,
+            "chats": chat_list["chats"],
             "current_user_id": current_user.id,
             "other_identity_key": other_identity_key,
             "other_identity_signing_key": other_identity_signing_key,
@@ -594,14 +811,11 @@ def messages_page(request: Request, current_user: User = Depends(get_current_use
 def search_users(query: str, current_user: User = Depends(get_current_user)):
     db: Session = SessionLocal()
     try:
-        users = db.query(User).filter(
-            User.username.ilike(f"%{query}%"),
-            User.id != current_user.id,
-        ).limit(10).all()
+        results = search_usernames(db, query)
     finally:
         db.close()
 
-    return [{"id": user.id, "username": user.username, **build_avatar_props(user)} for user in users]
+    return [result for result in results if result["id"] != current_user.id][:USER_SEARCH_LIMIT]
 
 
 def parse_group_usernames(raw_value: str | None) -> list[str]:
@@ -625,9 +839,8 @@ def save_group_avatar_file(upload: UploadFile) -> str:
     if len(content) > MAX_GROUP_AVATAR_SIZE_BYTES:
         raise ValueError("Avatar file is too large.")
 
-    GROUP_AVATAR_UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
     filename = f"{secrets.token_hex(16)}{extension}"
-    (GROUP_AVATAR_UPLOAD_DIR / filename).write_bytes(content)
+    get_avatar_storage(GROUP_AVATAR_UPLOAD_DIR).put_bytes(filename, content, content_type=upload.content_type)
     return filename
 
 
@@ -635,49 +848,207 @@ def remove_group_avatar_file(filename: str | None):
     if not filename:
         return
 
-    path = GROUP_AVATAR_UPLOAD_DIR / filename
-    if path.exists():
-        path.unlink()
+    get_avatar_storage(GROUP_AVATAR_UPLOAD_DIR).delete(filename)
+
+
+def refuse_upload(refused: tuple[str, float], user_id: int):
+    reason, retry_after = refused
+    audit_logger.warning("message_upload_%s user_id=%s", reason, user_id)
+    if reason == "rate_limited":
+        raise HTTPException(
+            status_code=429,
+            detail="Too many uploads. Try again later.",
+            headers=retry_after_header(retry_after),
+        )
+    raise HTTPException(
+        status_code=503,
+        detail="Server is busy. Try again shortly.",
+        headers=retry_after_header(retry_after),
+    )
+
+
+# Both run before the body is received, as long as the route takes the raw Request rather
+# than Form/File parameters, which FastAPI fills in by reading the whole body first.
+async def admit_upload(current_user: User = Depends(get_current_user)):
+    refused = admission.admit("uploads", [upload_buckets.get(current_user.id)])
+    if refused is not None:
+        refuse_upload(refused, current_user.id)
+
+
+async def admit_upload_chunk(current_user: User = Depends(get_current_user)):
+    # A chunk is part of an upload already charged when its session was created; only shed load.
+    refused = admission.check()
+    if refused is not None:
+        refuse_upload(refused, current_user.id)
 
 
-@router.post("/messages/upload")
-async def upload_message_attachment(
+@router.post("/messages/upload", dependencies=[Depends(admit_upload)])
+async def upload_message_attachment(request: Request, current_user: User = Depends(get_current_user)):
+    try:
+        chat_id, attachment = await receive_message_attachment(request, current_user.id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except OSError as exc:
+        audit_logger.exception(
+            "message_attachment_storage_failed user_id=%s",
+            current_user.id,
+        )
+        raise HTTPException(status_code=500, detail="Could not save attachment on server.") from exc
+
+    audit_logger.info(
+        "message_attachment_uploaded chat_id=%s user_id=%s kind=%s size=%s",
+        chat_id,
+        current_user.id,
+        attachment["kind"],
+        attachment["size"],
+    )
+    return JSONResponse({"status": "ok", "attachment": attachment})
+
+
+@router.post("/messages/uploads", dependencies=[Depends(admit_upload)])
+async def create_resumable_upload(
     chat_id: int = Form(...),
-    encrypted: bool = Form(False),
-    file: UploadFile = File(...),
+    size: int = Form(...),
+    encrypted: bool = Form(True),
+    filename: str | None = Form(None),
+    mime_type: str | None = Form(None),
+    sha256: str | None = Form(None),
     current_user: User = Depends(get_current_user),
 ):
-    db: Session = SessionLocal()
+    roster = await manager.chat_rosters.get(chat_id)
+    if roster is None or current_user.id not in roster:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    store = get_upload_session_store()
     try:
-        chat = db.query(Chat).filter(Chat.id == chat_id).first()
-        if not chat:
-            raise HTTPException(status_code=403, detail="Access denied")
-        ensure_direct_chat_participants_sync(chat, db)
-        if not get_chat_participant_sync(chat.id, current_user.id, db):
-            raise HTTPException(status_code=403, detail="Access denied")
+        details = resolve_message_attachment_details(filename, mime_type, encrypted=encrypted)
+        session = await run_in_threadpool(
+            store.create,
+            user_id=current_user.id,
+            chat_id=chat_id,
+            size=size,
+            max_size=MAX_MESSAGE_UPLOAD_SIZE_BYTES,
+            details=details,
+            sha256=sha256.lower() if sha256 else None,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    audit_logger.info(
+        "message_upload_session_created chat_id=%s user_id=%s upload_id=%s size=%s",
+        chat_id,
+        current_user.id,
+        session["upload_id"],
+        size,
+    )
+    return JSONResponse({"status": "ok", **store.describe(session)})
 
-        try:
-            attachment = save_message_attachment(file, encrypted=encrypted)
-        except ValueError as exc:
-            raise HTTPException(status_code=400, detail=str(exc)) from exc
-        except OSError as exc:
-            audit_logger.exception(
-                "message_attachment_storage_failed chat_id=%s user_id=%s",
-                chat_id,
-                current_user.id,
-            )
-            raise HTTPException(status_code=500, detail="Could not save attachment on server.") from exc
 
-        audit_logger.info(
-            "message_attachment_uploaded chat_id=%s user_id=%s kind=%s size=%s",
-            chat_id,
+async def load_upload_session(store: ResumableUploadStore, upload_id: str, user_id: int) -> dict:
+    try:
+        return await run_in_threadpool(store.load, upload_id, user_id)
+    except UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found") from None
+
+
+@router.get("/messages/uploads/{upload_id}")
+async def get_resumable_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    store = get_upload_session_store()
+    session = await load_upload_session(store, upload_id, current_user.id)
+    return JSONResponse({"status": "ok", **await run_in_threadpool(store.describe, session)})
+
+
+@router.put("/messages/uploads/{upload_id}/chunks/{index}", dependencies=[Depends(admit_upload_chunk)])
+async def put_resumable_upload_chunk(
+    request: Request,
+    upload_id: str,
+    index: int,
+    offset: int | None = None,
+    current_user: User = Depends(get_current_user),
+):
+    store = get_upload_session_store()
+    session = await load_upload_session(store, upload_id, current_user.id)
+    try:
+        written = await store.write_chunk(session, index, request.stream(), offset=offset)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return JSONResponse({"status": "ok", "index": index, "size": written})
+
+
+@router.post("/messages/uploads/{upload_id}/finalize")
+async def finalize_resumable_upload(upload_id: str, current_user: User = Depends(get_current_user)):
+    store = get_upload_session_store()
+    session = await load_upload_session(store, upload_id, current_user.id)
+    roster = await manager.chat_rosters.get(session["chat_id"])
+    if roster is None or current_user.id not in roster:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    details = session["details"]
+    incoming = get_message_blob_store().incoming_path(details["extension"])
+    try:
+        size, sha256 = await run_in_threadpool(store.assemble, session, incoming)
+        attachment = await store_message_blob(
+            incoming, details, size=size, sha256=sha256, uploaded_by=current_user.id
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except OSError as exc:
+        audit_logger.exception(
+            "message_attachment_storage_failed chat_id=%s user_id=%s upload_id=%s",
+            session["chat_id"],
             current_user.id,
-            attachment["kind"],
-            attachment["size"],
+            upload_id,
         )
-        return JSONResponse({"status": "ok", "attachment": attachment})
-    finally:
-        db.close()
+        raise HTTPException(status_code=500, detail="Could not save attachment on server.") from exc
+    await run_in_threadpool(store.discard, session)
+
+    audit_logger.info(
+        "message_attachment_uploaded chat_id=%s user_id=%s kind=%s size=%s upload_id=%s",
+        session["chat_id"],
+        current_user.id,
+        attachment["kind"],
+        attachment["size"],
+        upload_id,
+    )
+    return JSONResponse({"status": "ok", "attachment": attachment})
+
+
+@router.api_route("/messages/{chat_id:int}/attachments/{blob_path:path}", methods=["GET", "HEAD"])
+async def download_message_attachment(
+    request: Request,
+    chat_id: int,
+    blob_path: str,
+    current_user: User = Depends(get_current_user),
+):
+    url = f"{MESSAGE_UPLOAD_URL_PREFIX}{blob_path}"
+    store = get_message_blob_store()
+    key = store.key_for_url(url)
+    if key is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+    roster = await manager.chat_rosters.get(chat_id)
+    if roster is None or current_user.id not in roster:
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    # Range requests while seeking repeat this check many times per file.
+    if not attachment_access_cache.contains(chat_id, url):
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Message.id).where(Message.chat_id == chat_id, Message.attachment_url == url).limit(1)
+            )
+            if result.first() is None:
+                raise HTTPException(status_code=404, detail="Attachment not found")
+        attachment_access_cache.add(chat_id, url)
+
+    # Object storage serves the bytes, ranges and validators itself from a short-lived signed URL.
+    redirect_url = store.storage.download_url(key)
+    if redirect_url:
+        return RedirectResponse(redirect_url, status_code=302, headers={"Cache-Control": "private, no-store"})
+
+    response = await build_attachment_response(request, store.storage.local_path(key), key)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return response
 
 
 @router.post("/messages/start")
@@ -711,6 +1082,8 @@ async def start_chat_json(username: str = Form(...), current_user: User = Depend
                 ChatParticipant(chat_id=chat.id, user_id=u2),
             ])
             await db.commit()
+            await manager.invalidate_contacts([u1, u2])
+            manager.invalidate_chat_lists(owner_ids=[u1, u2])
             audit_logger.info("chat_created chat_id=%s user1_id=%s user2_id=%s", chat.id, u1, u2)
         else:
             await ensure_direct_chat_participants_async(chat, db)
@@ -722,6 +1095,7 @@ async def start_chat_json(username: str = Form(...), current_user: User = Depend
             )
             set_chat_hidden_for_user(chat, current_user.id, False, current_participant)
             await db.commit()
+            manager.invalidate_chat_lists(chat_id=chat.id)
             audit_logger.info(
                 "chat_reused chat_id=%s requester_id=%s other_user_id=%s session_reset=%s",
                 chat.id,
@@ -739,14 +1113,11 @@ async def start_chat_json(username: str = Form(...), current_user: User = Depend
             "prekey_bundle": await (
                 issue_prekey_bundle(other_user.id, db) if (is_new_chat or session_reset) else peek_prekey_bundle(other_user.id, db)
             ),
-            "device_bundles": [
-                await (
-                    issue_device_prekey_bundle(device, db)
-                    if (is_new_chat or session_reset)
-                    else peek_device_prekey_bundle(device, db)
-                )
-                for device in active_devices
-            ],
+            "device_bundles": await (
+                issue_device_prekey_bundles(active_devices, db)
+                if (is_new_chat or session_reset)
+                else peek_device_prekey_bundles(active_devices, db)
+            ),
             "username": other_user.username,
             **build_avatar_props(other_user),
         }
@@ -779,11 +1150,11 @@ async def start_group_chat_json(
         if len(users_by_username) != len(unique_usernames):
             return {"status": "error", "message": "Some selected users were not found."}
 
+        devices_by_user_id = await get_active_devices_for_users([user.id for user in users], db)
         for user in users:
             if not has_complete_x3dh_bundle(user):
                 return {"status": "error", "message": f"User {user.username} has not initialized X3DH keys yet."}
-            active_devices = await get_active_devices_for_user(user.id, db)
-            if not active_devices:
+            if not devices_by_user_id[user.id]:
                 return {"status": "error", "message": f"User {user.username} has no active devices."}
 
         chat = Chat(
@@ -798,20 +1169,23 @@ async def start_group_chat_json(
         await db.commit()
         await db.refresh(chat)
 
-        participants = [ChatParticipant(chat_id=chat.id, user_id=current_user.id)]
-        participants.extend(ChatParticipant(chat_id=chat.id, user_id=user.id) for user in users)
-        db.add_all(participants)
+        member_ids = [current_user.id, *(user.id for user in users)]
+        # One executemany rather than a flushed INSERT per member.
+        await db.execute(insert(ChatParticipant), [{"chat_id": chat.id, "user_id": user_id} for user_id in member_ids])
         await db.commit()
+        await manager.invalidate_chat_roster(chat.id)
+        await manager.invalidate_contacts(member_ids, chat_id=chat.id)
+        manager.invalidate_chat_lists(owner_ids=member_ids)
 
         for user in users:
             await manager.notify_user(user.id, {"type": "new_chat", "chat_id": chat.id})
         await manager.notify_user(current_user.id, {"type": "new_chat", "chat_id": chat.id})
 
+        bundles_by_user_id = await build_device_bundles_by_user(devices_by_user_id, db, issue_prekeys=True)
         flat_device_bundles = []
         participant_payloads = []
         for user in users:
-            devices = await get_active_devices_for_user(user.id, db)
-            bundles = [await issue_device_prekey_bundle(device, db) for device in devices]
+            bundles = bundles_by_user_id[user.id]
             flat_device_bundles.extend(bundles)
             participant_payloads.append(
                 {
@@ -917,13 +1291,14 @@ async def update_group_metadata(
         old_avatar_filename = chat.avatar_filename
         if avatar and avatar.filename:
             try:
-                chat.avatar_filename = save_group_avatar_file(avatar)
+                chat.avatar_filename = await run_in_threadpool(save_group_avatar_file, avatar)
             except ValueError as exc:
                 raise HTTPException(status_code=400, detail=str(exc)) from exc
 
         await db.commit()
+        manager.invalidate_chat_lists(chat_id=chat.id)
         if chat.avatar_filename and chat.avatar_filename != old_avatar_filename:
-            remove_group_avatar_file(old_avatar_filename)
+            await run_in_threadpool(remove_group_avatar_file, old_avatar_filename)
 
         users_result = await db.execute(select(User).where(User.id.in_(participant_user_ids)))
         users = users_result.scalars().all()
@@ -933,9 +1308,10 @@ async def update_group_metadata(
             "chat_id": chat.id,
             **build_group_payload(chat, participants, users_by_id, current_user.id),
         }
+        frame = Frame(payload)
         for participant_user_id in participant_user_ids:
-            await manager.notify_chat_user(chat.id, participant_user_id, payload)
-            await manager.notify_user(participant_user_id, payload)
+            await manager.notify_chat_user(chat.id, participant_user_id, frame)
+            await manager.notify_user(participant_user_id, frame)
 
         return {"status": "ok", **payload}
 
@@ -976,12 +1352,15 @@ async def add_group_participant(
         db.add(ChatParticipant(chat_id=chat.id, user_id=user.id))
         chat.group_key_epoch = max(1, int(chat.group_key_epoch or 1)) + 1
         await db.commit()
+        await manager.invalidate_chat_roster(chat.id)
+        await manager.invalidate_contacts([user.id], chat_id=chat.id)
+        manager.invalidate_chat_lists(chat_id=chat.id, owner_ids=[user.id])
 
         participants = await get_chat_participants_async(chat.id, db)
         users_result = await db.execute(select(User).where(User.id.in_(get_participant_user_ids(chat, participants))))
         users = users_result.scalars().all()
         users_by_id = {row.id: row for row in users}
-        bundles = [await issue_device_prekey_bundle(device, db) for device in devices]
+        bundles = await issue_device_prekey_bundles(devices, db)
         payload = {
             "type": "chat_participants_updated",
             "chat_id": chat.id,
@@ -993,9 +1372,10 @@ async def add_group_participant(
             },
             **build_group_payload(chat, participants, users_by_id, current_user.id),
         }
+        frame = Frame(payload)
         for participant_user_id in get_participant_user_ids(chat, participants):
-            await manager.notify_chat_user(chat.id, participant_user_id, payload)
-            await manager.notify_user(participant_user_id, payload)
+            await manager.notify_chat_user(chat.id, participant_user_id, frame)
+            await manager.notify_user(participant_user_id, frame)
 
         return {"status": "ok", **payload}
 
@@ -1025,12 +1405,16 @@ async def remove_group_participant(chat_id: int, user_id: int, current_user: Use
         await db.delete(participant)
         chat.group_key_epoch = max(1, int(chat.group_key_epoch or 1)) + 1
         await db.commit()
+        # Before anything is awaited on the removed user's behalf: their next frame must see the new roster.
+        await manager.invalidate_chat_roster(chat.id)
+        await manager.invalidate_contacts([user_id], chat_id=chat.id)
 
         if current_user.id == user_id and chat.creator_id == user_id:
             remaining = await get_chat_participants_async(chat.id, db)
             if remaining:
                 chat.creator_id = remaining[0].user_id
                 await db.commit()
+        manager.invalidate_chat_lists(chat_id=chat.id, owner_ids=[user_id])
 
         participants = await get_chat_participants_async(chat.id, db)
         participant_user_ids = get_participant_user_ids(chat, participants)
@@ -1044,9 +1428,10 @@ async def remove_group_participant(chat_id: int, user_id: int, current_user: Use
             "removed_user_id": user_id,
             **build_group_payload(chat, participants, users_by_id, current_user.id if current_user.id in participant_user_ids else (participant_user_ids[0] if participant_user_ids else user_id)),
         }
+        frame = Frame(payload)
         for participant_user_id in participant_user_ids:
-            await manager.notify_chat_user(chat.id, participant_user_id, payload)
-            await manager.notify_user(participant_user_id, payload)
+            await manager.notify_chat_user(chat.id, participant_user_id, frame)
+            await manager.notify_user(participant_user_id, frame)
         removed_user_event = {"type": "chat_deleted", "chat_id": chat.id, "delete_for_all": False}
         await manager.revoke_chat_user(chat.id, user_id, removed_user_event)
         await manager.notify_user(user_id, removed_user_event)
@@ -1107,7 +1492,7 @@ async def delete_message_for_all(message_id: int, current_user: User = Depends(g
         if message.sender_id != current_user.id:
             raise HTTPException(status_code=403, detail="Only the sender can delete the message for all")
 
-        attachment_url = message.attachment_url
+        released_urls = await release_attachment_refs(db, [message.attachment_url])
         message.deleted_for_all_at = utc_now()
         message.deleted_for_all_by_user_id = current_user.id
         message.attachment_kind = None
@@ -1117,7 +1502,8 @@ async def delete_message_for_all(message_id: int, current_user: User = Depends(g
         message.attachment_size = None
         message.attachment_meta = None
         await db.commit()
-        remove_message_attachment_file(attachment_url)
+        attachment_access_cache.invalidate_chat(chat.id)
+        await run_in_threadpool(get_message_blob_store().remove, released_urls)
 
         event = build_message_deleted_event(message_id, delete_for_all=True)
         for participant_user_id in participant_user_ids:
@@ -1142,6 +1528,7 @@ async def delete_chat_for_self(chat_id: int, current_user: User = Depends(get_cu
         set_chat_hidden_for_user(chat, current_user.id, True, current_participant)
         set_chat_cleared_for_user(chat, current_user.id, deleted_at, current_participant)
         await db.commit()
+        manager.invalidate_chat_lists(owner_ids=[current_user.id])
 
         event = build_chat_deleted_event(chat_id, delete_for_all=False)
         await manager.notify_chat_user(chat_id, current_user.id, event)
@@ -1169,12 +1556,42 @@ async def delete_chat_for_all(chat_id: int, current_user: User = Depends(get_cur
             participant = participants_by_user_id.get(participant_user_id)
             set_chat_hidden_for_user(chat, participant_user_id, True, participant)
             set_chat_cleared_for_user(chat, participant_user_id, deleted_at, participant)
+        # History is now hidden from every participant, so its attachments lose their references.
+        result = await db.execute(
+            select(Message.id, Message.attachment_url).where(
+                Message.chat_id == chat_id,
+                Message.attachment_url.is_not(None),
+                Message.created_at <= deleted_at,
+            )
+        )
+        attachment_rows = result.all()
+        released_urls = []
+        if attachment_rows:
+            released_urls = await release_attachment_refs(db, [attachment_url for _message_id, attachment_url in attachment_rows])
+            await db.execute(
+                update(Message)
+                .where(Message.id.in_([message_id for message_id, _attachment_url in attachment_rows]))
+                .values(
+                    attachment_kind=None,
+                    attachment_url=None,
+                    attachment_name=None,
+                    attachment_mime_type=None,
+                    attachment_size=None,
+                    attachment_meta=None,
+                )
+                .execution_options(synchronize_session=False)
+            )
         await db.commit()
+        attachment_access_cache.invalidate_chat(chat_id)
+        await run_in_threadpool(get_message_blob_store().remove, released_urls)
+        await manager.invalidate_chat_roster(chat_id)
+        manager.invalidate_chat_lists(chat_id=chat_id)
 
         event = build_chat_deleted_event(chat_id, delete_for_all=True)
+        frame = Frame(event)
         for participant_user_id in participant_user_ids:
-            await manager.notify_chat_user(chat_id, participant_user_id, event)
-            await manager.notify_user(participant_user_id, event)
+            await manager.notify_chat_user(chat_id, participant_user_id, frame)
+            await manager.notify_user(participant_user_id, frame)
         audit_logger.info("chat_deleted_for_all chat_id=%s user_id=%s", chat_id, current_user.id)
         return {"status": "ok"}
 
@@ -1194,7 +1611,7 @@ async def websocket_user(websocket: WebSocket):
         await websocket.close(code=1008)
         return
 
-    user = get_user_by_email_sync(payload.get("sub"))
+    user = await get_user_for_token_payload(payload)
     if not user:
         audit_logger.warning("ws_user_rejected missing_user email=%s", payload.get("sub"))
         await websocket.close(code=1008)
@@ -1204,8 +1621,7 @@ async def websocket_user(websocket: WebSocket):
     audit_logger.info("ws_user_connected user_id=%s", user_id)
     await manager.connect_user(user_id, websocket, device_id=device_id)
     async with AsyncSessionLocal() as db:
-        updated_messages = await mark_messages_delivered_for_user(user_id, db)
-        await notify_message_status(db, updated_messages)
+        await notify_receipt_events(await mark_messages_delivered_for_user(user_id, db))
     try:
         while True:
             await websocket.receive_text()
@@ -1214,6 +1630,285 @@ async def websocket_user(websocket: WebSocket):
         manager.disconnect_user(user_id, websocket, device_id=device_id)
 
 
+PARTICIPANT_REMOVED = object()
+
+
+async def reveal_chat_for_participants(chat_id: int, is_group: bool, db: AsyncSession):
+    # Set-based form of set_chat_hidden_for_user(..., False) for every participant; a no-op write when nothing is hidden.
+    await db.execute(
+        update(ChatParticipant)
+        .where(ChatParticipant.chat_id == chat_id, ChatParticipant.hidden.is_(True))
+        .values(hidden=False)
+        .execution_options(synchronize_session=False)
+    )
+    if not is_group:
+        await db.execute(
+            update(Chat)
+            .where(Chat.id == chat_id, or_(Chat.user1_hidden.is_(True), Chat.user2_hidden.is_(True)))
+            .values(user1_hidden=False, user2_hidden=False)
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def resolve_attachment_permissions(chat_id: int, jobs: list, db: AsyncSession) -> list:
+    """Check the attachment of each message in a batch: ``None`` when allowed, else the ``HTTPException``.
+
+    An attachment URL must name a blob in the message store that the sender uploaded or that
+    is already shared in this chat; anything else would let a client attach, and so gain
+    download access to, a file from a chat it is not part of.
+    """
+    store = get_message_blob_store()
+    resolved: list = []
+    for job in jobs:
+        if not job.attachment:
+            resolved.append(None)
+        elif not isinstance(job.attachment, dict) or store.key_for_url(job.attachment.get("url")) is None:
+            resolved.append(HTTPException(status_code=400, detail="Invalid attachment"))
+        else:
+            resolved.append(job.attachment["url"])
+
+    requested_urls = {value for value in resolved if isinstance(value, str)}
+    if not requested_urls:
+        return resolved
+
+    result = await db.execute(
+        select(AttachmentUpload.url, AttachmentUpload.user_id).where(
+            AttachmentUpload.url.in_(requested_urls),
+            AttachmentUpload.user_id.in_({job.user_id for job in jobs}),
+        )
+    )
+    uploaded = {(url, user_id) for url, user_id in result.all()}
+    result = await db.execute(
+        select(Message.attachment_url)
+        .where(Message.chat_id == chat_id, Message.attachment_url.in_(requested_urls))
+        .distinct()
+    )
+    shared_in_chat = set(result.scalars().all())
+
+    errors: list = []
+    for job, value in zip(jobs, resolved):
+        if isinstance(value, str):
+            allowed = value in shared_in_chat or (value, job.user_id) in uploaded
+            value = None if allowed else HTTPException(status_code=403, detail="Attachment not available")
+        errors.append(value)
+    return errors
+
+
+class InboundChatMessage:
+    __slots__ = (
+        "user_id",
+        "username",
+        "device_id",
+        "websocket",
+        "content",
+        "attachment",
+        "attachment_meta",
+        "reply_to_message_id",
+        "encrypted_content_payload",
+    )
+
+    def __init__(
+        self,
+        *,
+        user_id: int,
+        username: str,
+        device_id: str | None,
+        websocket: WebSocket,
+        content: str,
+        attachment: dict | None,
+        attachment_meta: str | None,
+        reply_to_message_id,
+        encrypted_content_payload,
+    ):
+        self.user_id = user_id
+        self.username = username
+        self.device_id = device_id
+        self.websocket = websocket
+        self.content = content
+        self.attachment = attachment
+        self.attachment_meta = attachment_meta
+        self.reply_to_message_id = reply_to_message_id
+        self.encrypted_content_payload = encrypted_content_payload
+
+
+async def write_chat_message_batch(chat_id: int, jobs: list[InboundChatMessage]) -> list:
+    """Persist every queued message of a chat in one transaction.
+
+    Returns, per job, the saved ``Message``, ``PARTICIPANT_REMOVED`` or the ``HTTPException``
+    that rejected it, along with the fan-out of the saved messages for ``chat_writer`` to run.
+    """
+    results: list = [PARTICIPANT_REMOVED] * len(jobs)
+    roster = await manager.chat_rosters.get(chat_id)
+    if roster is None:
+        return results, None
+    participant_user_ids = list(roster.user_ids)
+
+    async with AsyncSessionLocal() as db:
+        reply_targets = await resolve_reply_target_ids(chat_id, [job.reply_to_message_id for job in jobs], db)
+        attachment_errors = await resolve_attachment_permissions(chat_id, jobs, db)
+
+        accepted = []
+        for index, job in enumerate(jobs):
+            if job.user_id not in participant_user_ids:
+                continue
+            if isinstance(reply_targets[index], HTTPException):
+                results[index] = reply_targets[index]
+                continue
+            if attachment_errors[index] is not None:
+                results[index] = attachment_errors[index]
+                continue
+            accepted.append((index, job))
+        # Referenced before the insert, so a blob purged since the upload refuses its message instead of dangling.
+        missing_urls = await acquire_attachment_refs(
+            db, [job.attachment.get("url") for _index, job in accepted if job.attachment]
+        )
+        if missing_urls:
+            for index, job in accepted:
+                if job.attachment and job.attachment.get("url") in missing_urls:
+                    results[index] = HTTPException(status_code=400, detail="Attachment is no longer available")
+            accepted = [(index, job) for index, job in accepted if results[index] is PARTICIPANT_REMOVED]
+        if not accepted:
+            return results, None
+
+        # INSERT ... RETURNING for the whole batch; parameter order keeps ids in submission order.
+        result = await db.execute(
+            insert(Message).returning(Message, sort_by_parameter_order=True),
+            [
+                {
+                    "chat_id": chat_id,
+                    "sender_id": job.user_id,
+                    "sender_device_id": job.device_id,
+                    "reply_to_message_id": reply_targets[index],
+                    "content": job.content,
+                    "attachment_kind": job.attachment.get("kind") if job.attachment else None,
+                    "attachment_url": job.attachment.get("url") if job.attachment else None,
+                    "attachment_name": job.attachment.get("name") if job.attachment else None,
+                    "attachment_mime_type": job.attachment.get("mime_type") if job.attachment else None,
+                    "attachment_size": job.attachment.get("size") if job.attachment else None,
+                    "attachment_meta": job.attachment_meta,
+                }
+                for index, job in accepted
+            ],
+        )
+        saved_messages = result.scalars().all()
+
+        await reveal_chat_for_participants(chat_id, roster.is_group, db)
+
+        # Recipients with the chat open have read it on arrival; recipients online elsewhere have it delivered.
+        received_at = utc_now()
+        online_user_ids = {participant_id for participant_id in participant_user_ids if manager.is_online(participant_id)}
+        reading_user_ids = {
+            participant_id for participant_id in participant_user_ids if manager.has_chat_user(chat_id, participant_id)
+        }
+        watermarks = {"delivered": {}, "read": {}}
+        receipts = []
+        for message in saved_messages:
+            other_user_ids = [participant_id for participant_id in participant_user_ids if participant_id != message.sender_id]
+            receipt = ("sent", None)
+            for delivery_status, user_ids in (("delivered", online_user_ids), ("read", reading_user_ids)):
+                recipients = [other_user_id for other_user_id in other_user_ids if other_user_id in user_ids]
+                if recipients:
+                    receipt = (delivery_status, received_at if delivery_status == "read" else None)
+                for recipient_id in recipients:
+                    watermarks[delivery_status][recipient_id] = message.id
+            receipts.append(receipt)
+        for delivery_status, up_to_by_user_id in watermarks.items():
+            user_ids_by_up_to: dict[int, list[int]] = {}
+            for recipient_id, up_to_message_id in up_to_by_user_id.items():
+                user_ids_by_up_to.setdefault(up_to_message_id, []).append(recipient_id)
+            for up_to_message_id, user_ids in user_ids_by_up_to.items():
+                await advance_receipt_watermarks(db, chat_id, user_ids, delivery_status, up_to_message_id, received_at)
+
+        payload_rows_by_message_id: dict[int, list[MessageDevicePayload]] = {}
+        if any(job.device_id for _index, job in accepted):
+            devices_by_user_id = await get_active_devices_for_users(participant_user_ids, db)
+            for (_index, job), message in zip(accepted, saved_messages):
+                if not job.device_id:
+                    continue
+                payload_rows = build_message_device_payload_rows(
+                    message=message,
+                    sender_user_id=job.user_id,
+                    recipient_user_ids=[participant_id for participant_id in participant_user_ids if participant_id != job.user_id],
+                    parsed_payload=job.encrypted_content_payload,
+                    devices_by_user_id=devices_by_user_id,
+                )
+                db.add_all(payload_rows)
+                payload_rows_by_message_id[message.id] = payload_rows
+
+        await db.commit()
+
+    manager.invalidate_chat_lists(chat_id=chat_id)
+    deliveries = []
+    for (index, job), message, receipt in zip(accepted, saved_messages, receipts):
+        results[index] = message
+        deliveries.append((job, message, receipt, payload_rows_by_message_id.get(message.id)))
+    return results, fan_out_chat_messages(chat_id, participant_user_ids, deliveries)
+
+
+async def fan_out_chat_messages(chat_id: int, participant_user_ids: list[int], deliveries: list):
+    """Deliver a committed batch in order; a message that fails to go out does not hold back the rest."""
+    new_message_user_ids = set()
+    new_chat_user_ids = set()
+    for job, message, receipt, payload_rows in deliveries:
+        other_user_ids = [participant_id for participant_id in participant_user_ids if participant_id != job.user_id]
+        audit_logger.info(
+            "message_saved chat_id=%s message_id=%s sender_id=%s batch_size=%s",
+            chat_id,
+            message.id,
+            job.user_id,
+            len(deliveries),
+        )
+
+        try:
+            if not job.device_id:
+                legacy_event = serialize_message_for_content(
+                    message,
+                    job.username,
+                    historical=False,
+                    content=message.content,
+                    receipt=receipt,
+                )
+                for participant_user_id in participant_user_ids:
+                    await manager.notify_chat_user(chat_id, participant_user_id, legacy_event)
+            else:
+                base_event = serialize_message(message, job.username, historical=False, receipt=receipt)
+                current_device_content = next(
+                    (
+                        row.payload
+                        for row in payload_rows
+                        if row.payload_role == "sender" and row.device_id == job.device_id
+                    ),
+                    message.content,
+                )
+                delivered_to_current = await manager.safe_send(job.websocket, {**base_event, "content": current_device_content})
+                if not delivered_to_current:
+                    manager.disconnect_chat(chat_id, job.websocket, job.user_id, device_id=job.device_id)
+
+                await fan_out_device_payloads(chat_id, base_event, payload_rows, skip_device_id=job.device_id)
+        except Exception:
+            # The message is saved; recipients pick it up from history on their next sync.
+            audit_logger.exception("message_fan_out_failed chat_id=%s message_id=%s", chat_id, message.id)
+
+        new_message_user_ids.update(other_user_ids)
+        new_chat_user_ids.update(other_user_ids)
+        new_chat_user_ids.add(job.user_id)
+        audit_logger.info(
+            "new_message_notified chat_id=%s recipient_user_ids=%s message_id=%s",
+            chat_id,
+            other_user_ids,
+            message.id,
+        )
+
+    # One notification per user for the whole batch instead of one per message.
+    for notified_user_id in new_message_user_ids:
+        await manager.notify_user(notified_user_id, {"type": "new_message", "chat_id": chat_id})
+    for notified_user_id in new_chat_user_ids:
+        await manager.notify_user(notified_user_id, {"type": "new_chat", "chat_id": chat_id})
+
+
+chat_writer = ChatWriteQueue(write_chat_message_batch)
+
+
 @router.websocket("/ws/{chat_id}")
 async def websocket_chat(websocket: WebSocket, chat_id: int):
     device_id = resolve_socket_device_id(websocket)
@@ -1229,72 +1924,74 @@ async def websocket_chat(websocket: WebSocket, chat_id: int):
         await websocket.close(code=1008)
         return
 
-    user = get_user_by_email_sync(payload.get("sub"))
+    user = await get_user_for_token_payload(payload)
     if not user:
         audit_logger.warning("ws_chat_rejected missing_user chat_id=%s email=%s", chat_id, payload.get("sub"))
         await websocket.close(code=1008)
         return
 
-    chat = get_chat_for_user_sync(chat_id, user.id)
-    if not chat:
-        audit_logger.warning("ws_chat_rejected forbidden chat_id=%s user_id=%s", chat_id, user.id)
-        await websocket.close(code=1008)
-        return
-
+    # Taken before the membership check so a change racing with it is still noticed on the first frame.
+    roster_version = manager.chat_rosters.version(chat_id)
     user_id = user.id
     username = user.username
 
     async with AsyncSessionLocal() as db:
-        await ensure_direct_chat_participants_async(chat, db)
+        chat = await get_chat_for_user_async(chat_id, user_id, db)
+        if not chat:
+            audit_logger.warning("ws_chat_rejected forbidden chat_id=%s user_id=%s", chat_id, user_id)
+            await websocket.close(code=1008)
+            return
+
         participant_rows = await get_chat_participants_async(chat.id, db)
         participants_by_user_id = {participant.user_id: participant for participant in participant_rows}
         participant_user_ids = get_participant_user_ids(chat, participant_rows)
         other_user_ids = [participant_id for participant_id in participant_user_ids if participant_id != user_id]
         current_participant = participants_by_user_id.get(user_id)
 
-        updated_messages = await mark_chat_messages_read(chat_id, user_id, db)
-        await notify_message_status(db, updated_messages)
-
-        device_payload_map = await load_device_payload_map(chat_id, user_id, device_id, db)
-        deleted_message_ids = await get_deleted_message_ids(chat_id, user_id, db)
-        result = await db.execute(select(Message).where(Message.chat_id == chat_id).order_by(Message.created_at))
-        messages = [
-            message
-            for message in result.scalars().all()
-            if is_message_visible_to_user(message, chat, user_id, deleted_message_ids, current_participant)
-        ]
-        usernames: dict[int, str] = {}
-        for msg in messages:
-            if msg.sender_id not in usernames:
-                usernames[msg.sender_id] = await get_username(msg.sender_id, db)
-        historical_events = [
-            serialize_message_for_content(
-                msg,
-                usernames.get(msg.sender_id, "Unknown"),
-                historical=True,
-                content=device_payload_map.get(msg.id, msg.content),
-            )
-            for msg in messages
-        ]
+        read_event = await mark_chat_messages_read(chat_id, user_id, db)
+        if read_event:
+            await notify_receipt_events([read_event])
+
+        messages, history_cursor = await load_history_page(
+            chat,
+            user_id,
+            db,
+            participant=current_participant,
+            before_message_id=parse_history_cursor(websocket.query_params.get("before_message_id")),
+            since_message_id=parse_history_cursor(websocket.query_params.get("since_message_id")),
+            limit=resolve_history_limit(websocket.query_params.get("limit")),
+        )
+        historical_frames = [Frame(event) for event in await build_history_events(messages, user_id, device_id, db)]
 
     audit_logger.info("ws_chat_connected chat_id=%s user_id=%s", chat_id, user_id)
     await manager.connect_chat(chat_id, user_id, websocket, device_id=device_id)
 
     if not chat.is_group and other_user_ids:
-        await websocket.send_text(json.dumps({
+        await manager.send(websocket, {
             "type": "status",
             "user_id": other_user_ids[0],
             "is_online": manager.is_online(other_user_ids[0]),
-        }))
+        })
 
-    for event in historical_events:
-        await websocket.send_text(json.dumps(event))
+    for frame in historical_frames:
+        await manager.send(websocket, frame)
 
-    await websocket.send_text(json.dumps({"type": "history_complete"}))
+    await manager.send(websocket, {"type": "history_complete", **history_cursor})
 
+    frame_bucket = new_connection_frame_bucket()
+    throttled = False
     try:
         while True:
             raw_data = await websocket.receive_text()
+            # Every frame costs several queries and a fan-out, so turn it away before any of that.
+            refused = admission.admit("frames", [frame_bucket, user_frame_buckets.get(user_id)])
+            if refused is not None:
+                if not throttled:
+                    audit_logger.warning("ws_chat_frame_%s chat_id=%s user_id=%s", refused[0], chat_id, user_id)
+                throttled = True
+                await manager.send(websocket, rate_limited_frame(*refused))
+                continue
+            throttled = False
             attachment = None
             content = raw_data
             reply_to_message_id = None
@@ -1319,148 +2016,61 @@ async def websocket_chat(websocket: WebSocket, chat_id: int):
                 content = json.dumps(content, ensure_ascii=False)
 
             attachment_meta = None
-            if attachment:
+            if isinstance(attachment, dict):
                 raw_attachment_meta = attachment.get("meta")
                 if raw_attachment_meta is not None:
                     attachment_meta = json.dumps(raw_attachment_meta, ensure_ascii=False)
 
-            async with AsyncSessionLocal() as db:
-                await ensure_direct_chat_participants_async(chat, db)
-                participant_rows = await get_chat_participants_async(chat.id, db)
-                participants_by_user_id = {participant.user_id: participant for participant in participant_rows}
-                participant_user_ids = get_participant_user_ids(chat, participant_rows)
-                if user_id not in participant_user_ids:
-                    audit_logger.warning(
-                        "ws_chat_message_rejected removed_participant chat_id=%s user_id=%s",
-                        chat_id,
-                        user_id,
-                    )
-                    await manager.revoke_chat_user(
-                        chat_id,
-                        user_id,
-                        {"type": "chat_deleted", "chat_id": chat_id, "delete_for_all": False},
-                    )
-                    return
-                other_user_ids = [participant_id for participant_id in participant_user_ids if participant_id != user_id]
-                result = await db.execute(select(Message.id).where(Message.chat_id == chat_id).limit(1))
-                is_first_message = result.scalar_one_or_none() is None
-                reply_to_message_id = await resolve_reply_target_id(chat_id, reply_to_message_id, db)
-
-                delivered_at = utc_now() if any(manager.is_online(other_user_id) for other_user_id in other_user_ids) else None
-                read_at = delivered_at if any(manager.has_chat_user(chat_id, other_user_id) for other_user_id in other_user_ids) else None
-                msg = Message(
-                    chat_id=chat_id,
-                    sender_id=user_id,
-                    sender_device_id=device_id,
-                    reply_to_message_id=reply_to_message_id,
-                    content=content,
-                    attachment_kind=attachment.get("kind") if attachment else None,
-                    attachment_url=attachment.get("url") if attachment else None,
-                    attachment_name=attachment.get("name") if attachment else None,
-                    attachment_mime_type=attachment.get("mime_type") if attachment else None,
-                    attachment_size=attachment.get("size") if attachment else None,
-                    attachment_meta=attachment_meta,
-                    delivered_at=delivered_at,
-                    read_at=read_at,
+            if manager.chat_rosters.version(chat_id) != roster_version:
+                # Membership changed since this connection last looked; re-read it before accepting the frame.
+                roster = await manager.chat_rosters.get(chat_id)
+                roster_version = roster.version if roster is not None and user_id in roster else None
+            result = PARTICIPANT_REMOVED
+            if roster_version is not None:
+                result = await chat_writer.submit(
+                    chat_id,
+                    InboundChatMessage(
+                        user_id=user_id,
+                        username=username,
+                        device_id=device_id,
+                        websocket=websocket,
+                        content=content,
+                        attachment=attachment,
+                        attachment_meta=attachment_meta,
+                        reply_to_message_id=reply_to_message_id,
+                        encrypted_content_payload=encrypted_content_payload,
+                    ),
                 )
-                db.add(msg)
-                set_chat_hidden_for_user(chat, user_id, False, participants_by_user_id.get(user_id))
-                for other_user_id in other_user_ids:
-                    set_chat_hidden_for_user(chat, other_user_id, False, participants_by_user_id.get(other_user_id))
-                await db.commit()
-                await db.refresh(msg)
-                audit_logger.info(
-                    "message_saved chat_id=%s message_id=%s sender_id=%s first_message=%s",
+            if result is PARTICIPANT_REMOVED:
+                audit_logger.warning(
+                    "ws_chat_message_rejected removed_participant chat_id=%s user_id=%s",
                     chat_id,
-                    msg.id,
                     user_id,
-                    is_first_message,
                 )
-
-                if not device_id:
-                    legacy_event = serialize_message_for_content(
-                        msg,
-                        username,
-                        historical=False,
-                        content=msg.content,
-                    )
-                    for participant_user_id in participant_user_ids:
-                        await manager.notify_chat_user(chat_id, participant_user_id, legacy_event)
-                else:
-                    await persist_message_device_payloads(
-                        db,
-                        message=msg,
-                        sender_user_id=user_id,
-                        recipient_user_ids=other_user_ids,
-                        sender_device_id=device_id,
-                        parsed_payload=encrypted_content_payload,
-                    )
-
-                    sender_payloads = await load_device_payload_map(chat_id, user_id, device_id, db)
-                    sender_devices = await get_active_devices_for_user(user_id, db)
-
-                    current_device_event = serialize_message_for_content(
-                        msg,
-                        username,
-                        historical=False,
-                        content=sender_payloads.get(msg.id, msg.content),
-                    )
-                    delivered_to_current = await manager.safe_send(websocket, current_device_event)
-                    if not delivered_to_current:
-                        manager.disconnect_chat(chat_id, websocket, user_id, device_id=device_id)
-
-                    for recipient_user_id in other_user_ids:
-                        recipient_devices = await get_active_devices_for_user(recipient_user_id, db)
-                        for recipient_device in recipient_devices:
-                            recipient_payload_map = await load_device_payload_map(chat_id, recipient_user_id, recipient_device.device_id, db)
-                            await manager.notify_chat_device(
-                                chat_id,
-                                recipient_device.device_id,
-                                serialize_message_for_content(
-                                    msg,
-                                    username,
-                                    historical=False,
-                                    content=recipient_payload_map.get(msg.id, msg.content),
-                                )
-                            )
-
-                    for sender_device in sender_devices:
-                        if sender_device.device_id == device_id:
-                            continue
-                        sender_device_payload_map = await load_device_payload_map(chat_id, user_id, sender_device.device_id, db)
-                        await manager.notify_chat_device(
-                            chat_id,
-                            sender_device.device_id,
-                            serialize_message_for_content(
-                                msg,
-                                username,
-                                historical=False,
-                                content=sender_device_payload_map.get(msg.id, msg.content),
-                            )
-                        )
-
-                for other_user_id in other_user_ids:
-                    await manager.notify_user(other_user_id, {"type": "new_message", "chat_id": chat_id})
-                    await manager.notify_user(other_user_id, {"type": "new_chat", "chat_id": chat_id})
-                await manager.notify_user(user_id, {"type": "new_chat", "chat_id": chat_id})
-                await notify_message_status(db, [msg])
-                audit_logger.info(
-                    "new_message_notified chat_id=%s recipient_user_ids=%s message_id=%s",
+                await manager.revoke_chat_user(
+                    chat_id,
+                    user_id,
+                    {"type": "chat_deleted", "chat_id": chat_id, "delete_for_all": False},
+                )
+                return
+            if isinstance(result, HTTPException):
+                # HTTP error handlers cannot answer a socket; a refused frame ends the connection instead.
+                audit_logger.warning(
+                    "ws_chat_message_rejected chat_id=%s user_id=%s detail=%s",
                     chat_id,
-                    other_user_ids,
-                    msg.id,
+                    user_id,
+                    result.detail,
                 )
+                manager.disconnect_chat(chat_id, websocket, user_id, device_id=device_id)
+                await websocket.close(code=1008)
+                return
+            if isinstance(result, Exception):
+                raise result
     except WebSocketDisconnect:
         audit_logger.info("ws_chat_disconnected chat_id=%s user_id=%s", chat_id, user_id)
         manager.disconnect_chat(chat_id, websocket, user_id, device_id=device_id)
 
 
-async def get_username(user_id: int, db: AsyncSession):
-    result = await db.execute(select(User).where(User.id == user_id))
-    user = result.scalar_one_or_none()
-    return user.username if user else "Unknown"
-
-
 async def build_chat_keys_payload(chat: Chat, current_user: User, db: AsyncSession, *, issue_prekeys: bool) -> dict:
     await ensure_direct_chat_participants_async(chat, db)
     participants = await get_chat_participants_async(chat.id, db)
@@ -1474,21 +2084,19 @@ async def build_chat_keys_payload(chat: Chat, current_user: User, db: AsyncSessi
         other_users = users_result.scalars().all()
         users_by_id = {user.id: user for user in other_users}
 
-        flat_device_bundles = []
-        participant_payloads = []
-        for other_user_id in other_user_ids:
-            other_user = users_by_id.get(other_user_id)
-            if not other_user:
-                continue
+        other_users_in_order = [users_by_id[user_id] for user_id in other_user_ids if user_id in users_by_id]
+        devices_by_user_id = await get_active_devices_for_users([user.id for user in other_users_in_order], db)
+        for other_user in other_users_in_order:
             if not has_complete_x3dh_bundle(other_user):
                 return {"status": "error", "message": f"User {other_user.username} has not initialized X3DH keys yet."}
-            devices = await get_active_devices_for_user(other_user.id, db)
-            if not devices:
+            if not devices_by_user_id[other_user.id]:
                 return {"status": "error", "message": f"User {other_user.username} has no active devices."}
-            bundles = [
-                await (issue_device_prekey_bundle(device, db) if issue_prekeys else peek_device_prekey_bundle(device, db))
-                for device in devices
-            ]
+
+        bundles_by_user_id = await build_device_bundles_by_user(devices_by_user_id, db, issue_prekeys=issue_prekeys)
+        flat_device_bundles = []
+        participant_payloads = []
+        for other_user in other_users_in_order:
+            bundles = bundles_by_user_id[other_user.id]
             flat_device_bundles.extend(bundles)
             participant_payloads.append(
                 {
@@ -1543,38 +2151,161 @@ async def build_chat_keys_payload(chat: Chat, current_user: User, db: AsyncSessi
         "identity_key": other_user.identity_key or "",
         "identity_signing_key": other_user.identity_signing_key or "",
         "prekey_bundle": await (issue_prekey_bundle(other_user.id, db) if issue_prekeys else peek_prekey_bundle(other_user.id, db)),
-        "device_bundles": [
-            await (issue_device_prekey_bundle(device, db) if issue_prekeys else peek_device_prekey_bundle(device, db))
-            for device in active_devices
-        ],
+        "device_bundles": await (
+            issue_device_prekey_bundles(active_devices, db)
+            if issue_prekeys
+            else peek_device_prekey_bundles(active_devices, db)
+        ),
         "username": other_user.username,
         **build_avatar_props(other_user),
     }
 
 
-async def get_deleted_message_ids(chat_id: int, user_id: int, db: AsyncSession) -> set[int]:
-    result = await db.execute(
-        select(DeletedMessage.message_id)
-        .join(Message, Message.id == DeletedMessage.message_id)
-        .where(DeletedMessage.user_id == user_id, Message.chat_id == chat_id)
+def parse_history_cursor(raw_value) -> int | None:
+    if raw_value in (None, ""):
+        return None
+    try:
+        value = int(raw_value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+def resolve_history_limit(raw_value) -> int:
+    try:
+        limit = int(raw_value)
+    except (TypeError, ValueError):
+        return HISTORY_PAGE_SIZE
+    return max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+
+
+def build_visible_messages_query(chat: Chat, user_id: int, participant: ChatParticipant | None = None):
+    query = select(Message).where(
+        Message.chat_id == chat.id,
+        Message.deleted_for_all_at.is_(None),
+        Message.id.not_in(select(DeletedMessage.message_id).where(DeletedMessage.user_id == user_id)),
     )
-    return {message_id for message_id in result.scalars().all()}
+    cutoff = get_chat_clear_cutoff(chat, user_id, participant)
+    if cutoff is not None:
+        query = query.where(Message.created_at > cutoff)
+    return query
 
 
-def is_message_visible_to_user(
-    message: Message,
+async def load_history_page(
     chat: Chat,
     user_id: int,
-    deleted_message_ids: set[int],
+    db: AsyncSession,
+    *,
     participant: ChatParticipant | None = None,
-) -> bool:
-    if message.deleted_for_all_at:
-        return False
-    if message.id in deleted_message_ids:
-        return False
-    if is_message_cleared_for_user(message, chat, user_id, participant):
-        return False
-    return True
+    before_message_id: int | None = None,
+    since_message_id: int | None = None,
+    limit: int = HISTORY_PAGE_SIZE,
+) -> tuple[list[Message], dict]:
+    query = build_visible_messages_query(chat, user_id, participant)
+
+    if since_message_id is not None:
+        query = query.where(Message.id > since_message_id)
+        if before_message_id is not None:
+            query = query.where(Message.id < before_message_id)
+        result = await db.execute(query.order_by(Message.id.asc()).limit(limit + 1))
+        messages = list(result.scalars().all())
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        return messages, {
+            "has_more": has_more,
+            "before_message_id": None,
+            "since_message_id": messages[-1].id if has_more else None,
+        }
+
+    if before_message_id is not None:
+        query = query.where(Message.id < before_message_id)
+    result = await db.execute(query.order_by(Message.id.desc()).limit(limit + 1))
+    messages = list(result.scalars().all())
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, {
+        "has_more": has_more,
+        "before_message_id": messages[0].id if has_more else None,
+        "since_message_id": None,
+    }
+
+
+async def get_usernames_by_id(user_ids, db: AsyncSession) -> dict[int, str]:
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    result = await db.execute(select(User.id, User.username).where(User.id.in_(user_ids)))
+    return {user_id: username for user_id, username in result.all()}
+
+
+async def load_receipt_watermarks(chat_id: int, db: AsyncSession) -> list:
+    result = await db.execute(
+        select(
+            ChatParticipant.user_id,
+            ChatParticipant.last_delivered_message_id,
+            ChatParticipant.last_read_message_id,
+            ChatParticipant.last_read_at,
+        ).where(ChatParticipant.chat_id == chat_id)
+    )
+    return result.all()
+
+
+async def build_history_events(messages: list[Message], user_id: int, device_id: str | None, db: AsyncSession) -> list[dict]:
+    device_payload_map = await load_device_payload_map(
+        messages[0].chat_id if messages else None,
+        user_id,
+        device_id,
+        db,
+        message_ids=[message.id for message in messages],
+    )
+    usernames = await get_usernames_by_id((message.sender_id for message in messages), db)
+    watermarks = await load_receipt_watermarks(messages[0].chat_id, db) if messages else []
+    return [
+        serialize_message_for_content(
+            message,
+            usernames.get(message.sender_id, "Unknown"),
+            historical=True,
+            content=device_payload_map.get(message.id, message.content),
+            receipt=get_message_receipt(message, watermarks),
+        )
+        for message in messages
+    ]
+
+
+@router.get("/chats/{chat_id}/messages")
+async def get_chat_messages(
+    request: Request,
+    chat_id: int,
+    before: int | None = None,
+    since: int | None = None,
+    limit: int | None = None,
+    current_user: User = Depends(get_current_user),
+):
+    device_id = (request.headers.get("X-Device-ID") or "").strip() or None
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Chat).where(Chat.id == chat_id))
+        chat = result.scalar_one_or_none()
+        if not chat:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+        await ensure_direct_chat_participants_async(chat, db)
+        participant = await get_chat_participant_async(chat.id, current_user.id, db)
+        if not participant:
+            raise HTTPException(status_code=403, detail="Access denied")
+
+        messages, history_cursor = await load_history_page(
+            chat,
+            current_user.id,
+            db,
+            participant=participant,
+            before_message_id=parse_history_cursor(before),
+            since_message_id=parse_history_cursor(since),
+            limit=resolve_history_limit(limit),
+        )
+        events = await build_history_events(messages, current_user.id, device_id, db)
+
+    return {"status": "ok", "chat_id": chat_id, "messages": events, **history_cursor}
 
 
 @router.get("/messages/get_keys")
@@ -1647,7 +2378,7 @@ async def get_device_prekey_bundles(username: str, current_user: User = Depends(
         return {
             "status": "ok",
             "username": other_user.username,
-            "devices": [await issue_device_prekey_bundle(device, db) for device in active_devices],
+            "devices": await issue_device_prekey_bundles(active_devices, db),
         }
 
 
@@ -1677,7 +2408,7 @@ async def get_chat_device_keys(chat_id: int, current_user: User = Depends(get_cu
         return {
             "status": "ok",
             "username": other_user.username,
-            "devices": [await peek_device_prekey_bundle(device, db) for device in active_devices],
+            "devices": await peek_device_prekey_bundles(active_devices, db),
             **build_avatar_props(other_user),
         }
 
@@ -1723,29 +2454,14 @@ async def users_me_device_bundles(current_user: User = Depends(get_current_user)
 
 
 async def issue_prekey_bundle(user_id: int, db: AsyncSession):
-    await purge_old_used_prekeys(user_id, db)
-
     result = await db.execute(select(User).where(User.id == user_id))
     user = result.scalar_one_or_none()
     if not user or not has_complete_x3dh_bundle(user):
         return None
 
-    result = await db.execute(
-        select(OneTimePreKey)
-        .where(OneTimePreKey.user_id == user_id, OneTimePreKey.used_at.is_(None))
-        .order_by(OneTimePreKey.id)
-        .limit(1)
-    )
-    one_time_prekey = result.scalar_one_or_none()
-
-    one_time_payload = None
-    if one_time_prekey:
-        one_time_prekey.used_at = utc_now()
+    one_time_payload = await claim_user_prekey(db, user_id)
+    if one_time_payload:
         await db.commit()
-        one_time_payload = {
-            "key_id": one_time_prekey.key_id,
-            "public_key": one_time_prekey.public_key,
-        }
 
     return {
         "identity_key": user.identity_key or "",
@@ -1758,8 +2474,6 @@ async def issue_prekey_bundle(user_id: int, db: AsyncSession):
 
 
 async def peek_prekey_bundle(user_id: int, db: AsyncSession):
-    await purge_old_used_prekeys(user_id, db)
-
     result = await db.execute(select(User).where(User.id == user_id))
     user = result.scalar_one_or_none()
     if not user or not has_complete_x3dh_bundle(user):
@@ -1787,37 +2501,29 @@ async def peek_prekey_bundle(user_id: int, db: AsyncSession):
     }
 
 
-async def purge_old_used_prekeys(user_id: int, db: AsyncSession):
-    cutoff = utc_now() - timedelta(days=USED_PREKEY_RETENTION_DAYS)
-    await db.execute(
-        OneTimePreKey.__table__.delete().where(
-            OneTimePreKey.user_id == user_id,
-            OneTimePreKey.used_at.is_not(None),
-            OneTimePreKey.used_at < cutoff,
-        )
+async def get_active_devices_for_user(user_id: int, db: AsyncSession) -> list[Device]:
+    result = await db.execute(
+        select(Device)
+        .where(Device.user_id == user_id, Device.revoked_at.is_(None))
+        .order_by(Device.created_at.asc(), Device.id.asc())
     )
-    await db.commit()
+    return [device for device in result.scalars().all() if has_complete_device_bundle(device)]
 
 
-async def purge_old_used_device_prekeys(device_id: str, db: AsyncSession):
-    cutoff = utc_now() - timedelta(days=USED_PREKEY_RETENTION_DAYS)
-    await db.execute(
-        DeviceOneTimePreKey.__table__.delete().where(
-            DeviceOneTimePreKey.device_id == device_id,
-            DeviceOneTimePreKey.used_at.is_not(None),
-            DeviceOneTimePreKey.used_at < cutoff,
-        )
-    )
-    await db.commit()
-
+async def get_active_devices_for_users(user_ids, db: AsyncSession) -> dict[int, list[Device]]:
+    devices_by_user_id: dict[int, list[Device]] = {user_id: [] for user_id in user_ids}
+    if not devices_by_user_id:
+        return devices_by_user_id
 
-async def get_active_devices_for_user(user_id: int, db: AsyncSession) -> list[Device]:
     result = await db.execute(
         select(Device)
-        .where(Device.user_id == user_id, Device.revoked_at.is_(None))
+        .where(Device.user_id.in_(devices_by_user_id.keys()), Device.revoked_at.is_(None))
         .order_by(Device.created_at.asc(), Device.id.asc())
     )
-    return [device for device in result.scalars().all() if has_complete_device_bundle(device)]
+    for device in result.scalars().all():
+        if has_complete_device_bundle(device):
+            devices_by_user_id[device.user_id].append(device)
+    return devices_by_user_id
 
 
 def normalize_device_payload_map(payload_value) -> dict[str, str]:
@@ -1834,15 +2540,14 @@ def normalize_device_payload_map(payload_value) -> dict[str, str]:
     return {}
 
 
-async def persist_message_device_payloads(
-    db: AsyncSession,
+def build_message_device_payload_rows(
     *,
     message: Message,
     sender_user_id: int,
     recipient_user_ids: list[int],
-    sender_device_id: str | None,
     parsed_payload,
-):
+    devices_by_user_id: dict[int, list[Device]],
+) -> list[MessageDevicePayload]:
     recipient_payloads = {}
     sender_payloads = {}
 
@@ -1850,11 +2555,9 @@ async def persist_message_device_payloads(
         recipient_payloads = normalize_device_payload_map(parsed_payload.get("device_payloads"))
         sender_payloads = normalize_device_payload_map(parsed_payload.get("sender_device_payloads"))
 
-    sender_devices = await get_active_devices_for_user(sender_user_id, db)
     rows = []
     for recipient_user_id in recipient_user_ids:
-        recipient_devices = await get_active_devices_for_user(recipient_user_id, db)
-        for device in recipient_devices:
+        for device in devices_by_user_id.get(recipient_user_id, []):
             rows.append(
                 MessageDevicePayload(
                     message_id=message.id,
@@ -1864,32 +2567,50 @@ async def persist_message_device_payloads(
                     payload_role="recipient",
                 )
             )
-        
 
-    for device in sender_devices:
-        payload_value = sender_payloads.get(device.device_id, message.content)
-        if device.device_id == sender_device_id:
-            payload_value = sender_payloads.get(device.device_id, message.content)
+    for device in devices_by_user_id.get(sender_user_id, []):
         rows.append(
             MessageDevicePayload(
                 message_id=message.id,
                 user_id=sender_user_id,
                 device_id=device.device_id,
-                payload=payload_value,
+                payload=sender_payloads.get(device.device_id, message.content),
                 payload_role="sender",
             )
         )
+    return rows
 
-    if rows:
-        db.add_all(rows)
-        await db.commit()
+
+async def fan_out_device_payloads(
+    chat_id: int,
+    base_event: dict,
+    payload_rows: list[MessageDevicePayload],
+    *,
+    skip_device_id: str | None = None,
+):
+    sends = [
+        manager.notify_chat_device(chat_id, row.device_id, {**base_event, "content": row.payload})
+        for row in payload_rows
+        if not (row.payload_role == "sender" and row.device_id == skip_device_id)
+    ]
+    if sends:
+        await asyncio.gather(*sends)
 
 
-async def load_device_payload_map(chat_id: int, user_id: int, device_id: str | None, db: AsyncSession) -> dict[int, str]:
+async def load_device_payload_map(
+    chat_id: int | None,
+    user_id: int,
+    device_id: str | None,
+    db: AsyncSession,
+    *,
+    message_ids: list[int] | None = None,
+) -> dict[int, str]:
     if not device_id:
         return {}
+    if message_ids is not None and not message_ids:
+        return {}
 
-    result = await db.execute(
+    query = (
         select(MessageDevicePayload)
         .join(Message, Message.id == MessageDevicePayload.message_id)
         .where(
@@ -1898,53 +2619,40 @@ async def load_device_payload_map(chat_id: int, user_id: int, device_id: str | N
             MessageDevicePayload.device_id == device_id,
         )
     )
+    if message_ids is not None:
+        query = query.where(MessageDevicePayload.message_id.in_(message_ids))
+    result = await db.execute(query)
     return {
         row.message_id: row.payload
         for row in result.scalars().all()
     }
 
 
-async def issue_device_prekey_bundle(device: Device, db: AsyncSession):
-    await purge_old_used_device_prekeys(device.device_id, db)
-
-    result = await db.execute(
-        select(DeviceOneTimePreKey)
-        .where(DeviceOneTimePreKey.device_id == device.device_id, DeviceOneTimePreKey.used_at.is_(None))
-        .order_by(DeviceOneTimePreKey.id)
-        .limit(1)
-    )
-    one_time_prekey = result.scalar_one_or_none()
-
-    one_time_payload = None
-    if one_time_prekey:
-        one_time_prekey.used_at = utc_now()
+async def issue_device_prekey_bundles(devices: list[Device], db: AsyncSession) -> list[dict]:
+    """Bundles for several devices, claiming their one-time prekeys in a single statement."""
+    claimed = await claim_device_prekeys(db, [device.device_id for device in devices])
+    if claimed:
         await db.commit()
-        one_time_payload = {
-            "key_id": one_time_prekey.key_id,
-            "public_key": one_time_prekey.public_key,
-        }
+    return [build_device_bundle_payload(device, claimed.get(device.device_id)) for device in devices]
 
-    return build_device_bundle_payload(device, one_time_payload)
 
+async def peek_device_prekey_bundles(devices: list[Device], db: AsyncSession) -> list[dict]:
+    peeked = await peek_device_prekeys(db, [device.device_id for device in devices])
+    return [build_device_bundle_payload(device, peeked.get(device.device_id)) for device in devices]
 
-async def peek_device_prekey_bundle(device: Device, db: AsyncSession):
-    await purge_old_used_device_prekeys(device.device_id, db)
 
-    result = await db.execute(
-        select(DeviceOneTimePreKey)
-        .where(DeviceOneTimePreKey.device_id == device.device_id, DeviceOneTimePreKey.used_at.is_(None))
-        .order_by(DeviceOneTimePreKey.id)
-        .limit(1)
-    )
-    one_time_prekey = result.scalar_one_or_none()
-    return build_device_bundle_payload(
-        device,
-        (
-            {"key_id": one_time_prekey.key_id, "public_key": one_time_prekey.public_key}
-            if one_time_prekey
-            else None
-        ),
+async def build_device_bundles_by_user(
+    devices_by_user_id: dict[int, list[Device]],
+    db: AsyncSession,
+    *,
+    issue_prekeys: bool,
+) -> dict[int, list[dict]]:
+    """Device bundles for many users at once: one prekey statement however many devices there are."""
+    devices = [device for user_devices in devices_by_user_id.values() for device in user_devices]
+    bundles = iter(
+        await (issue_device_prekey_bundles(devices, db) if issue_prekeys else peek_device_prekey_bundles(devices, db))
     )
+    return {user_id: [next(bundles) for _device in user_devices] for user_id, user_devices in devices_by_user_id.items()}
 
 
 def build_device_bundle_payload(device: Device, one_time_payload):
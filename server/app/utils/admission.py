@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+from app.db.session import async_engine, engine
+
+
+logger = logging.getLogger("app.admission")
+
+# Sustained rate and burst for inbound chat frames, per socket and across all of a user's sockets.
+WEBSOCKET_FRAME_RATE_PER_SECOND = float(os.getenv("WEBSOCKET_FRAME_RATE_PER_SECOND", 5))
+WEBSOCKET_FRAME_BURST = float(os.getenv("WEBSOCKET_FRAME_BURST", 20))
+WEBSOCKET_USER_FRAME_RATE_PER_SECOND = float(os.getenv("WEBSOCKET_USER_FRAME_RATE_PER_SECOND", 10))
+WEBSOCKET_USER_FRAME_BURST = float(os.getenv("WEBSOCKET_USER_FRAME_BURST", 40))
+UPLOAD_RATE_PER_SECOND = float(os.getenv("UPLOAD_RATE_PER_SECOND", 0.5))
+UPLOAD_BURST = float(os.getenv("UPLOAD_BURST", 10))
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", 50_000))
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in {"1", "true", "yes", "on"}
+ADMISSION_MAX_LOOP_LAG_MS = float(os.getenv("ADMISSION_MAX_LOOP_LAG_MS", 200))
+ADMISSION_MAX_DB_POOL_USAGE = float(os.getenv("ADMISSION_MAX_DB_POOL_USAGE", 0.9))
+ADMISSION_PROBE_INTERVAL_SECONDS = float(os.getenv("ADMISSION_PROBE_INTERVAL_SECONDS", 0.5))
+ADMISSION_RETRY_AFTER_SECONDS = float(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", 1))
+
+
+class TokenBucket:
+    """``burst`` tokens refilled at ``rate`` per second; each admitted unit of work takes one."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, *, now: float | None = None):
+        self.rate = max(rate, 0.001)
+        self.burst = max(burst, 1.0)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now: float, cost: float = 1.0) -> float:
+        """Seconds until ``cost`` tokens are available; zero if they are now."""
+        self._refill(now)
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def take(self, now: float, cost: float = 1.0):
+        self._refill(now)
+        self.tokens -= cost
+
+
+def take_from_buckets(buckets: list[TokenBucket], *, now: float | None = None, cost: float = 1.0) -> float:
+    """Take ``cost`` from every bucket, or from none of them; returns the wait when refused.
+
+    Checking all buckets before taking from any means a frame the user bucket refuses does
+    not also use up the connection's allowance.
+    """
+    now = time.monotonic() if now is None else now
+    wait = max(bucket.wait_time(now, cost) for bucket in buckets)
+    if wait > 0:
+        return wait
+    for bucket in buckets:
+        bucket.take(now, cost)
+    return 0.0
+
+
+class TokenBucketRegistry:
+    """One bucket per key (usually a user id), LRU-bounded so idle users do not accumulate.
+
+    A bucket dropped for being least recently used would have refilled to full anyway
+    unless the key has been very active, so eviction only ever errs towards admitting.
+    """
+
+    def __init__(self, rate: float, burst: float, *, max_keys: int = RATE_LIMIT_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max(1, max_keys)
+        self._buckets: OrderedDict[object, TokenBucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return bucket
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+def db_pool_usage(pool: Pool) -> float:
+    """Share of the pool's connections, overflow included, that are checked out right now."""
+    checked_out = getattr(pool, "checkedout", None)
+    size = getattr(pool, "size", None)
+    if checked_out is None or size is None:
+        # NullPool and StaticPool have no fixed capacity to run out of.
+        return 0.0
+    capacity = size() + max(0, getattr(pool, "_max_overflow", 0))
+    return checked_out() / capacity if capacity > 0 else 0.0
+
+
+class AdmissionController:
+    """Decides whether the process has room for more database work.
+
+    A probe task sleeps for a fixed interval and records how late it wakes up; that
+    overshoot is the event-loop lag every other coroutine is seeing too. Together with
+    how much of the database pool is checked out, it tells request handlers to turn
+    work away early with a retry hint instead of queueing it behind a saturated pool.
+    """
+
+    def __init__(
+        self,
+        engines: list[Engine],
+        *,
+        max_loop_lag_ms: float = ADMISSION_MAX_LOOP_LAG_MS,
+        max_db_pool_usage: float = ADMISSION_MAX_DB_POOL_USAGE,
+        probe_interval_seconds: float = ADMISSION_PROBE_INTERVAL_SECONDS,
+        retry_after_seconds: float = ADMISSION_RETRY_AFTER_SECONDS,
+        enabled: bool = ADMISSION_ENABLED,
+    ):
+        self.engines = engines
+        self.max_loop_lag_ms = max_loop_lag_ms
+        self.max_db_pool_usage = max_db_pool_usage
+        self.probe_interval_seconds = max(0.01, probe_interval_seconds)
+        self.retry_after_seconds = retry_after_seconds
+        self.enabled = enabled
+        self.loop_lag_ms = 0.0
+        self._task: asyncio.Task | None = None
+        self.stats = {"shed_loop_lag": 0, "shed_db_pool": 0, "max_loop_lag_ms": 0.0}
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._probe_forever())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _probe_forever(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected_at = loop.time() + self.probe_interval_seconds
+            await asyncio.sleep(self.probe_interval_seconds)
+            self.record_loop_lag(max(0.0, loop.time() - expected_at) * 1000)
+
+    def record_loop_lag(self, lag_ms: float):
+        self.loop_lag_ms = lag_ms
+        self.stats["max_loop_lag_ms"] = max(self.stats["max_loop_lag_ms"], lag_ms)
+        if lag_ms > self.max_loop_lag_ms:
+            logger.warning("event_loop_lag lag_ms=%.1f", lag_ms)
+
+    def db_pool_usage(self) -> float:
+        # Read the pool through the engine every time; dispose() swaps in a new one.
+        return max((db_pool_usage(engine.pool) for engine in self.engines), default=0.0)
+
+    def check(self) -> tuple[str, float] | None:
+        """``None`` when there is room, otherwise ``(reason, retry_after_seconds)``."""
+        if not self.enabled:
+            return None
+        if self.loop_lag_ms > self.max_loop_lag_ms:
+            self.stats["shed_loop_lag"] += 1
+            return "overloaded", self.retry_after_seconds
+        if self.db_pool_usage() >= self.max_db_pool_usage:
+            self.stats["shed_db_pool"] += 1
+            return "overloaded", self.retry_after_seconds
+        return None
+
+    def admit(self, kind: str, buckets: list[TokenBucket]) -> tuple[str, float] | None:
+        """Shed load first, then charge ``buckets``; ``None`` means go ahead."""
+        refused = self.check()
+        if refused is None:
+            wait = take_from_buckets(buckets)
+            if wait > 0:
+                refused = ("rate_limited", wait)
+        if refused is not None:
+            self.stats[f"{refused[0]}_{kind}"] = self.stats.get(f"{refused[0]}_{kind}", 0) + 1
+        return refused
+
+    def get_metrics(self) -> dict:
+        return {
+            "admission_loop_lag_ms": round(self.loop_lag_ms, 3),
+            "admission_db_pool_usage": round(self.db_pool_usage(), 3),
+            **{f"admission_{name}": value for name, value in self.stats.items()},
+        }
+
+    def clear(self):
+        self.loop_lag_ms = 0.0
+        self.stats = {"shed_loop_lag": 0, "shed_db_pool": 0, "max_loop_lag_ms": 0.0}
+
+
+admission = AdmissionController([engine, async_engine.sync_engine])
+user_frame_buckets = TokenBucketRegistry(WEBSOCKET_USER_FRAME_RATE_PER_SECOND, WEBSOCKET_USER_FRAME_BURST)
+upload_buckets = TokenBucketRegistry(UPLOAD_RATE_PER_SECOND, UPLOAD_BURST)
+
+
+def new_connection_frame_bucket() -> TokenBucket:
+    return TokenBucket(WEBSOCKET_FRAME_RATE_PER_SECOND, WEBSOCKET_FRAME_BURST)
+
+
+def retry_after_header(retry_after: float) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+def rate_limited_frame(reason: str, retry_after: float) -> dict:
+    """What a socket gets instead of a silently dropped frame; resend after ``retry_after_ms``."""
+    return {"type": "rate_limited", "reason": reason, "retry_after_ms": max(1, math.ceil(retry_after * 1000))}
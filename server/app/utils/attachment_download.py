@@ -0,0 +1,142 @@
+import hashlib
+import mimetypes
+import os
+import re
+import stat
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, Response
+
+
+ATTACHMENT_ACCESS_CACHE_TTL_SECONDS = float(os.getenv("ATTACHMENT_ACCESS_CACHE_TTL_SECONDS", 60))
+ATTACHMENT_ACCESS_CACHE_MAX_ENTRIES = int(os.getenv("ATTACHMENT_ACCESS_CACHE_MAX_ENTRIES", 50000))
+# "" streams from this process; "x-accel-redirect" (nginx) or "x-sendfile" (Apache, lighttpd) hand the file to the proxy.
+ATTACHMENT_OFFLOAD_MODE = os.getenv("ATTACHMENT_OFFLOAD_MODE", "").strip().lower()
+ATTACHMENT_ACCEL_REDIRECT_PREFIX = os.getenv("ATTACHMENT_ACCEL_REDIRECT_PREFIX", "/internal/uploads/messages/")
+
+CONTENT_ADDRESSED_STEM = re.compile(r"^[0-9a-f]{64}$")
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+
+
+class AttachmentAccessCache:
+    """Attachment URLs known to be referenced by a message in a chat, keyed on ``(chat_id, url)``.
+
+    Chat membership itself comes from the roster cache; this only saves the message lookup
+    on repeated range requests while a video is being scrubbed. Misses are not remembered,
+    so a just-sent attachment is downloadable at once.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl_seconds: float = ATTACHMENT_ACCESS_CACHE_TTL_SECONDS,
+        max_entries: int = ATTACHMENT_ACCESS_CACHE_MAX_ENTRIES,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict[tuple[int, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, chat_id: int, url: str) -> bool:
+        key = (chat_id, url)
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= time.monotonic():
+                self._entries.pop(key, None)
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, chat_id: int, url: str):
+        key = (chat_id, url)
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl_seconds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_chat(self, chat_id: int):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == chat_id]:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+attachment_access_cache = AttachmentAccessCache()
+
+
+def _entity_tag(path: Path, stat_result: os.stat_result) -> tuple[str, bool]:
+    # A content-addressed name is the hash of the bytes, so it is a strong validator that never changes.
+    if CONTENT_ADDRESSED_STEM.match(path.stem):
+        return f'"{path.stem}"', True
+    etag_base = f"{stat_result.st_mtime}-{stat_result.st_size}"
+    return f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"', False
+
+
+def _not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in candidates or etag in candidates
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def build_attachment_response(
+    request: Request,
+    path: Path,
+    relative_name: str,
+    *,
+    media_type: str | None = None,
+) -> Response | None:
+    """Serve an attachment file, or return ``None`` when it does not exist.
+
+    Range and If-Range are handled by ``FileResponse``, which also hands the file to the
+    server through the ``http.response.pathsend`` extension where one is offered.
+    """
+    try:
+        stat_result = await run_in_threadpool(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+
+    etag, immutable = _entity_tag(path, stat_result)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if _not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    if ATTACHMENT_OFFLOAD_MODE in {"x-accel-redirect", "x-sendfile"}:
+        media_type = media_type or mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if ATTACHMENT_OFFLOAD_MODE == "x-accel-redirect":
+            # nginx serves Range and conditional requests itself from an `internal` location.
+            headers["X-Accel-Redirect"] = f"{ATTACHMENT_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_name}"
+        else:
+            headers["X-Sendfile"] = str(path.resolve())
+        return Response(media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
@@ -1,6 +1,13 @@
 import hashlib
+import os
+from pathlib import Path
 
 from app.db.models import Chat, User
+from app.utils.storage import LocalStorage, S3Storage, build_storage
+
+
+AVATAR_UPLOAD_DIR = Path(os.getenv("AVATAR_UPLOAD_DIR", "client/static/uploads/avatars"))
+AVATAR_URL_PREFIX = "/static/uploads/avatars/"
 
 AVATAR_GRADIENT_CLASSES = [
     "avatar-gradient-1",
@@ -18,6 +25,10 @@ AVATAR_GRADIENT_CLASSES = [
 ]
 
 
+def get_avatar_storage(root: Path | None = None) -> LocalStorage | S3Storage:
+    return build_storage("avatars", root or AVATAR_UPLOAD_DIR, AVATAR_URL_PREFIX)
+
+
 def build_avatar_props(user: User | None) -> dict:
     if not user:
         return {
@@ -27,7 +38,7 @@ def build_avatar_props(user: User | None) -> dict:
         }
 
     seed = user.account_instance_id or user.email or user.username or str(user.id)
-    avatar_url = f"/static/uploads/avatars/{user.avatar_filename}" if user.avatar_filename else None
+    avatar_url = get_avatar_storage().public_url(user.avatar_filename) if user.avatar_filename else None
     return {
         "avatar_url": avatar_url,
         "avatar_class": None if avatar_url else _gradient_class(seed),
@@ -44,7 +55,7 @@ def build_chat_avatar_props(chat: Chat | None) -> dict:
         }
 
     seed = chat.title or f"chat-{chat.id}"
-    avatar_url = f"/static/uploads/avatars/{chat.avatar_filename}" if chat.avatar_filename else None
+    avatar_url = get_avatar_storage().public_url(chat.avatar_filename) if chat.avatar_filename else None
     title = (chat.title or "Group").strip()
     return {
         "avatar_url": avatar_url,
@@ -0,0 +1,134 @@
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Iterable
+
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import AttachmentBlob, AttachmentUpload
+from app.utils.storage import LocalStorage, S3Storage, check_storage_key
+from app.utils.time import utc_now
+
+
+class ContentAddressedBlobStore:
+    """Objects named by the sha256 of their bytes, sharded two levels deep.
+
+    ``ab/cd/abcd….bin`` keeps any one directory or key listing small. Identical uploads land
+    on the same key, so storing a blob twice only costs the temporary copy.
+    """
+
+    def __init__(self, storage: LocalStorage | S3Storage, url_prefix: str):
+        self.storage = storage
+        self.url_prefix = url_prefix.rstrip("/") + "/"
+
+    def relative_name(self, sha256: str, extension: str) -> str:
+        return f"{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}"
+
+    def url_for(self, relative_name: str) -> str:
+        return f"{self.url_prefix}{relative_name}"
+
+    def incoming_path(self, extension: str) -> Path:
+        return self.storage.spool_path(extension)
+
+    def key_for_url(self, url: str | None) -> str | None:
+        if not url or not str(url).startswith(self.url_prefix):
+            return None
+        # Blobs are sharded; uploads from before the blob store are flat names.
+        try:
+            return check_storage_key(str(url)[len(self.url_prefix):])
+        except ValueError:
+            return None
+
+    def adopt(self, incoming: Path, sha256: str, extension: str, *, content_type: str | None = None) -> str:
+        """Store ``incoming`` under its content address and return the blob URL; blocking."""
+        relative_name = self.relative_name(sha256, extension)
+        # Overwriting an existing blob with the same bytes is harmless, and it restores the object
+        # if a concurrent release removed it after this upload registered its row.
+        self.storage.put_file(relative_name, incoming, content_type=content_type)
+        return self.url_for(relative_name)
+
+    def remove(self, urls: Iterable[str]):
+        for url in urls:
+            key = self.key_for_url(url)
+            if key is not None:
+                self.storage.delete(key)
+
+
+async def register_attachment_blob(db: AsyncSession, url: str, sha256: str, size: int, *, uploaded_by: int):
+    """Record an uploaded blob with no references yet, and who uploaded it.
+
+    Re-uploading a known blob restarts its grace period, so an unreferenced row that was
+    about to be purged stays around long enough for the new upload to be sent.
+    """
+    now = utc_now()
+    dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    await db.execute(
+        dialect_insert(AttachmentBlob)
+        .values(url=url, sha256=sha256, size=size, ref_count=0, created_at=now)
+        .on_conflict_do_update(index_elements=[AttachmentBlob.url], set_={"created_at": now})
+    )
+    await db.execute(
+        dialect_insert(AttachmentUpload)
+        .values(url=url, user_id=uploaded_by, created_at=now)
+        .on_conflict_do_nothing(index_elements=[AttachmentUpload.url, AttachmentUpload.user_id])
+    )
+
+
+async def forget_attachment_blobs(db: AsyncSession, urls: list[str]):
+    """Drop the upload records of blobs whose rows were just deleted."""
+    if urls:
+        await db.execute(
+            delete(AttachmentUpload)
+            .where(AttachmentUpload.url.in_(urls))
+            .execution_options(synchronize_session=False)
+        )
+
+
+async def _shift_ref_counts(db: AsyncSession, counts: Counter, sign: int) -> set[str]:
+    """Apply ``counts`` to the blob rows and return the URLs that had a row to update."""
+    # One UPDATE per distinct count; in practice nearly every URL appears once per batch.
+    urls_by_count = defaultdict(list)
+    for url, count in counts.items():
+        urls_by_count[count].append(url)
+    shifted = set()
+    for count, urls in urls_by_count.items():
+        result = await db.execute(
+            update(AttachmentBlob)
+            .where(AttachmentBlob.url.in_(urls))
+            .values(ref_count=AttachmentBlob.ref_count + sign * count)
+            .returning(AttachmentBlob.url)
+            .execution_options(synchronize_session=False)
+        )
+        shifted.update(result.scalars().all())
+    return shifted
+
+
+async def acquire_attachment_refs(db: AsyncSession, urls: Iterable[str | None]) -> set[str]:
+    """Add one reference per entry and return the URLs whose blob row is gone.
+
+    The increment and the purge job's ``ref_count <= 0`` delete lock the same row, so
+    one of them sees the other's result. A missing row means the blob was purged (or never
+    registered) and a message pointing at it must be refused rather than saved.
+    """
+    counts = Counter(url for url in urls if url)
+    if not counts:
+        return set()
+    return set(counts) - await _shift_ref_counts(db, counts, 1)
+
+
+async def release_attachment_refs(db: AsyncSession, urls: Iterable[str | None]) -> list[str]:
+    """Drop one reference per entry and return the URLs whose files can now be removed.
+
+    Tracked blobs are only decremented: ``purge_orphan_uploads`` deletes them once they are
+    unreferenced and past the grace period, so a blob that was just uploaded again, or whose
+    file is still being stored, is not pulled out from under its uploader. The result holds
+    only URLs without a blob row, which predate reference counting and had a single owner;
+    call ``ContentAddressedBlobStore.remove`` with it after committing.
+    """
+    counts = Counter(url for url in urls if url)
+    if not counts:
+        return []
+    tracked = await _shift_ref_counts(db, counts, -1)
+    return [url for url in counts if url not in tracked]
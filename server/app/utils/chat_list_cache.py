@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+CHAT_LIST_CACHE_TTL_SECONDS = float(os.getenv("CHAT_LIST_CACHE_TTL_SECONDS", 60))
+CHAT_LIST_CACHE_MAX_USERS = int(os.getenv("CHAT_LIST_CACHE_MAX_USERS", 10000))
+
+
+class ChatListCache:
+    """Per-user chat list snapshots, indexed by the chats and users each snapshot mentions."""
+
+    def __init__(self, *, ttl_seconds: float = CHAT_LIST_CACHE_TTL_SECONDS, max_users: int = CHAT_LIST_CACHE_MAX_USERS):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max(1, max_users)
+        self._entries: OrderedDict[int, tuple[float, dict, frozenset[int], frozenset[int]]] = OrderedDict()
+        self._owners_by_chat: dict[int, set[int]] = {}
+        self._owners_by_user: dict[int, set[int]] = {}
+        # messages_page runs in the threadpool, so entries are touched from several threads.
+        self._lock = threading.Lock()
+
+    def get(self, owner_id: int) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(owner_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._drop(owner_id)
+                return None
+            self._entries.move_to_end(owner_id)
+            return entry[1]
+
+    def set(self, owner_id: int, snapshot: dict, *, chat_ids, user_ids):
+        chat_ids = frozenset(chat_ids)
+        user_ids = frozenset(user_ids) | {owner_id}
+        with self._lock:
+            self._drop(owner_id)
+            self._entries[owner_id] = (time.monotonic() + self.ttl_seconds, snapshot, chat_ids, user_ids)
+            for chat_id in chat_ids:
+                self._owners_by_chat.setdefault(chat_id, set()).add(owner_id)
+            for user_id in user_ids:
+                self._owners_by_user.setdefault(user_id, set()).add(owner_id)
+            while len(self._entries) > self.max_users:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_users(self, owner_ids):
+        with self._lock:
+            for owner_id in owner_ids:
+                self._drop(owner_id)
+
+    def invalidate_chat(self, chat_id: int, user_ids=()):
+        with self._lock:
+            for owner_id in self._owners_by_chat.get(chat_id, set()) | set(user_ids):
+                self._drop(owner_id)
+
+    def invalidate_user_references(self, user_id: int):
+        # Usernames, avatars and identity keys of a user appear in every list that shows a chat with them.
+        with self._lock:
+            for owner_id in self._owners_by_user.get(user_id, set()) | {user_id}:
+                self._drop(owner_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners_by_chat.clear()
+            self._owners_by_user.clear()
+
+    def _drop(self, owner_id: int):
+        entry = self._entries.pop(owner_id, None)
+        if entry is None:
+            return
+        _expires_at, _snapshot, chat_ids, user_ids = entry
+        for index, keys in ((self._owners_by_chat, chat_ids), (self._owners_by_user, user_ids)):
+            for key in keys:
+                owners = index.get(key)
+                if owners is None:
+                    continue
+                owners.discard(owner_id)
+                if not owners:
+                    index.pop(key)
+
+
+chat_list_cache = ChatListCache()
@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from sqlalchemy import select
+
+from app.db.models import Chat, ChatParticipant
+from app.db.session import AsyncSessionLocal
+
+
+CHAT_ROSTER_CACHE_MAX_CHATS = int(os.getenv("CHAT_ROSTER_CACHE_MAX_CHATS", 10000))
+
+ChatRosterLoader = Callable[[int], Awaitable[tuple[bool, tuple[int, ...]] | None]]
+
+
+async def load_chat_roster(chat_id: int) -> tuple[bool, tuple[int, ...]] | None:
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(Chat.is_group, Chat.user1_id, Chat.user2_id).where(Chat.id == chat_id))
+        chat_row = result.one_or_none()
+        if chat_row is None:
+            return None
+
+        result = await db.execute(
+            select(ChatParticipant.user_id).where(ChatParticipant.chat_id == chat_id).order_by(ChatParticipant.id)
+        )
+        user_ids = tuple(result.scalars().all())
+
+    is_group, user1_id, user2_id = chat_row
+    if not user_ids:
+        # Older direct chats may predate their participant rows.
+        user_ids = tuple(user_id for user_id in (user1_id, user2_id) if user_id)
+    return bool(is_group), user_ids
+
+
+class ChatRoster:
+    __slots__ = ("chat_id", "version", "is_group", "user_ids")
+
+    def __init__(self, chat_id: int, version: int, is_group: bool, user_ids: tuple[int, ...]):
+        self.chat_id = chat_id
+        self.version = version
+        self.is_group = is_group
+        self.user_ids = user_ids
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.user_ids
+
+
+class ChatRosterCache:
+    """Participants per chat, versioned so open connections notice membership changes.
+
+    Every membership change calls ``bump``. A connection remembers the version of the
+    roster it checked and re-reads only when ``version(chat_id)`` moves.
+    """
+
+    def __init__(self, loader: ChatRosterLoader = load_chat_roster, *, max_chats: int = CHAT_ROSTER_CACHE_MAX_CHATS):
+        self.loader = loader
+        self.max_chats = max(1, max_chats)
+        self._entries: OrderedDict[int, ChatRoster] = OrderedDict()
+        # Versions are kept after their roster is evicted: resetting one could make a
+        # connection holding an old roster believe nothing changed.
+        self._versions: dict[int, int] = {}
+
+    def version(self, chat_id: int) -> int:
+        return self._versions.get(chat_id, 0)
+
+    async def get(self, chat_id: int) -> ChatRoster | None:
+        version = self.version(chat_id)
+        roster = self._entries.get(chat_id)
+        if roster is not None and roster.version == version:
+            self._entries.move_to_end(chat_id)
+            return roster
+
+        loaded = await self.loader(chat_id)
+        if loaded is None:
+            self._entries.pop(chat_id, None)
+            return None
+
+        roster = ChatRoster(chat_id, version, *loaded)
+        # A bump that landed while the loader was running may not be reflected in what it read.
+        if self.version(chat_id) == version:
+            self._entries[chat_id] = roster
+            self._entries.move_to_end(chat_id)
+            while len(self._entries) > self.max_chats:
+                self._entries.popitem(last=False)
+        return roster
+
+    def bump(self, chat_id: int):
+        self._versions[chat_id] = self.version(chat_id) + 1
+        self._entries.pop(chat_id, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._versions.clear()
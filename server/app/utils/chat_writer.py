@@ -0,0 +1,77 @@
+import asyncio
+import logging
+import os
+from collections import deque
+
+
+logger = logging.getLogger("app.chat_writer")
+
+CHAT_WRITE_MAX_BATCH = int(os.getenv("CHAT_WRITE_MAX_BATCH", 100))
+
+
+class ChatWriteQueue:
+    """One ordered writer task per chat that turns concurrent submissions into group commits.
+
+    ``write_batch(chat_id, jobs)`` is awaited with every job queued since the previous
+    batch started, in submission order, and returns ``(results, fan_out)``: one result
+    per job, and a coroutine that delivers the batch, or ``None``. ``submit`` resolves as
+    soon as the batch is committed, so callers are only acknowledged after their write is
+    durable and a failing delivery cannot turn a saved message into an error. ``fan_out``
+    is awaited afterwards, before the next batch of the chat, to keep delivery in order.
+    """
+
+    def __init__(self, write_batch, *, max_batch: int = CHAT_WRITE_MAX_BATCH):
+        self.write_batch = write_batch
+        self.max_batch = max(1, max_batch)
+        # Keyed by loop as well: asyncio primitives cannot be shared between event loops.
+        self._pending: dict[tuple[asyncio.AbstractEventLoop, int], deque] = {}
+        self._writers: dict[tuple[asyncio.AbstractEventLoop, int], asyncio.Task] = {}
+        self.stats = {"batches": 0, "writes": 0, "max_batch_size": 0}
+
+    async def submit(self, chat_id: int, job):
+        loop = asyncio.get_running_loop()
+        key = (loop, chat_id)
+        future = loop.create_future()
+        self._pending.setdefault(key, deque()).append((job, future))
+        if key not in self._writers:
+            self._writers[key] = loop.create_task(self._run(key, chat_id))
+        # A sender that goes away mid-write must not cancel the batch its message is part of.
+        return await asyncio.shield(future)
+
+    def is_idle(self) -> bool:
+        return not self._writers
+
+    async def _run(self, key, chat_id: int):
+        queue = self._pending[key]
+        try:
+            while queue:
+                batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch))]
+                try:
+                    results, fan_out = await self.write_batch(chat_id, [job for job, _future in batch])
+                except BaseException as error:
+                    for _job, future in batch:
+                        if not future.done():
+                            future.set_exception(error if isinstance(error, Exception) else RuntimeError("Chat writer stopped"))
+                    if not isinstance(error, Exception):
+                        raise
+                    logger.exception("chat_write_batch_failed chat_id=%s size=%s", chat_id, len(batch))
+                    continue
+
+                self.stats["batches"] += 1
+                self.stats["writes"] += len(batch)
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+                for (_job, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+                if fan_out is not None:
+                    try:
+                        await fan_out
+                    except Exception:
+                        logger.exception("chat_fan_out_failed chat_id=%s size=%s", chat_id, len(batch))
+        finally:
+            self._writers.pop(key, None)
+            while queue:
+                _job, future = queue.popleft()
+                if not future.done():
+                    future.set_exception(RuntimeError("Chat writer stopped"))
+            self._pending.pop(key, None)
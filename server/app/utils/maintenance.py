@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+from datetime import timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy import delete, inspect, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.models import (
+    DeviceOneTimePreKey,
+    MaintenanceLease,
+    OneTimePreKey,
+    PasswordResetToken,
+    RateLimitCounter,
+    RefreshToken,
+)
+from app.db.session import AsyncSessionLocal
+from app.utils.time import utc_now
+
+
+logger = logging.getLogger("app.maintenance")
+
+MAINTENANCE_ENABLED = os.getenv("MAINTENANCE_ENABLED", "true").lower() in {"1", "true", "yes", "on"}
+MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_INTERVAL_SECONDS", 900))
+# Workers start staggered so a fresh deploy does not run every purge at the same moment.
+MAINTENANCE_INITIAL_DELAY_SECONDS = float(os.getenv("MAINTENANCE_INITIAL_DELAY_SECONDS", 60))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", 1000))
+MAINTENANCE_MAX_BATCHES = int(os.getenv("MAINTENANCE_MAX_BATCHES", 50))
+USED_PREKEY_RETENTION_DAYS = int(os.getenv("USED_PREKEY_RETENTION_DAYS", 7))
+
+JobRunner = Callable[[int, int], Awaitable[int]]
+
+
+class MaintenanceJob:
+    """A periodic cleanup; ``run(batch_size, max_batches)`` returns the number of rows or files removed."""
+
+    def __init__(self, name: str, run: JobRunner, *, interval_seconds: float = MAINTENANCE_INTERVAL_SECONDS):
+        self.name = name
+        self.run = run
+        self.interval_seconds = max(1.0, interval_seconds)
+
+
+def new_job_stats() -> dict:
+    return {
+        "runs": 0,
+        "skipped": 0,
+        "errors": 0,
+        "rows": 0,
+        "last_rows": 0,
+        "last_duration_ms": 0.0,
+        "max_duration_ms": 0.0,
+        "last_run_at": 0.0,
+    }
+
+
+async def try_acquire_lease(db: AsyncSession, job_name: str, owner: str, lease_seconds: float) -> bool:
+    """Take the job's lease if nobody holds an unexpired one; the lease also spaces runs across workers."""
+    now = utc_now()
+    dialect_insert = postgresql_insert if db.bind.dialect.name == "postgresql" else sqlite_insert
+    await db.execute(
+        dialect_insert(MaintenanceLease)
+        .values(job_name=job_name, owner="", expires_at=now)
+        .on_conflict_do_nothing(index_elements=[MaintenanceLease.job_name])
+    )
+    # The expiry check and the takeover are one statement, so two workers cannot both win.
+    result = await db.execute(
+        update(MaintenanceLease)
+        .where(MaintenanceLease.job_name == job_name, MaintenanceLease.expires_at <= now)
+        .values(owner=owner, expires_at=now + timedelta(seconds=lease_seconds), last_run_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def delete_in_batches(model, *conditions, batch_size: int, max_batches: int) -> int:
+    """Delete matching rows ``batch_size`` at a time, each batch in its own short transaction."""
+    key_column = inspect(model).primary_key[0]
+    total = 0
+    for _ in range(max(1, max_batches)):
+        batch = select(key_column).where(*conditions).order_by(key_column).limit(batch_size)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                delete(model)
+                .where(key_column.in_(batch.scalar_subquery()))
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        total += result.rowcount
+        if result.rowcount < batch_size:
+            break
+        # Let request handlers at the database between batches.
+        await asyncio.sleep(0)
+    return total
+
+
+async def purge_used_prekeys(batch_size: int, max_batches: int) -> int:
+    cutoff = utc_now() - timedelta(days=USED_PREKEY_RETENTION_DAYS)
+    return await delete_in_batches(
+        OneTimePreKey,
+        OneTimePreKey.used_at.is_not(None),
+        OneTimePreKey.used_at < cutoff,
+        batch_size=batch_size,
+        max_batches=max_batches,
+    )
+
+
+async def purge_used_device_prekeys(batch_size: int, max_batches: int) -> int:
+    cutoff = utc_now() - timedelta(days=USED_PREKEY_RETENTION_DAYS)
+    return await delete_in_batches(
+        DeviceOneTimePreKey,
+        DeviceOneTimePreKey.used_at.is_not(None),
+        DeviceOneTimePreKey.used_at < cutoff,
+        batch_size=batch_size,
+        max_batches=max_batches,
+    )
+
+
+async def purge_expired_refresh_tokens(batch_size: int, max_batches: int) -> int:
+    return await delete_in_batches(
+        RefreshToken,
+        RefreshToken.expires_at < utc_now(),
+        batch_size=batch_size,
+        max_batches=max_batches,
+    )
+
+
+async def purge_expired_password_reset_tokens(batch_size: int, max_batches: int) -> int:
+    # Used tokens are kept until they would have expired anyway, so a replayed link still reads as used.
+    return await delete_in_batches(
+        PasswordResetToken,
+        PasswordResetToken.expires_at < utc_now(),
+        batch_size=batch_size,
+        max_batches=max_batches,
+    )
+
+
+async def purge_expired_rate_limit_counters(batch_size: int, max_batches: int) -> int:
+    return await delete_in_batches(
+        RateLimitCounter,
+        RateLimitCounter.expires_at < utc_now(),
+        batch_size=batch_size,
+        max_batches=max_batches,
+    )
+
+
+def default_maintenance_jobs() -> list[MaintenanceJob]:
+    return [
+        MaintenanceJob("used_prekeys", purge_used_prekeys),
+        MaintenanceJob("used_device_prekeys", purge_used_device_prekeys),
+        MaintenanceJob("expired_refresh_tokens", purge_expired_refresh_tokens),
+        MaintenanceJob("expired_password_reset_tokens", purge_expired_password_reset_tokens),
+        MaintenanceJob("expired_rate_limit_counters", purge_expired_rate_limit_counters),
+    ]
+
+
+class MaintenanceScheduler:
+    """Runs cleanup jobs off the request path, one worker per job per interval.
+
+    Every worker runs the same loop; a row in ``maintenance_leases`` decides which of them
+    actually does the work. The lease lasts a whole interval, so whoever wins it also keeps
+    the others from repeating the job until the next one is due.
+    """
+
+    def __init__(
+        self,
+        jobs: list[MaintenanceJob],
+        *,
+        owner: str | None = None,
+        batch_size: int = MAINTENANCE_BATCH_SIZE,
+        max_batches: int = MAINTENANCE_MAX_BATCHES,
+        initial_delay_seconds: float = MAINTENANCE_INITIAL_DELAY_SECONDS,
+        enabled: bool = MAINTENANCE_ENABLED,
+    ):
+        self.jobs = {job.name: job for job in jobs}
+        self.owner = owner or uuid.uuid4().hex
+        self.batch_size = max(1, batch_size)
+        self.max_batches = max(1, max_batches)
+        self.initial_delay_seconds = initial_delay_seconds
+        self.enabled = enabled
+        self.stats = {name: new_job_stats() for name in self.jobs}
+        self._task: asyncio.Task | None = None
+
+    def add_job(self, job: MaintenanceJob):
+        self.jobs[job.name] = job
+        self.stats.setdefault(job.name, new_job_stats())
+
+    async def start(self):
+        if self.enabled and self.jobs and self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run_job(self, name: str) -> bool:
+        """Run one job now if this worker can take its lease; returns whether it ran."""
+        job = self.jobs[name]
+        stats = self.stats[name]
+        async with AsyncSessionLocal() as db:
+            acquired = await try_acquire_lease(db, name, self.owner, job.interval_seconds)
+        if not acquired:
+            stats["skipped"] += 1
+            return False
+
+        started_at = time.perf_counter()
+        try:
+            rows = await job.run(self.batch_size, self.max_batches)
+        except Exception:
+            stats["errors"] += 1
+            logger.exception("maintenance_job_failed job=%s", name)
+            return False
+        finally:
+            duration_ms = round((time.perf_counter() - started_at) * 1000, 2)
+            stats["last_duration_ms"] = duration_ms
+            stats["max_duration_ms"] = max(stats["max_duration_ms"], duration_ms)
+            stats["last_run_at"] = time.time()
+        stats["runs"] += 1
+        stats["rows"] += rows
+        stats["last_rows"] = rows
+        if rows:
+            logger.info("maintenance_job_done job=%s rows=%s duration_ms=%s", name, rows, duration_ms)
+        return True
+
+    async def run_due(self, due_at: dict[str, float]):
+        now = time.monotonic()
+        for name, job in self.jobs.items():
+            if due_at.get(name, 0.0) > now:
+                continue
+            try:
+                await self.run_job(name)
+            except Exception:
+                # Lease bookkeeping failed (database away); try again next interval.
+                self.stats[name]["errors"] += 1
+                logger.exception("maintenance_lease_failed job=%s", name)
+            due_at[name] = time.monotonic() + job.interval_seconds
+
+    async def _run_forever(self):
+        await asyncio.sleep(self.initial_delay_seconds * (1 + random.random()))
+        due_at: dict[str, float] = {}
+        while True:
+            await self.run_due(due_at)
+            next_due = min(due_at.values(), default=time.monotonic() + MAINTENANCE_INTERVAL_SECONDS)
+            await asyncio.sleep(max(1.0, next_due - time.monotonic()))
+
+    def get_metrics(self) -> dict:
+        return {
+            f"maintenance_{name}_{key}": value
+            for name, stats in self.stats.items()
+            for key, value in stats.items()
+        }
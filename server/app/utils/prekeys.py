@@ -0,0 +1,113 @@
+from typing import Iterable
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.db.models import Device, DeviceOneTimePreKey, OneTimePreKey
+from app.utils.time import utc_now
+
+
+# Claims are a single UPDATE ... RETURNING whose target is picked by a subquery. On Postgres the
+# subquery locks its row with FOR UPDATE SKIP LOCKED, so concurrent claims for the same owner each
+# take a different key instead of queueing on the first one. SQLite runs one writer at a time and
+# renders no locking clause; the statement is atomic there on its own. Either way a key is marked
+# used in the same statement that selects it, so no two callers can be handed the same key.
+
+
+def _next_unused(model, owner_column, owner):
+    return (
+        select(model.id)
+        .where(owner_column == owner, model.used_at.is_(None))
+        .order_by(model.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+
+
+def _next_unused_per_device(device_ids: list[str], *, lock: bool):
+    candidate = aliased(DeviceOneTimePreKey)
+    next_key = (
+        select(candidate.id)
+        .where(candidate.device_id == Device.device_id, candidate.used_at.is_(None))
+        .order_by(candidate.id)
+        .limit(1)
+    )
+    if lock:
+        next_key = next_key.with_for_update(skip_locked=True)
+    # One correlated pick per device row; devices.device_id is unique, so each device yields at most one key.
+    return select(next_key.scalar_subquery()).where(Device.device_id.in_(device_ids))
+
+
+def _claim_payload(row) -> dict:
+    return {"key_id": row.key_id, "public_key": row.public_key}
+
+
+async def claim_user_prekey(db: AsyncSession, user_id: int) -> dict | None:
+    """Mark the user's oldest unused one-time prekey as used and return it; the caller commits."""
+    result = await db.execute(
+        update(OneTimePreKey)
+        .where(
+            OneTimePreKey.id == _next_unused(OneTimePreKey, OneTimePreKey.user_id, user_id),
+            OneTimePreKey.used_at.is_(None),
+        )
+        .values(used_at=utc_now())
+        .returning(OneTimePreKey.key_id, OneTimePreKey.public_key)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    return _claim_payload(row) if row else None
+
+
+async def claim_device_prekey(db: AsyncSession, device_id: str) -> dict | None:
+    """Single-device form of ``claim_device_prekeys``."""
+    result = await db.execute(
+        update(DeviceOneTimePreKey)
+        .where(
+            DeviceOneTimePreKey.id == _next_unused(DeviceOneTimePreKey, DeviceOneTimePreKey.device_id, device_id),
+            DeviceOneTimePreKey.used_at.is_(None),
+        )
+        .values(used_at=utc_now())
+        .returning(DeviceOneTimePreKey.key_id, DeviceOneTimePreKey.public_key)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    return _claim_payload(row) if row else None
+
+
+async def claim_device_prekeys(db: AsyncSession, device_ids: Iterable[str]) -> dict[str, dict]:
+    """Claim one one-time prekey for each device in one statement; the caller commits.
+
+    Devices that have run out of keys are missing from the result.
+    """
+    device_ids = list(dict.fromkeys(device_ids))
+    if not device_ids:
+        return {}
+    if len(device_ids) == 1:
+        claimed = await claim_device_prekey(db, device_ids[0])
+        return {device_ids[0]: claimed} if claimed else {}
+
+    result = await db.execute(
+        update(DeviceOneTimePreKey)
+        .where(
+            DeviceOneTimePreKey.id.in_(_next_unused_per_device(device_ids, lock=True)),
+            DeviceOneTimePreKey.used_at.is_(None),
+        )
+        .values(used_at=utc_now())
+        .returning(DeviceOneTimePreKey.device_id, DeviceOneTimePreKey.key_id, DeviceOneTimePreKey.public_key)
+        .execution_options(synchronize_session=False)
+    )
+    return {row.device_id: _claim_payload(row) for row in result.all()}
+
+
+async def peek_device_prekeys(db: AsyncSession, device_ids: Iterable[str]) -> dict[str, dict]:
+    """The key ``claim_device_prekeys`` would hand out next for each device, without claiming it."""
+    device_ids = list(dict.fromkeys(device_ids))
+    if not device_ids:
+        return {}
+    result = await db.execute(
+        select(DeviceOneTimePreKey.device_id, DeviceOneTimePreKey.key_id, DeviceOneTimePreKey.public_key)
+        .where(DeviceOneTimePreKey.id.in_(_next_unused_per_device(device_ids, lock=False)))
+    )
+    return {row.device_id: _claim_payload(row) for row in result.all()}
@@ -0,0 +1,98 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from sqlalchemy import or_, select, union
+
+from app.db.models import Chat, ChatParticipant
+from app.db.session import AsyncSessionLocal
+
+
+logger = logging.getLogger("app.presence")
+
+CONTACT_CACHE_TTL_SECONDS = float(os.getenv("PRESENCE_CONTACT_CACHE_TTL_SECONDS", 300))
+CONTACT_CACHE_MAX_USERS = int(os.getenv("PRESENCE_CONTACT_CACHE_MAX_USERS", 10000))
+PRESENCE_DEBOUNCE_SECONDS = float(os.getenv("PRESENCE_DEBOUNCE_SECONDS", 0.25))
+
+ChatMembersLoader = Callable[[int], Awaitable[dict[int, set[int]]]]
+
+
+async def load_user_chat_members(user_id: int) -> dict[int, set[int]]:
+    chat_ids = union(
+        select(ChatParticipant.chat_id.label("chat_id")).where(ChatParticipant.user_id == user_id),
+        select(Chat.id.label("chat_id")).where(
+            Chat.is_group.is_(False),
+            or_(Chat.user1_id == user_id, Chat.user2_id == user_id),
+        ),
+    ).subquery()
+
+    members: dict[int, set[int]] = {}
+    async with AsyncSessionLocal() as db:
+        participant_rows = await db.execute(
+            select(ChatParticipant.chat_id, ChatParticipant.user_id).where(
+                ChatParticipant.chat_id.in_(select(chat_ids.c.chat_id))
+            )
+        )
+        for chat_id, member_id in participant_rows:
+            members.setdefault(chat_id, set()).add(member_id)
+
+        # Older direct chats may predate their participant rows.
+        direct_rows = await db.execute(
+            select(Chat.id, Chat.user1_id, Chat.user2_id).where(
+                Chat.id.in_(select(chat_ids.c.chat_id)),
+                Chat.is_group.is_(False),
+            )
+        )
+        for chat_id, user1_id, user2_id in direct_rows:
+            members.setdefault(chat_id, set()).update(
+                member_id for member_id in (user1_id, user2_id) if member_id
+            )
+
+    return members
+
+
+class ContactGraph:
+    """Per-user cache of the chats a user is in and who else is in them."""
+
+    def __init__(
+        self,
+        loader: ChatMembersLoader = load_user_chat_members,
+        *,
+        ttl_seconds: float = CONTACT_CACHE_TTL_SECONDS,
+        max_users: int = CONTACT_CACHE_MAX_USERS,
+    ):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max(1, max_users)
+        self._entries: OrderedDict[int, tuple[float, dict[int, set[int]]]] = OrderedDict()
+
+    async def get_chat_members(self, user_id: int) -> dict[int, set[int]]:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            return entry[1]
+
+        chat_members = await self.loader(user_id)
+        self._entries[user_id] = (time.monotonic() + self.ttl_seconds, chat_members)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return chat_members
+
+    def invalidate_users(self, user_ids):
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+
+    def invalidate_chat(self, chat_id: int, user_ids=()):
+        # Members that just joined have no cached entry mentioning the chat yet, so callers pass them in.
+        stale_user_ids = {
+            user_id
+            for user_id, (_expires_at, chat_members) in self._entries.items()
+            if chat_id in chat_members
+        }
+        self.invalidate_users(stale_user_ids | set(user_ids))
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import time
+from pathlib import Path
+from typing import AsyncIterator
+
+from starlette.concurrency import run_in_threadpool
+
+from app.utils.uploads import UPLOAD_CHUNK_SIZE_BYTES, UploadTooLargeError
+
+
+RESUMABLE_UPLOAD_CHUNK_SIZE_BYTES = int(os.getenv("RESUMABLE_UPLOAD_CHUNK_SIZE_BYTES", 4 * 1024 * 1024))
+RESUMABLE_UPLOAD_MAX_CHUNKS = int(os.getenv("RESUMABLE_UPLOAD_MAX_CHUNKS", 10000))
+
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+SESSION_FILE = "session.json"
+
+
+class UploadSessionNotFound(LookupError):
+    pass
+
+
+class UploadSessionError(ValueError):
+    pass
+
+
+def _chunk_name(index: int) -> str:
+    return f"{index:06d}.chunk"
+
+
+class ResumableUploadStore:
+    """Upload sessions kept on disk, so any worker sharing the directory can resume them.
+
+    Each session is a directory holding ``session.json`` and one file per received
+    chunk. Chunks are written under a temporary name and renamed when complete, so
+    a chunk file that exists is always whole.
+    """
+
+    def __init__(self, root: Path, *, chunk_size: int | None = None):
+        self.root = root
+        self.chunk_size = max(1, chunk_size or RESUMABLE_UPLOAD_CHUNK_SIZE_BYTES)
+
+    def create(self, *, user_id: int, chat_id: int, size: int, max_size: int, details: dict, sha256: str | None = None) -> dict:
+        if size <= 0:
+            raise UploadSessionError("Upload size must be positive")
+        if size > max_size:
+            raise UploadSessionError("Attachment is too large")
+        if sha256 is not None and not SHA256_PATTERN.match(sha256):
+            raise UploadSessionError("Invalid sha256")
+        chunk_count = -(-size // self.chunk_size)
+        if chunk_count > RESUMABLE_UPLOAD_MAX_CHUNKS:
+            raise UploadSessionError("Too many chunks")
+
+        session = {
+            "upload_id": secrets.token_hex(16),
+            "user_id": user_id,
+            "chat_id": chat_id,
+            "size": size,
+            "chunk_size": self.chunk_size,
+            "chunk_count": chunk_count,
+            "sha256": sha256,
+            "details": details,
+            "created_at": time.time(),
+        }
+        directory = self.root / session["upload_id"]
+        directory.mkdir(parents=True)
+        (directory / SESSION_FILE).write_text(json.dumps(session), encoding="utf-8")
+        return session
+
+    def load(self, upload_id: str, user_id: int) -> dict:
+        if not UPLOAD_ID_PATTERN.match(upload_id or ""):
+            raise UploadSessionNotFound(upload_id)
+        try:
+            session = json.loads((self.root / upload_id / SESSION_FILE).read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            raise UploadSessionNotFound(upload_id) from None
+        # Someone else's session looks exactly like a missing one.
+        if session.get("user_id") != user_id:
+            raise UploadSessionNotFound(upload_id)
+        return session
+
+    def received_chunks(self, session: dict) -> list[int]:
+        directory = self.root / session["upload_id"]
+        received = []
+        for path in directory.glob("*.chunk"):
+            try:
+                received.append(int(path.stem))
+            except ValueError:
+                continue
+        return sorted(index for index in received if 0 <= index < session["chunk_count"])
+
+    def describe(self, session: dict) -> dict:
+        received = self.received_chunks(session)
+        return {
+            "upload_id": session["upload_id"],
+            "size": session["size"],
+            "chunk_size": session["chunk_size"],
+            "chunk_count": session["chunk_count"],
+            "received_chunks": received,
+            "complete": len(received) == session["chunk_count"],
+        }
+
+    def expected_chunk_length(self, session: dict, index: int) -> int:
+        if not 0 <= index < session["chunk_count"]:
+            raise UploadSessionError("Chunk index out of range")
+        return min(session["chunk_size"], session["size"] - index * session["chunk_size"])
+
+    async def write_chunk(self, session: dict, index: int, body: AsyncIterator[bytes], *, offset: int | None = None) -> int:
+        expected_length = self.expected_chunk_length(session, index)
+        if offset is not None and offset != index * session["chunk_size"]:
+            raise UploadSessionError("Chunk offset does not match its index")
+
+        directory = self.root / session["upload_id"]
+        partial = directory / f".{_chunk_name(index)}.{secrets.token_hex(4)}.part"
+        handle = await run_in_threadpool(open, partial, "wb")
+        written = 0
+        try:
+            async for piece in body:
+                if not piece:
+                    continue
+                written += len(piece)
+                if written > expected_length:
+                    raise UploadTooLargeError("Chunk is larger than announced")
+                await run_in_threadpool(handle.write, piece)
+            await run_in_threadpool(handle.close)
+            if written != expected_length:
+                raise UploadSessionError("Chunk is incomplete")
+            # Re-sending a chunk simply replaces it, which is what a client retrying after a timeout does.
+            await run_in_threadpool(os.replace, partial, directory / _chunk_name(index))
+        except BaseException:
+            handle.close()
+            partial.unlink(missing_ok=True)
+            raise
+        return written
+
+    def assemble(self, session: dict, destination: Path) -> tuple[int, str]:
+        """Concatenate the chunks into ``destination``; blocking, run it in the threadpool."""
+        if len(self.received_chunks(session)) != session["chunk_count"]:
+            raise UploadSessionError("Upload is missing chunks")
+
+        directory = self.root / session["upload_id"]
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        partial = destination.with_name(f".{destination.name}.part")
+        hasher = hashlib.sha256()
+        size = 0
+        try:
+            with open(partial, "wb") as output:
+                for index in range(session["chunk_count"]):
+                    with open(directory / _chunk_name(index), "rb") as chunk:
+                        while piece := chunk.read(UPLOAD_CHUNK_SIZE_BYTES):
+                            hasher.update(piece)
+                            output.write(piece)
+                            size += len(piece)
+            digest = hasher.hexdigest()
+            if size != session["size"]:
+                raise UploadSessionError("Upload size does not match")
+            if session.get("sha256") and session["sha256"] != digest:
+                raise UploadSessionError("Upload checksum does not match")
+            os.replace(partial, destination)
+        except BaseException:
+            partial.unlink(missing_ok=True)
+            raise
+        return size, digest
+
+    def discard(self, session: dict):
+        shutil.rmtree(self.root / session["upload_id"], ignore_errors=True)
+
+    def purge_stale(self, max_age_seconds: float, *, limit: int) -> int:
+        """Discard at most ``limit`` sessions started more than ``max_age_seconds`` ago; blocking."""
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        try:
+            entries = os.scandir(self.root)
+        except FileNotFoundError:
+            return 0
+        with entries:
+            for entry in entries:
+                if removed >= limit:
+                    break
+                if not UPLOAD_ID_PATTERN.match(entry.name) or not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    created_at = json.loads(Path(entry.path, SESSION_FILE).read_text(encoding="utf-8"))["created_at"]
+                except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+                    # A session directory without readable metadata was cut off while being created.
+                    created_at = entry.stat(follow_symlinks=False).st_mtime
+                if created_at < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed += 1
+        return removed
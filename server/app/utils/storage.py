@@ -0,0 +1,288 @@
+import os
+import secrets
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import boto3
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").strip().lower()
+# Empty means AWS itself; set it for MinIO and other S3-compatible services.
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "")
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+# Leave the keys empty to use boto3's credential chain: AWS_* variables, a shared profile,
+# web identity tokens, or the ECS/EC2 instance role.
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "")
+S3_SESSION_TOKEN = os.getenv("S3_SESSION_TOKEN", "")
+# MinIO and most self-hosted stand-ins only route path-style requests; "virtual" or "auto" for AWS.
+S3_ADDRESSING_STYLE = os.getenv("S3_ADDRESSING_STYLE", "path").strip().lower()
+S3_PUBLIC_BASE_URL = os.getenv("S3_PUBLIC_BASE_URL", "")
+S3_PRESIGN_EXPIRES_SECONDS = int(os.getenv("S3_PRESIGN_EXPIRES_SECONDS", 300))
+S3_MULTIPART_PART_SIZE_BYTES = max(5 * 1024 * 1024, int(os.getenv("S3_MULTIPART_PART_SIZE_BYTES", 8 * 1024 * 1024)))
+S3_TIMEOUT_SECONDS = float(os.getenv("S3_TIMEOUT_SECONDS", 30))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 3))
+UPLOAD_SPOOL_DIR = Path(os.getenv("UPLOAD_SPOOL_DIR", tempfile.gettempdir())) / "message-uploads"
+
+
+class StorageError(OSError):
+    pass
+
+
+def check_storage_key(key: str) -> str:
+    parts = key.split("/")
+    if not key or any(part in {"", ".", ".."} or part.startswith(".") for part in parts):
+        raise ValueError(f"Invalid storage key: {key!r}")
+    return key
+
+
+class S3Client:
+    """The handful of S3 object calls the storage driver needs, on one boto3 client.
+
+    boto3 signs, retries throttled and failed requests, adds checksums and resolves
+    credentials, including session tokens and instance roles.
+    """
+
+    def __init__(
+        self,
+        endpoint_url: str,
+        bucket: str,
+        *,
+        region: str,
+        access_key_id: str = "",
+        secret_access_key: str = "",
+        session_token: str = "",
+        addressing_style: str = "path",
+        timeout: float = S3_TIMEOUT_SECONDS,
+        max_attempts: int = S3_MAX_ATTEMPTS,
+    ):
+        if not bucket:
+            raise StorageError("S3 storage needs S3_BUCKET")
+        self.bucket = bucket
+        session = boto3.session.Session(
+            aws_access_key_id=access_key_id or None,
+            aws_secret_access_key=secret_access_key or None,
+            aws_session_token=session_token or None,
+            region_name=region,
+        )
+        # boto3 clients are thread-safe, so the threadpool workers share this one and its connection pool.
+        self.client = session.client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            config=BotoConfig(
+                s3={"addressing_style": addressing_style},
+                signature_version="s3v4",
+                retries={"total_max_attempts": max_attempts, "mode": "standard"},
+                connect_timeout=timeout,
+                read_timeout=timeout,
+            ),
+        )
+
+    def _call(self, operation: str, key: str, *, ignore_codes: tuple[str, ...] = (), **params) -> dict:
+        try:
+            return getattr(self.client, operation)(Bucket=self.bucket, Key=check_storage_key(key), **params)
+        except ClientError as exc:
+            if exc.response.get("Error", {}).get("Code") in ignore_codes:
+                return {}
+            raise StorageError(f"S3 {operation} {key} failed: {exc}") from exc
+        except BotoCoreError as exc:
+            raise StorageError(f"S3 {operation} {key} failed: {exc}") from exc
+
+    def put_object(self, key: str, content: bytes, *, content_type: str | None = None):
+        extra = {"ContentType": content_type} if content_type else {}
+        self._call("put_object", key, Body=content, **extra)
+
+    def create_multipart_upload(self, key: str, *, content_type: str | None = None) -> str:
+        extra = {"ContentType": content_type} if content_type else {}
+        return self._call("create_multipart_upload", key, **extra)["UploadId"]
+
+    def upload_part(self, key: str, upload_id: str, part_number: int, content: bytes) -> str:
+        response = self._call("upload_part", key, UploadId=upload_id, PartNumber=part_number, Body=content)
+        return response["ETag"]
+
+    def complete_multipart_upload(self, key: str, upload_id: str, etags: list[str]):
+        parts = [{"PartNumber": number, "ETag": etag} for number, etag in enumerate(etags, start=1)]
+        self._call("complete_multipart_upload", key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+
+    def abort_multipart_upload(self, key: str, upload_id: str):
+        self._call("abort_multipart_upload", key, UploadId=upload_id, ignore_codes=("NoSuchUpload",))
+
+    def delete_object(self, key: str):
+        # S3 answers 204 whether or not the object existed.
+        self._call("delete_object", key)
+
+    def presigned_get_url(self, key: str, *, expires_seconds: int, content_type: str | None = None) -> str:
+        params = {"Bucket": self.bucket, "Key": check_storage_key(key)}
+        if content_type:
+            params["ResponseContentType"] = content_type
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=expires_seconds)
+
+
+def purge_stale_spool_files(spool_dir: Path, max_age_seconds: float, *, limit: int) -> int:
+    """Remove at most ``limit`` spooled uploads older than ``max_age_seconds``; blocking.
+
+    A spool file normally lives only as long as its upload request, so an old one was left
+    behind by a worker that crashed or was killed mid-upload.
+    """
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    try:
+        entries = os.scandir(spool_dir)
+    except FileNotFoundError:
+        return 0
+    with entries:
+        for entry in entries:
+            if removed >= limit:
+                break
+            try:
+                if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return removed
+
+
+class LocalStorage:
+    """Objects as files under ``root``, served by the app itself."""
+
+    def __init__(self, root: Path, url_prefix: str):
+        self.root = root
+        self.url_prefix = url_prefix.rstrip("/") + "/"
+        # Same filesystem as the objects, so storing a spooled upload is a rename rather than a copy.
+        self.spool_dir = root / ".incoming"
+
+    def local_path(self, key: str) -> Path:
+        return self.root / check_storage_key(key)
+
+    def spool_path(self, suffix: str = "") -> Path:
+        return self.spool_dir / f"{secrets.token_hex(16)}{suffix}"
+
+    def put_file(self, key: str, source: Path, *, content_type: str | None = None):
+        destination = self.local_path(key)
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, destination)
+
+    def put_bytes(self, key: str, content: bytes, *, content_type: str | None = None):
+        spooled = self.spool_path()
+        spooled.parent.mkdir(parents=True, exist_ok=True)
+        spooled.write_bytes(content)
+        self.put_file(key, spooled, content_type=content_type)
+
+    def delete(self, key: str):
+        self.local_path(key).unlink(missing_ok=True)
+
+    def public_url(self, key: str) -> str:
+        return f"{self.url_prefix}{check_storage_key(key)}"
+
+    def download_url(self, key: str, *, content_type: str | None = None) -> str | None:
+        # Files are streamed by the app; there is nothing to redirect to.
+        return None
+
+
+class S3Storage:
+    """Objects under ``prefix`` in an S3-compatible bucket; clients download from presigned URLs."""
+
+    def __init__(
+        self,
+        client: S3Client,
+        prefix: str,
+        *,
+        spool_dir: Path | None = None,
+        part_size: int | None = None,
+        public_base_url: str | None = None,
+        presign_expires_seconds: int | None = None,
+    ):
+        self.client = client
+        self.prefix = prefix.strip("/") + "/"
+        self.spool_dir = spool_dir or UPLOAD_SPOOL_DIR
+        self.part_size = part_size or S3_MULTIPART_PART_SIZE_BYTES
+        self.public_base_url = (S3_PUBLIC_BASE_URL if public_base_url is None else public_base_url).rstrip("/")
+        self.presign_expires_seconds = presign_expires_seconds or S3_PRESIGN_EXPIRES_SECONDS
+
+    def object_key(self, key: str) -> str:
+        return f"{self.prefix}{check_storage_key(key)}"
+
+    def local_path(self, key: str) -> None:
+        return None
+
+    def spool_path(self, suffix: str = "") -> Path:
+        return self.spool_dir / f"{secrets.token_hex(16)}{suffix}"
+
+    def put_file(self, key: str, source: Path, *, content_type: str | None = None):
+        """Upload ``source`` and remove it; files over one part go up as a multipart upload."""
+        object_key = self.object_key(key)
+        try:
+            with open(source, "rb") as handle:
+                first_part = handle.read(self.part_size)
+                next_part = handle.read(self.part_size)
+                if not next_part:
+                    self.client.put_object(object_key, first_part, content_type=content_type)
+                    return
+
+                # Only one part is held in memory at a time, whatever the file size.
+                upload_id = self.client.create_multipart_upload(object_key, content_type=content_type)
+                try:
+                    etags = [self.client.upload_part(object_key, upload_id, 1, first_part)]
+                    while next_part:
+                        etags.append(self.client.upload_part(object_key, upload_id, len(etags) + 1, next_part))
+                        next_part = handle.read(self.part_size)
+                    self.client.complete_multipart_upload(object_key, upload_id, etags)
+                except BaseException:
+                    self.client.abort_multipart_upload(object_key, upload_id)
+                    raise
+        finally:
+            source.unlink(missing_ok=True)
+
+    def put_bytes(self, key: str, content: bytes, *, content_type: str | None = None):
+        self.client.put_object(self.object_key(key), content, content_type=content_type)
+
+    def delete(self, key: str):
+        self.client.delete_object(self.object_key(key))
+
+    def public_url(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url}/{self.object_key(key)}"
+        return self.download_url(key)
+
+    def download_url(self, key: str, *, content_type: str | None = None) -> str:
+        return self.client.presigned_get_url(
+            self.object_key(key),
+            expires_seconds=self.presign_expires_seconds,
+            content_type=content_type,
+        )
+
+
+_s3_client: S3Client | None = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client() -> S3Client:
+    # One client per process, so every storage area shares the connection pool.
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = S3Client(
+                S3_ENDPOINT_URL,
+                S3_BUCKET,
+                region=S3_REGION,
+                access_key_id=S3_ACCESS_KEY_ID,
+                secret_access_key=S3_SECRET_ACCESS_KEY,
+                session_token=S3_SESSION_TOKEN,
+                addressing_style=S3_ADDRESSING_STYLE,
+            )
+        return _s3_client
+
+
+def build_storage(area: str, local_root: Path, url_prefix: str) -> LocalStorage | S3Storage:
+    """Storage for one kind of upload; ``area`` becomes the key prefix in a shared bucket."""
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(get_s3_client(), area)
+    if STORAGE_BACKEND != "local":
+        raise StorageError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}")
+    return LocalStorage(local_root, url_prefix)
@@ -0,0 +1,174 @@
+import hashlib
+import os
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+
+UPLOAD_CHUNK_SIZE_BYTES = int(os.getenv("UPLOAD_CHUNK_SIZE_BYTES", 256 * 1024))
+# Plain form fields sent next to a file (chat id, flags, CSRF token) are tiny; anything bigger is refused.
+UPLOAD_FORM_FIELD_MAX_BYTES = int(os.getenv("UPLOAD_FORM_FIELD_MAX_BYTES", 4096))
+# Room for boundaries, part headers and those fields on top of the file itself.
+UPLOAD_FORM_OVERHEAD_BYTES = int(os.getenv("UPLOAD_FORM_OVERHEAD_BYTES", 64 * 1024))
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+class ReceivedUpload:
+    __slots__ = ("fields", "filename", "content_type", "size", "sha256")
+
+    def __init__(self, fields: dict[str, str], filename: str | None, content_type: str | None, size: int, sha256: str):
+        self.fields = fields
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.sha256 = sha256
+
+
+def _write_chunk(handle, hasher, chunk: bytes):
+    # hashlib releases the GIL for large buffers, so hashing here keeps it off the event loop too.
+    hasher.update(chunk)
+    handle.write(chunk)
+
+
+def _discard_partial(handle, partial: Path):
+    handle.close()
+    partial.unlink(missing_ok=True)
+
+
+def _multipart_events(boundary: bytes) -> tuple[MultipartParser, list]:
+    """A parser whose callbacks queue ``(event, value)`` pairs for the caller to act on after each write."""
+    events: list = []
+    header = {"field": b"", "value": b"", "headers": {}}
+
+    def on_part_begin():
+        header["headers"] = {}
+
+    def on_header_field(data: bytes, start: int, end: int):
+        header["field"] += data[start:end]
+
+    def on_header_value(data: bytes, start: int, end: int):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        header["headers"][header["field"].decode("latin-1").lower()] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished():
+        events.append(("headers", header["headers"]))
+
+    def on_part_data(data: bytes, start: int, end: int):
+        events.append(("data", data[start:end]))
+
+    def on_part_end():
+        events.append(("end", None))
+
+    callbacks = {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    }
+    return MultipartParser(boundary, callbacks), events
+
+
+async def receive_multipart_upload(
+    request: Request,
+    destination: Path,
+    *,
+    max_bytes: int,
+    file_field: str = "file",
+    before_file: Callable[[dict[str, str], str | None, str | None], Awaitable[None]] | None = None,
+) -> ReceivedUpload:
+    """Parse a ``multipart/form-data`` body as it arrives, writing the ``file_field`` part to ``destination``.
+
+    The file is hashed and written once, straight from the socket, and the limit is checked
+    as data arrives; a ``Content-Length`` that cannot fit is refused before any of the body
+    is read. ``before_file(fields, filename, content_type)`` is awaited with the fields sent
+    ahead of the file, before its first byte is written, so a caller can still turn the
+    upload away cheaply. The file only appears under its final name once complete.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type"))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("Expected a multipart/form-data upload")
+    max_body_bytes = max_bytes + UPLOAD_FORM_OVERHEAD_BYTES
+    declared_length = request.headers.get("content-length", "")
+    if declared_length.isdigit() and int(declared_length) > max_body_bytes:
+        raise UploadTooLargeError(f"Upload exceeds {max_bytes} bytes")
+
+    parser, events = _multipart_events(boundary)
+    partial = destination.with_name(f".{destination.name}.part")
+    fields: dict[str, str] = {}
+    field_name = None
+    field_value = bytearray()
+    handle = None
+    in_file = file_done = False
+    filename = file_content_type = None
+    hasher = hashlib.sha256()
+    received = size = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > max_body_bytes:
+                raise UploadTooLargeError(f"Upload exceeds {max_bytes} bytes")
+            try:
+                parser.write(chunk)
+            except MultipartParseError as exc:
+                raise ValueError("Malformed multipart upload") from exc
+
+            file_data = []
+            for event, value in events:
+                if event == "headers":
+                    _disposition, disposition = parse_options_header(value.get("content-disposition"))
+                    name = disposition.get(b"name", b"").decode("utf-8", "replace")
+                    if name == file_field and b"filename" in disposition:
+                        if handle is not None:
+                            raise ValueError("Only one file can be uploaded at a time")
+                        filename = disposition[b"filename"].decode("utf-8", "replace")
+                        file_content_type = value.get("content-type", b"").decode("latin-1") or None
+                        if before_file is not None:
+                            await before_file(fields, filename, file_content_type)
+                        await run_in_threadpool(destination.parent.mkdir, parents=True, exist_ok=True)
+                        handle = await run_in_threadpool(open, partial, "wb")
+                        in_file = True
+                    else:
+                        field_name = name
+                        field_value.clear()
+                elif event == "data":
+                    if in_file:
+                        size += len(value)
+                        if size > max_bytes:
+                            raise UploadTooLargeError(f"Upload exceeds {max_bytes} bytes")
+                        file_data.append(value)
+                    else:
+                        field_value += value
+                        if len(field_value) > UPLOAD_FORM_FIELD_MAX_BYTES:
+                            raise ValueError("Form field is too large")
+                elif in_file:
+                    in_file, file_done = False, True
+                else:
+                    fields[field_name] = field_value.decode("utf-8", "replace")
+            events.clear()
+            if file_data:
+                await run_in_threadpool(_write_chunk, handle, hasher, b"".join(file_data))
+
+        parser.finalize()
+        if not file_done:
+            raise ValueError("No file was uploaded")
+        await run_in_threadpool(handle.close)
+        await run_in_threadpool(os.replace, partial, destination)
+    except BaseException:
+        if handle is not None:
+            _discard_partial(handle, partial)
+        raise
+    return ReceivedUpload(fields, filename, file_content_type, size, hasher.hexdigest())
@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.db.models import User
+
+
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 30))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000))
+
+UserCacheKey = tuple[str, str | None]
+
+
+class UserCache:
+    """Authenticated users keyed on the access token's ``sub`` and account instance."""
+
+    def __init__(self, *, ttl_seconds: float = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict[UserCacheKey, tuple[float, dict]] = OrderedDict()
+        self._keys_by_sub: dict[str, set[UserCacheKey]] = {}
+        self._keys_by_user_id: dict[int, set[UserCacheKey]] = {}
+        # Sync endpoints invalidate from threadpool workers while async code reads on the loop.
+        self._lock = threading.Lock()
+
+    def get(self, key: UserCacheKey) -> User | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            values = entry[1]
+
+        # Every request gets its own detached instance, so a handler that adds it to a session cannot affect others.
+        user = User(**values)
+        make_transient_to_detached(user)
+        return user
+
+    def set(self, key: UserCacheKey, user: User):
+        values = {attribute.key: getattr(user, attribute.key) for attribute in sa_inspect(User).column_attrs}
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, values)
+            self._keys_by_sub.setdefault(key[0], set()).add(key)
+            self._keys_by_user_id.setdefault(values["id"], set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int | None = None, *, email: str | None = None):
+        with self._lock:
+            keys = set(self._keys_by_user_id.get(user_id, ())) if user_id is not None else set()
+            if email is not None:
+                keys |= self._keys_by_sub.get(email, set())
+            for key in keys:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_sub.clear()
+            self._keys_by_user_id.clear()
+
+    def _drop(self, key: UserCacheKey):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for index, index_key in ((self._keys_by_sub, key[0]), (self._keys_by_user_id, entry[1]["id"])):
+            keys = index.get(index_key)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                index.pop(index_key)
+
+
+user_cache = UserCache()
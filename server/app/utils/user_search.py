@@ -0,0 +1,152 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import column, func, select, table
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app.db.models import User
+from app.utils.avatar import build_avatar_props
+
+
+logger = logging.getLogger("app.user_search")
+
+USER_SEARCH_LIMIT = int(os.getenv("USER_SEARCH_LIMIT", 10))
+USER_SEARCH_MAX_QUERY_LENGTH = int(os.getenv("USER_SEARCH_MAX_QUERY_LENGTH", 64))
+USER_SEARCH_CACHE_TTL_SECONDS = float(os.getenv("USER_SEARCH_CACHE_TTL_SECONDS", 30))
+USER_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("USER_SEARCH_CACHE_MAX_ENTRIES", 2048))
+# Trigram indexes cannot answer substring queries shorter than a trigram; those get prefix matches only.
+MIN_SUBSTRING_QUERY_LENGTH = 3
+
+# Greater than any character a username can contain, so [prefix, prefix + this) is exactly the prefix range.
+PREFIX_RANGE_END = "\U0010ffff"
+
+# SQLite's trigram shadow table, see app/db/search_index.py.
+users_search = table("users_search", column("rowid"), column("username"))
+
+
+class UserSearchCache:
+    """Recent search results keyed on the normalized query, shared by everyone searching.
+
+    Typing produces the same short prefixes over and over, so a small cache absorbs most of
+    the keystrokes. Entries hold one result more than a page, which leaves a full page once
+    the searcher's own account is filtered out.
+    """
+
+    def __init__(
+        self,
+        *,
+        ttl_seconds: float = USER_SEARCH_CACHE_TTL_SECONDS,
+        max_entries: int = USER_SEARCH_CACHE_MAX_ENTRIES,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> list[dict] | None:
+        with self._lock:
+            entry = self._entries.get(query)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._entries.pop(query, None)
+                return None
+            self._entries.move_to_end(query)
+            return entry[1]
+
+    def set(self, query: str, results: list[dict]):
+        with self._lock:
+            self._entries[query] = (time.monotonic() + self.ttl_seconds, results)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int | None = None, *, username: str | None = None):
+        """Forget results showing ``user_id`` and queries that ``username`` now answers."""
+        normalized = (username or "").lower()
+        with self._lock:
+            stale = [
+                query
+                for query, (_expires_at, results) in self._entries.items()
+                if (normalized and query in normalized) or any(result["id"] == user_id for result in results)
+            ]
+            for query in stale:
+                self._entries.pop(query, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_search_cache = UserSearchCache()
+
+
+def normalize_search_query(query: str | None) -> str:
+    return (query or "").strip().lower()[:USER_SEARCH_MAX_QUERY_LENGTH]
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _prefix_matches(db: Session, query: str, limit: int) -> list[User]:
+    lowered = func.lower(User.username)
+    if db.bind.dialect.name == "postgresql":
+        # text_pattern_ops turns LIKE 'abc%' into an index range scan; backslash is the default escape.
+        condition = lowered.like(f"{_escape_like(query)}%")
+    else:
+        condition = (lowered >= query) & (lowered < query + PREFIX_RANGE_END)
+    return db.execute(select(User).where(condition).order_by(lowered).limit(limit)).scalars().all()
+
+
+def _substring_matches(db: Session, query: str, limit: int) -> list[User]:
+    if db.bind.dialect.name == "postgresql":
+        statement = select(User).where(func.lower(User.username).like(f"%{_escape_like(query)}%")).limit(limit)
+        return db.execute(statement).scalars().all()
+
+    # FTS5's LIKE has no ESCAPE clause, so % and _ in the query match loosely and are re-checked below.
+    loose = "%" in query or "_" in query
+    statement = (
+        select(User)
+        .join(users_search, users_search.c.rowid == User.id)
+        .where(users_search.c.username.like(f"%{query}%"))
+        .limit(limit * 5 if loose else limit)
+    )
+    try:
+        users = db.execute(statement).scalars().all()
+    except OperationalError:
+        # No trigram table on this SQLite build; scan instead.
+        db.rollback()
+        statement = select(User).where(func.lower(User.username).contains(query, autoescape=True)).limit(limit)
+        return db.execute(statement).scalars().all()
+    return [user for user in users if query in user.username.lower()][:limit]
+
+
+def search_usernames(db: Session, query: str, *, limit: int = USER_SEARCH_LIMIT) -> list[dict]:
+    """Users whose name starts with ``query`` first, then those merely containing it.
+
+    Returns up to ``limit + 1`` results so callers can drop the searcher and still fill a page.
+    """
+    normalized = normalize_search_query(query)
+    if not normalized:
+        return []
+    cached = user_search_cache.get(normalized)
+    if cached is not None:
+        return cached
+
+    wanted = limit + 1
+    users = list(_prefix_matches(db, normalized, wanted))
+    if len(users) < wanted and len(normalized) >= MIN_SUBSTRING_QUERY_LENGTH:
+        seen = {user.id for user in users}
+        substring_matches = [user for user in _substring_matches(db, normalized, wanted + len(users)) if user.id not in seen]
+        # Shorter names are closer matches for the same substring.
+        substring_matches.sort(key=lambda user: (len(user.username), user.username.lower()))
+        users.extend(substring_matches[: wanted - len(users)])
+
+    results = [{"id": user.id, "username": user.username, **build_avatar_props(user)} for user in users]
+    user_search_cache.set(normalized, results)
+    return results
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+
+import asyncpg
+from sqlalchemy.engine import make_url
+
+
+logger = logging.getLogger("app.websocket_broker")
+
+EventHandler = Callable[[dict], Awaitable[None]]
+
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("WEBSOCKET_PRESENCE_HEARTBEAT_SECONDS", 10))
+PRESENCE_TTL_SECONDS = float(os.getenv("WEBSOCKET_PRESENCE_TTL_SECONDS", PRESENCE_HEARTBEAT_SECONDS * 3))
+# Postgres rejects NOTIFY payloads of 8000 bytes or more; larger events are split into chunks.
+NOTIFY_CHUNK_SIZE = 7800
+MAX_PENDING_CHUNKED_EVENTS = 1000
+RECONNECT_DELAY_SECONDS = 2
+
+
+class WebSocketBroker(ABC):
+    """Carries events between workers; subclasses decide how ``publish`` reaches the others."""
+
+    is_distributed = False
+
+    def __init__(self, node_id: str | None = None):
+        self.node_id = node_id or uuid.uuid4().hex
+        self._handler: EventHandler | None = None
+
+    async def start(self, handler: EventHandler):
+        self._handler = handler
+
+    async def stop(self):
+        self._handler = None
+
+    @abstractmethod
+    async def publish(self, kind: str, **args):
+        """Send ``kind`` with ``args`` to every other worker's ``dispatch``."""
+
+    async def dispatch(self, envelope: dict):
+        if self._handler is None or envelope.get("node_id") == self.node_id:
+            return
+        try:
+            await self._handler(envelope)
+        except Exception:
+            logger.exception("websocket_broker_dispatch_failed kind=%s", envelope.get("kind"))
+
+
+class InProcessBroker(WebSocketBroker):
+    """A single worker has nobody to tell, so publishing is a no-op."""
+
+    async def publish(self, kind: str, **args):
+        return None
+
+
+class PostgresNotifyBroker(WebSocketBroker):
+    is_distributed = True
+
+    def __init__(
+        self,
+        dsn: str,
+        *,
+        channel: str = "websocket_events",
+        node_id: str | None = None,
+        connect=None,
+        chunk_size: int = NOTIFY_CHUNK_SIZE,
+    ):
+        super().__init__(node_id)
+        self.dsn = dsn
+        self.channel = channel
+        self.chunk_size = chunk_size
+        self._connect = connect
+        self._listen_connection = None
+        self._publish_connection = None
+        self._publish_lock = asyncio.Lock()
+        self._inbox: asyncio.Queue | None = None
+        self._consumer_task: asyncio.Task | None = None
+        self._reconnect_task: asyncio.Task | None = None
+        self._pending_chunks: dict[tuple[str, str], list[str | None]] = {}
+        self._stopping = False
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        self._stopping = False
+        self._inbox = asyncio.Queue()
+        self._consumer_task = asyncio.create_task(self._consume())
+        await self._open_connections()
+
+    async def stop(self):
+        self._stopping = True
+        for task in (self._reconnect_task, self._consumer_task):
+            if task is not None:
+                task.cancel()
+        self._reconnect_task = None
+        self._consumer_task = None
+        await self._close_connections()
+        await super().stop()
+
+    async def publish(self, kind: str, **args):
+        body = json.dumps({"node_id": self.node_id, "kind": kind, "args": args})
+        chunks = [body[start:start + self.chunk_size] for start in range(0, len(body), self.chunk_size)]
+        event_id = uuid.uuid4().hex[:12]
+        async with self._publish_lock:
+            if self._publish_connection is None:
+                raise ConnectionError("WebSocket broker is not connected")
+            for index, chunk in enumerate(chunks):
+                await self._publish_connection.execute(
+                    "SELECT pg_notify($1, $2)",
+                    self.channel,
+                    f"{self.node_id}:{event_id}:{index}:{len(chunks)}:{chunk}",
+                )
+
+    async def _open_connections(self):
+        connect = self._connect or asyncpg.connect
+        self._listen_connection = await connect(self.dsn)
+        self._publish_connection = await connect(self.dsn)
+        await self._listen_connection.add_listener(self.channel, self._on_notification)
+        add_termination_listener = getattr(self._listen_connection, "add_termination_listener", None)
+        if add_termination_listener is not None:
+            add_termination_listener(self._on_termination)
+        logger.info("websocket_broker_connected node_id=%s channel=%s", self.node_id, self.channel)
+
+    async def _close_connections(self):
+        listen_connection, self._listen_connection = self._listen_connection, None
+        publish_connection, self._publish_connection = self._publish_connection, None
+        if listen_connection is not None:
+            try:
+                await listen_connection.remove_listener(self.channel, self._on_notification)
+            except Exception:
+                pass
+        for connection in (listen_connection, publish_connection):
+            if connection is None:
+                continue
+            try:
+                await connection.close()
+            except Exception:
+                pass
+
+    def _on_termination(self, _connection):
+        if self._stopping or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        logger.warning("websocket_broker_disconnected node_id=%s", self.node_id)
+        self._reconnect_task = asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while not self._stopping:
+            await self._close_connections()
+            try:
+                await self._open_connections()
+            except Exception:
+                logger.warning("websocket_broker_reconnect_failed node_id=%s", self.node_id)
+                await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+                continue
+            # Presence learnt from other nodes may have gone stale while we were away.
+            await self._inbox.put({"node_id": "", "kind": "broker_reconnected", "args": {}})
+            return
+
+    def _on_notification(self, _connection, _pid, _channel, payload: str):
+        try:
+            node_id, event_id, index, total, chunk = payload.split(":", 4)
+            index = int(index)
+            total = int(total)
+        except ValueError:
+            logger.warning("websocket_broker_malformed_notification node_id=%s", self.node_id)
+            return
+        if node_id == self.node_id:
+            return
+
+        if total == 1:
+            body = chunk
+        else:
+            key = (node_id, event_id)
+            parts = self._pending_chunks.get(key)
+            if parts is None:
+                if len(self._pending_chunks) >= MAX_PENDING_CHUNKED_EVENTS:
+                    self._pending_chunks.pop(next(iter(self._pending_chunks)))
+                parts = self._pending_chunks[key] = [None] * total
+            parts[index] = chunk
+            if any(part is None for part in parts):
+                return
+            self._pending_chunks.pop(key)
+            body = "".join(parts)
+
+        try:
+            envelope = json.loads(body)
+        except json.JSONDecodeError:
+            logger.warning("websocket_broker_malformed_event node_id=%s from=%s", self.node_id, node_id)
+            return
+        if self._inbox is not None:
+            self._inbox.put_nowait(envelope)
+
+    async def _consume(self):
+        while True:
+            await self.dispatch(await self._inbox.get())
+
+
+def build_asyncpg_dsn(url: str) -> str:
+    return make_url(url).set(drivername="postgresql").render_as_string(hide_password=False)
+
+
+class ClusterPresence:
+    def __init__(self, ttl_seconds: float = PRESENCE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.online_users: dict[str, set[int]] = {}
+        self.chat_users: dict[str, set[tuple[int, int]]] = {}
+        self.seen_at: dict[str, float] = {}
+
+    def touch(self, node_id: str):
+        self.seen_at[node_id] = time.monotonic()
+        self.online_users.setdefault(node_id, set())
+        self.chat_users.setdefault(node_id, set())
+
+    def set_user_online(self, node_id: str, user_id: int, is_online: bool):
+        self.touch(node_id)
+        if is_online:
+            self.online_users[node_id].add(user_id)
+        else:
+            self.online_users[node_id].discard(user_id)
+
+    def set_chat_user(self, node_id: str, chat_id: int, user_id: int, is_present: bool):
+        self.touch(node_id)
+        if is_present:
+            self.chat_users[node_id].add((chat_id, user_id))
+        else:
+            self.chat_users[node_id].discard((chat_id, user_id))
+
+    def replace(self, node_id: str, online_users, chat_users):
+        self.touch(node_id)
+        self.online_users[node_id] = {int(user_id) for user_id in online_users}
+        self.chat_users[node_id] = {(int(chat_id), int(user_id)) for chat_id, user_id in chat_users}
+
+    def drop_node(self, node_id: str):
+        self.online_users.pop(node_id, None)
+        self.chat_users.pop(node_id, None)
+        self.seen_at.pop(node_id, None)
+
+    def live_nodes(self) -> list[str]:
+        deadline = time.monotonic() - self.ttl_seconds
+        for node_id in [node_id for node_id, seen_at in self.seen_at.items() if seen_at < deadline]:
+            self.drop_node(node_id)
+        return list(self.seen_at)
+
+    def is_user_online(self, user_id: int) -> bool:
+        return any(user_id in self.online_users.get(node_id, ()) for node_id in self.live_nodes())
+
+    def has_chat_user(self, chat_id: int, user_id: int) -> bool:
+        return any((chat_id, user_id) in self.chat_users.get(node_id, ()) for node_id in self.live_nodes())
+
+    def clear(self):
+        self.online_users.clear()
+        self.chat_users.clear()
+        self.seen_at.clear()
+
+
+def create_broker_from_env() -> WebSocketBroker:
+    backend = os.getenv("WEBSOCKET_BROKER", "memory").strip().lower()
+    if backend in {"", "memory", "inprocess", "in-process"}:
+        return InProcessBroker()
+    if backend in {"postgres", "postgresql"}:
+        url = os.getenv("WEBSOCKET_BROKER_URL") or os.getenv("DATABASE_URL_SYNC") or (
+            f"postgresql://{os.getenv('POSTGRES_USER')}:"
+            f"{os.getenv('POSTGRES_PASSWORD')}@"
+            f"{os.getenv('POSTGRES_HOST')}:"
+            f"{os.getenv('POSTGRES_PORT')}/"
+            f"{os.getenv('POSTGRES_DB')}"
+        )
+        return PostgresNotifyBroker(
+            build_asyncpg_dsn(url),
+            channel=os.getenv("WEBSOCKET_BROKER_CHANNEL", "websocket_events"),
+        )
+    raise RuntimeError(f"Unknown WEBSOCKET_BROKER backend: {backend}")
@@ -1,28 +1,203 @@
 import asyncio
-import json
+import logging
 from typing import Dict, List
 
 from fastapi import WebSocket
 
+from app.utils.websocket_broker import (
+    PRESENCE_HEARTBEAT_SECONDS,
+    ClusterPresence,
+    InProcessBroker,
+    WebSocketBroker,
+    create_broker_from_env,
+)
+from app.utils.chat_list_cache import ChatListCache, chat_list_cache as default_chat_list_cache
+from app.utils.chat_roster import ChatRosterCache
+from app.utils.presence import PRESENCE_DEBOUNCE_SECONDS, ContactGraph
+from app.utils.user_cache import UserCache, user_cache as default_user_cache
+from app.utils.websocket_frame import Frame
+from app.utils.websocket_outbox import SocketOutbox, new_outbox_stats
+
+
+logger = logging.getLogger("app.websocket_manager")
+
+# Events that other nodes replay against their own sockets, mapped to the local delivery method.
+REMOTE_DELIVERY_METHODS = {
+    "broadcast_chat": "_broadcast_chat_local",
+    "notify_user": "_notify_user_local",
+    "notify_user_device": "_notify_user_device_local",
+    "notify_chat_device": "_notify_chat_device_local",
+    "notify_chat_user": "_notify_chat_user_local",
+    "revoke_chat_user": "_revoke_chat_user_local",
+    "broadcast_user_status": "_broadcast_user_status_local",
+    "invalidate_contacts": "_invalidate_contacts_local",
+    "invalidate_chat_roster": "_invalidate_chat_roster_local",
+    "invalidate_user": "_invalidate_user_local",
+    "invalidate_chat_lists": "_invalidate_chat_lists_local",
+}
+
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(
+        self,
+        broker: WebSocketBroker | None = None,
+        contact_graph: ContactGraph | None = None,
+        chat_rosters: ChatRosterCache | None = None,
+        *,
+        presence_debounce_seconds: float = PRESENCE_DEBOUNCE_SECONDS,
+        user_cache: UserCache | None = None,
+        chat_list_cache: ChatListCache | None = None,
+    ):
         self.chat_connections: Dict[int, List[WebSocket]] = {}
         self.chat_user_connections: Dict[int, Dict[int, List[WebSocket]]] = {}
         self.chat_device_connections: Dict[int, Dict[str, List[WebSocket]]] = {}
         self.user_connections: Dict[int, List[WebSocket]] = {}
         self.user_device_connections: Dict[int, Dict[str, List[WebSocket]]] = {}
         self.online_users: set[int] = set()
+        self.broker = broker or InProcessBroker()
+        self.cluster_presence = ClusterPresence()
+        self.outboxes: Dict[WebSocket, SocketOutbox] = {}
+        self.outbox_stats = new_outbox_stats()
+        self.contact_graph = contact_graph or ContactGraph()
+        self.chat_rosters = chat_rosters or ChatRosterCache()
+        self.user_cache = user_cache or default_user_cache
+        self.chat_list_cache = chat_list_cache or default_chat_list_cache
+        self.presence_debounce_seconds = presence_debounce_seconds
+        self.pending_presence: set[int] = set()
+        self.announced_presence: Dict[int, bool] = {}
+        self._presence_flush_task: asyncio.Task | None = None
+        self._heartbeat_task: asyncio.Task | None = None
+        self._background_tasks: set[asyncio.Task] = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.broker.start(self.handle_remote_event)
+        if self.broker.is_distributed:
+            await self.publish("presence_request")
+            await self.publish_presence_snapshot()
+            self._heartbeat_task = asyncio.create_task(self._presence_heartbeat())
+
+    async def stop(self):
+        for task in (self._heartbeat_task, self._presence_flush_task):
+            if task is not None:
+                task.cancel()
+        self._heartbeat_task = None
+        self._presence_flush_task = None
+        await self.publish("node_stopped")
+        await self.broker.stop()
+        self._loop = None
+
+    async def publish(self, kind: str, **args):
+        if not self.broker.is_distributed:
+            return
+        try:
+            await self.broker.publish(kind, **args)
+        except Exception:
+            logger.exception("websocket_broker_publish_failed kind=%s", kind)
 
-    async def safe_send(self, websocket: WebSocket, data: dict):
+    def publish_soon(self, kind: str, **args):
+        """``publish`` without awaiting it, callable from sync endpoints on threadpool workers too."""
+        loop = self._loop
+        if not self.broker.is_distributed or loop is None or loop.is_closed():
+            return
         try:
-            await websocket.send_text(json.dumps(data))
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._spawn(self.publish(kind, **args))
+        else:
+            asyncio.run_coroutine_threadsafe(self.publish(kind, **args), loop)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def handle_remote_event(self, envelope: dict):
+        node_id = envelope.get("node_id")
+        kind = envelope.get("kind")
+        args = envelope.get("args") or {}
+
+        if kind == "broker_reconnected":
+            self.cluster_presence.clear()
+            await self.publish("presence_request")
+            await self.publish_presence_snapshot()
+            return
+        if not node_id:
+            return
+        if kind == "node_stopped":
+            self.cluster_presence.drop_node(node_id)
+            return
+
+        self.cluster_presence.touch(node_id)
+        if kind == "presence_request":
+            await self.publish_presence_snapshot()
+        elif kind == "presence_snapshot":
+            self.cluster_presence.replace(node_id, args.get("online_users", []), args.get("chat_users", []))
+        elif kind == "user_presence":
+            self.cluster_presence.set_user_online(node_id, args["user_id"], args["is_online"])
+        elif kind == "chat_presence":
+            self.cluster_presence.set_chat_user(node_id, args["chat_id"], args["user_id"], args["is_present"])
+        elif kind in REMOTE_DELIVERY_METHODS:
+            await getattr(self, REMOTE_DELIVERY_METHODS[kind])(**args)
+        else:
+            logger.warning("websocket_broker_unknown_event kind=%s node_id=%s", kind, node_id)
+
+    async def publish_presence_snapshot(self):
+        await self.publish(
+            "presence_snapshot",
+            online_users=sorted(self.online_users),
+            chat_users=[
+                [chat_id, user_id]
+                for chat_id, users in self.chat_user_connections.items()
+                for user_id, sockets in users.items()
+                if sockets
+            ],
+        )
+
+    async def _presence_heartbeat(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT_SECONDS)
+            await self.publish_presence_snapshot()
+
+    def _open_outbox(self, websocket: WebSocket, on_closed):
+        self.outboxes[websocket] = SocketOutbox(websocket, on_closed=on_closed, stats=self.outbox_stats)
+
+    def _close_outbox(self, websocket: WebSocket):
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.stop()
+
+    async def safe_send(self, websocket: WebSocket, data: dict | Frame):
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            return outbox.enqueue(data)
+        try:
+            await websocket.send_text(Frame.of(data).text)
             return True
         except Exception:
             return False
 
+    async def send(self, websocket: WebSocket, data: dict | Frame):
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            return await outbox.put(data)
+        return await self.safe_send(websocket, data)
+
+    def get_metrics(self) -> dict:
+        depths = [outbox.depth for outbox in self.outboxes.values()]
+        return {
+            "sockets": len(depths),
+            "queue_depth_total": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            **self.outbox_stats,
+        }
+
     async def connect_user(self, user_id: int, websocket: WebSocket, device_id: str | None = None):
         await websocket.accept()
+        self._open_outbox(websocket, lambda: self.disconnect_user(user_id, websocket, device_id=device_id))
 
         if user_id not in self.user_connections:
             self.user_connections[user_id] = []
@@ -37,9 +212,11 @@ class ConnectionManager:
 
         if len(self.user_connections[user_id]) == 1:
             self.online_users.add(user_id)
-            await self.broadcast_user_status(user_id, True)
+            await self.publish("user_presence", user_id=user_id, is_online=True)
+            self.queue_presence_change(user_id)
 
     def disconnect_user(self, user_id: int, websocket: WebSocket, device_id: str | None = None):
+        self._close_outbox(websocket)
         if user_id in self.user_connections:
             if websocket in self.user_connections[user_id]:
                 self.user_connections[user_id].remove(websocket)
@@ -47,7 +224,7 @@ class ConnectionManager:
             if not self.user_connections[user_id]:
                 self.user_connections.pop(user_id)
                 self.online_users.discard(user_id)
-                asyncio.create_task(self.broadcast_user_status(user_id, False))
+                self._spawn(self._announce_user_offline(user_id))
 
         if device_id and user_id in self.user_device_connections:
             device_sockets = self.user_device_connections[user_id].get(device_id, [])
@@ -58,23 +235,55 @@ class ConnectionManager:
             if not self.user_device_connections[user_id]:
                 self.user_device_connections.pop(user_id)
 
+    async def _announce_user_offline(self, user_id: int):
+        await self.publish("user_presence", user_id=user_id, is_online=False)
+        self.queue_presence_change(user_id)
+
+    def queue_presence_change(self, user_id: int):
+        # Transitions are collected for one debounce interval; a reconnecting socket then produces no event at all.
+        self.pending_presence.add(user_id)
+        task = self._presence_flush_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            self._presence_flush_task = asyncio.create_task(self._flush_presence_changes())
+
+    async def _flush_presence_changes(self):
+        await asyncio.sleep(self.presence_debounce_seconds)
+        user_ids, self.pending_presence = self.pending_presence, set()
+        for user_id in sorted(user_ids):
+            is_online = self.is_online(user_id)
+            if self.announced_presence.get(user_id, False) != is_online:
+                await self.broadcast_user_status(user_id, is_online)
+
     def is_online(self, user_id: int) -> bool:
-        return user_id in self.online_users
+        return user_id in self.online_users or self.cluster_presence.is_user_online(user_id)
+
+    async def notify_user(self, user_id: int, data: dict | Frame):
+        frame = Frame.of(data)
+        await self.publish("notify_user", user_id=user_id, data=frame.data)
+        await self._notify_user_local(user_id, frame)
 
-    async def notify_user(self, user_id: int, data: dict):
+    async def _notify_user_local(self, user_id: int, data: dict | Frame):
+        frame = Frame.of(data)
         for websocket in list(self.user_connections.get(user_id, [])):
-            ok = await self.safe_send(websocket, data)
+            ok = await self.safe_send(websocket, frame)
             if not ok:
                 self.disconnect_user(user_id, websocket)
 
-    async def notify_user_device(self, user_id: int, device_id: str, data: dict):
+    async def notify_user_device(self, user_id: int, device_id: str, data: dict | Frame):
+        frame = Frame.of(data)
+        await self.publish("notify_user_device", user_id=user_id, device_id=device_id, data=frame.data)
+        await self._notify_user_device_local(user_id, device_id, frame)
+
+    async def _notify_user_device_local(self, user_id: int, device_id: str, data: dict | Frame):
+        frame = Frame.of(data)
         for websocket in list(self.user_device_connections.get(user_id, {}).get(device_id, [])):
-            ok = await self.safe_send(websocket, data)
+            ok = await self.safe_send(websocket, frame)
             if not ok:
                 self.disconnect_user(user_id, websocket, device_id=device_id)
 
     async def connect_chat(self, chat_id: int, user_id: int, websocket: WebSocket, device_id: str | None = None):
         await websocket.accept()
+        self._open_outbox(websocket, lambda: self.disconnect_chat(chat_id, websocket, user_id, device_id=device_id))
 
         if chat_id not in self.chat_connections:
             self.chat_connections[chat_id] = []
@@ -93,7 +302,11 @@ class ConnectionManager:
                 self.chat_device_connections[chat_id][device_id] = []
             self.chat_device_connections[chat_id][device_id].append(websocket)
 
+        if len(self.chat_user_connections[chat_id][user_id]) == 1:
+            await self.publish("chat_presence", chat_id=chat_id, user_id=user_id, is_present=True)
+
     def disconnect_chat(self, chat_id: int, websocket: WebSocket, user_id: int | None = None, device_id: str | None = None):
+        self._close_outbox(websocket)
         if chat_id in self.chat_connections:
             if websocket in self.chat_connections[chat_id]:
                 self.chat_connections[chat_id].remove(websocket)
@@ -107,6 +320,8 @@ class ConnectionManager:
                 user_sockets.remove(websocket)
             if not user_sockets and user_id in self.chat_user_connections[chat_id]:
                 self.chat_user_connections[chat_id].pop(user_id)
+                if self.broker.is_distributed:
+                    self._spawn(self.publish("chat_presence", chat_id=chat_id, user_id=user_id, is_present=False))
             if not self.chat_user_connections[chat_id]:
                 self.chat_user_connections.pop(chat_id)
 
@@ -120,56 +335,145 @@ class ConnectionManager:
                 self.chat_device_connections.pop(chat_id)
 
     def has_chat_user(self, chat_id: int, user_id: int) -> bool:
-        return bool(self.chat_user_connections.get(chat_id, {}).get(user_id))
+        return bool(self.chat_user_connections.get(chat_id, {}).get(user_id)) or self.cluster_presence.has_chat_user(chat_id, user_id)
+
+    async def broadcast_chat(self, chat_id: int, data: dict | Frame):
+        frame = Frame.of(data)
+        await self.publish("broadcast_chat", chat_id=chat_id, data=frame.data)
+        await self._broadcast_chat_local(chat_id, frame)
 
-    async def broadcast_chat(self, chat_id: int, data: dict):
+    async def _broadcast_chat_local(self, chat_id: int, data: dict | Frame):
+        frame = Frame.of(data)
         for connection in list(self.chat_connections.get(chat_id, [])):
-            ok = await self.safe_send(connection, data)
+            ok = await self.safe_send(connection, frame)
             if not ok:
                 self.disconnect_chat(chat_id, connection)
 
-    async def notify_chat_device(self, chat_id: int, device_id: str, data: dict):
+    async def notify_chat_device(self, chat_id: int, device_id: str, data: dict | Frame):
+        frame = Frame.of(data)
+        await self.publish("notify_chat_device", chat_id=chat_id, device_id=device_id, data=frame.data)
+        await self._notify_chat_device_local(chat_id, device_id, frame)
+
+    async def _notify_chat_device_local(self, chat_id: int, device_id: str, data: dict | Frame):
+        frame = Frame.of(data)
         for websocket in list(self.chat_device_connections.get(chat_id, {}).get(device_id, [])):
-            ok = await self.safe_send(websocket, data)
+            ok = await self.safe_send(websocket, frame)
             if not ok:
                 self.disconnect_chat(chat_id, websocket, device_id=device_id)
 
-    async def notify_chat_user(self, chat_id: int, user_id: int, data: dict, *, exclude: WebSocket | None = None):
+    async def notify_chat_user(self, chat_id: int, user_id: int, data: dict | Frame, *, exclude: WebSocket | None = None):
+        frame = Frame.of(data)
+        await self.publish("notify_chat_user", chat_id=chat_id, user_id=user_id, data=frame.data)
+        await self._notify_chat_user_local(chat_id, user_id, frame, exclude=exclude)
+
+    async def _notify_chat_user_local(self, chat_id: int, user_id: int, data: dict | Frame, *, exclude: WebSocket | None = None):
+        frame = Frame.of(data)
         for websocket in list(self.chat_user_connections.get(chat_id, {}).get(user_id, [])):
             if exclude is not None and websocket is exclude:
                 continue
-            ok = await self.safe_send(websocket, data)
+            ok = await self.safe_send(websocket, frame)
             if not ok:
                 self.disconnect_chat(chat_id, websocket, user_id=user_id)
 
     async def revoke_chat_user(self, chat_id: int, user_id: int, data: dict | None = None, *, code: int = 1008):
+        await self.publish("revoke_chat_user", chat_id=chat_id, user_id=user_id, data=data, code=code)
+        await self._revoke_chat_user_local(chat_id, user_id, data, code=code)
+
+    async def _revoke_chat_user_local(self, chat_id: int, user_id: int, data: dict | None = None, *, code: int = 1008):
         sockets = list(self.chat_user_connections.get(chat_id, {}).get(user_id, []))
         for websocket in sockets:
             if data is not None:
                 await self.safe_send(websocket, data)
+            outbox = self.outboxes.get(websocket)
+            if outbox is not None:
+                await outbox.drain(timeout=outbox.send_timeout)
             try:
                 await websocket.close(code=code)
             except Exception:
                 pass
             self.disconnect_chat(chat_id, websocket, user_id=user_id)
 
+    async def invalidate_contacts(self, user_ids, *, chat_id: int | None = None):
+        user_ids = sorted(set(user_ids))
+        await self.publish("invalidate_contacts", user_ids=user_ids, chat_id=chat_id)
+        await self._invalidate_contacts_local(user_ids, chat_id=chat_id)
+
+    async def _invalidate_contacts_local(self, user_ids, *, chat_id: int | None = None):
+        if chat_id is None:
+            self.contact_graph.invalidate_users(user_ids)
+        else:
+            self.contact_graph.invalidate_chat(chat_id, user_ids)
+
+    async def invalidate_chat_roster(self, chat_id: int):
+        # Every node bumps its own version, so removed members are refused cluster-wide.
+        await self.publish("invalidate_chat_roster", chat_id=chat_id)
+        await self._invalidate_chat_roster_local(chat_id)
+
+    async def _invalidate_chat_roster_local(self, chat_id: int):
+        self.chat_rosters.bump(chat_id)
+
+    def invalidate_user(self, user_id: int | None = None, *, email: str | None = None):
+        # Every worker caches authenticated users; a rename, revocation or deletion must reach all of them.
+        self.user_cache.invalidate_user(user_id, email=email)
+        self.publish_soon("invalidate_user", user_id=user_id, email=email)
+
+    async def _invalidate_user_local(self, user_id: int | None = None, *, email: str | None = None):
+        self.user_cache.invalidate_user(user_id, email=email)
+
+    def invalidate_chat_lists(self, *, owner_ids=(), chat_id: int | None = None, user_id: int | None = None):
+        """Drop cached chat lists on every worker.
+
+        Covers the lists of ``owner_ids``, every list showing ``chat_id``, and every list showing
+        ``user_id``'s name, avatar or keys.
+        """
+        owner_ids = list(owner_ids)
+        self.publish_soon("invalidate_chat_lists", owner_ids=owner_ids, chat_id=chat_id, user_id=user_id)
+        self._apply_chat_list_invalidation(owner_ids, chat_id, user_id)
+
+    async def _invalidate_chat_lists_local(self, owner_ids, chat_id: int | None = None, user_id: int | None = None):
+        self._apply_chat_list_invalidation(owner_ids, chat_id, user_id)
+
+    def _apply_chat_list_invalidation(self, owner_ids, chat_id: int | None, user_id: int | None):
+        if owner_ids:
+            self.chat_list_cache.invalidate_users(owner_ids)
+        if chat_id is not None:
+            self.chat_list_cache.invalidate_chat(chat_id)
+        if user_id is not None:
+            self.chat_list_cache.invalidate_user_references(user_id)
+
     async def broadcast_user_status(self, user_id: int, is_online: bool):
-        data = {
+        await self.publish("broadcast_user_status", user_id=user_id, is_online=is_online)
+        await self._broadcast_user_status_local(user_id, is_online)
+
+    async def _broadcast_user_status_local(self, user_id: int, is_online: bool):
+        if is_online:
+            self.announced_presence[user_id] = True
+        else:
+            self.announced_presence.pop(user_id, None)
+
+        try:
+            chat_members = await self.contact_graph.get_chat_members(user_id)
+        except Exception:
+            logger.exception("presence_contacts_load_failed user_id=%s", user_id)
+            return
+
+        frame = Frame({
             "type": "status",
             "user_id": user_id,
             "is_online": is_online
-        }
+        })
 
         tasks = []
 
-        for uid in list(self.user_connections.keys()):
-            if uid != user_id:
-                tasks.append(self.notify_user(uid, data))
+        contact_ids = set().union(*chat_members.values()) - {user_id} if chat_members else set()
+        for uid in contact_ids:
+            if uid in self.user_connections:
+                tasks.append(self._notify_user_local(uid, frame))
 
-        for chat_id, sockets in list(self.chat_connections.items()):
-            for ws in list(sockets):
+        for chat_id in chat_members:
+            for ws in list(self.chat_connections.get(chat_id, [])):
                 async def send(ws=ws, chat_id=chat_id):
-                    ok = await self.safe_send(ws, data)
+                    ok = await self.safe_send(ws, frame)
                     if not ok:
                         self.disconnect_chat(chat_id, ws)
                 tasks.append(send())
@@ -178,4 +482,4 @@ class ConnectionManager:
             await asyncio.gather(*tasks, return_exceptions=True)
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(create_broker_from_env())
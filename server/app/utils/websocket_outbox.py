@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Callable
+
+from fastapi import WebSocket
+
+from app.utils.websocket_frame import Frame
+
+
+logger = logging.getLogger("app.websocket_outbox")
+
+SEND_QUEUE_SIZE = int(os.getenv("WEBSOCKET_SEND_QUEUE_SIZE", 256))
+SEND_TIMEOUT_SECONDS = float(os.getenv("WEBSOCKET_SEND_TIMEOUT_SECONDS", 10))
+OVERFLOW_POLICY = os.getenv("WEBSOCKET_OVERFLOW_POLICY", "drop_oldest").strip().lower()
+OVERFLOW_POLICIES = {"drop_oldest", "disconnect", "coalesce"}
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# Status events only describe the latest state, so an older copy can be dropped or replaced.
+STATUS_EVENT_TYPES = {"status", "message_status"}
+
+
+def get_coalesce_key(data: dict) -> tuple | None:
+    event_type = data.get("type")
+    if event_type == "status":
+        return ("status", data.get("user_id"))
+    if event_type == "message_status":
+        return ("message_status", data.get("message_id"))
+    return None
+
+
+def new_outbox_stats() -> dict:
+    return {
+        "enqueued": 0,
+        "sent": 0,
+        "dropped": 0,
+        "coalesced": 0,
+        "send_failures": 0,
+        "slow_consumer_disconnects": 0,
+    }
+
+
+class SocketOutbox:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        *,
+        on_closed: Callable[[], None],
+        stats: dict,
+        max_size: int = SEND_QUEUE_SIZE,
+        policy: str = OVERFLOW_POLICY,
+        send_timeout: float = SEND_TIMEOUT_SECONDS,
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown websocket overflow policy: {policy}")
+        self.websocket = websocket
+        self.on_closed = on_closed
+        self.stats = stats
+        self.max_size = max(1, max_size)
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self.queue: deque[tuple[tuple | None, Frame]] = deque()
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._run())
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def enqueue(self, data: dict | Frame) -> bool:
+        if self.closed:
+            return False
+
+        frame = Frame.of(data)
+        key = get_coalesce_key(frame.data)
+        if self.policy == "coalesce" and key is not None and self._replace_queued(key, frame):
+            self.stats["coalesced"] += 1
+            return True
+
+        if len(self.queue) >= self.max_size and not self._make_room():
+            self.stats["slow_consumer_disconnects"] += 1
+            logger.warning("websocket_slow_consumer_disconnected depth=%s policy=%s", len(self.queue), self.policy)
+            self._close(code=SLOW_CONSUMER_CLOSE_CODE)
+            return False
+
+        self._push(key, frame)
+        return True
+
+    async def put(self, data: dict | Frame) -> bool:
+        # Backpressure for the socket's own handler, e.g. history replay: wait for room instead of shedding.
+        while not self.closed and len(self.queue) >= self.max_size:
+            self._space.clear()
+            await self._space.wait()
+        if self.closed:
+            return False
+        frame = Frame.of(data)
+        self._push(get_coalesce_key(frame.data), frame)
+        return True
+
+    async def drain(self, timeout: float | None = None):
+        if not self._in_owner_loop():
+            future = asyncio.run_coroutine_threadsafe(self.drain(timeout), self._loop)
+            await asyncio.wrap_future(future)
+            return
+        try:
+            await asyncio.wait_for(self._drained.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        self._call_in_owner_loop(self._space.set)
+        self._call_in_owner_loop(self._drained.set)
+        if not self._in_owner_loop() or self._task is not asyncio.current_task():
+            self._call_in_owner_loop(self._task.cancel)
+
+    def _in_owner_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def _call_in_owner_loop(self, callback: Callable[[], None]):
+        # Events can be published from another loop (threadpool endpoints, test client portals).
+        if self._in_owner_loop():
+            callback()
+        elif not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(callback)
+
+    def _push(self, key: tuple | None, frame: Frame):
+        self.queue.append((key, frame))
+        self.stats["enqueued"] += 1
+        self._drained.clear()
+        self._call_in_owner_loop(self._wakeup.set)
+
+    def _replace_queued(self, key: tuple, frame: Frame) -> bool:
+        for index, (queued_key, _queued_frame) in enumerate(self.queue):
+            if queued_key == key:
+                self.queue[index] = (key, frame)
+                return True
+        return False
+
+    def _make_room(self) -> bool:
+        if self.policy == "disconnect":
+            return False
+        for index, (_key, queued_frame) in enumerate(self.queue):
+            if queued_frame.data.get("type") in STATUS_EVENT_TYPES:
+                del self.queue[index]
+                self.stats["dropped"] += 1
+                return True
+        return False
+
+    def _close(self, *, code: int):
+        websocket = self.websocket
+        self.stop()
+        self.on_closed()
+
+        async def close_socket():
+            try:
+                await websocket.close(code=code)
+            except Exception:
+                pass
+
+        asyncio.create_task(close_socket())
+
+    async def _run(self):
+        while True:
+            if not self.queue:
+                self._drained.set()
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            _key, frame = self.queue.popleft()
+            self._space.set()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(frame.text), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                self.stats["slow_consumer_disconnects"] += 1
+                logger.warning("websocket_send_timeout timeout=%ss", self.send_timeout)
+                self._close(code=SLOW_CONSUMER_CLOSE_CODE)
+                return
+            except Exception:
+                self.stats["send_failures"] += 1
+                self.stop()
+                self.on_closed()
+                return
+            self.stats["sent"] += 1
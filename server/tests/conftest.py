@@ -24,14 +24,25 @@ os.environ.setdefault("AVATAR_UPLOAD_DIR", str(CLIENT_ROOT / "static" / "uploads
 os.environ.setdefault("MAX_AVATAR_SIZE_BYTES", str(2 * 1024 * 1024))
 os.environ.setdefault("TEMPLATES_DIR", str(CLIENT_ROOT / "templates"))
 os.environ.setdefault("STATIC_DIR", str(CLIENT_ROOT / "static"))
+# Tests run the maintenance jobs directly; the background loop would only race them.
+os.environ.setdefault("MAINTENANCE_ENABLED", "false")
+# Load shedding reacts to timing; the admission tests turn it on where they need it.
+os.environ.setdefault("ADMISSION_ENABLED", "false")
 
 if str(SERVER_ROOT) not in sys.path:
     sys.path.insert(0, str(SERVER_ROOT))
 
-from app.core.rate_limit import forgot_password_attempts, login_attempts
+from app.core.rate_limit import rate_limiter
 from app.db.base import Base
 from app.db.session import SessionLocal, async_engine, engine
 from app.main import app
+from app.routers import messages as messages_router
+from app.utils import storage as storage_module
+from app.utils.admission import admission, upload_buckets, user_frame_buckets
+from app.utils.attachment_download import attachment_access_cache
+from app.utils.chat_list_cache import chat_list_cache
+from app.utils.user_cache import user_cache
+from app.utils.user_search import user_search_cache
 from app.utils.websocket_manager import manager
 
 
@@ -83,14 +94,26 @@ def reset_test_database_state():
 def reset_state():
     reset_test_database_state()
 
-    login_attempts.clear()
-    forgot_password_attempts.clear()
+    rate_limiter.clear()
     manager.chat_connections.clear()
     manager.chat_user_connections.clear()
     manager.chat_device_connections.clear()
     manager.user_connections.clear()
     manager.user_device_connections.clear()
     manager.online_users.clear()
+    manager.cluster_presence.clear()
+    manager.outboxes.clear()
+    manager.contact_graph.clear()
+    manager.chat_rosters.clear()
+    manager.pending_presence.clear()
+    manager.announced_presence.clear()
+    chat_list_cache.clear()
+    user_cache.clear()
+    user_search_cache.clear()
+    attachment_access_cache.clear()
+    admission.clear()
+    user_frame_buckets.clear()
+    upload_buckets.clear()
 
     yield
 
@@ -101,9 +124,30 @@ def reset_state():
     manager.user_connections.clear()
     manager.user_device_connections.clear()
     manager.online_users.clear()
+    manager.cluster_presence.clear()
+    manager.outboxes.clear()
+    manager.contact_graph.clear()
+    manager.chat_rosters.clear()
+    manager.pending_presence.clear()
+    manager.announced_presence.clear()
+    chat_list_cache.clear()
+    user_cache.clear()
+    user_search_cache.clear()
+    attachment_access_cache.clear()
+    admission.clear()
+    user_frame_buckets.clear()
+    upload_buckets.clear()
     app.dependency_overrides.clear()
 
 
+@pytest.fixture(autouse=True)
+def isolate_upload_dirs(tmp_path, monkeypatch):
+    # Message blobs, resumable sessions and the upload spool would otherwise land under the working directory.
+    monkeypatch.setattr(messages_router, "MESSAGE_UPLOAD_DIR", tmp_path / "uploads" / "messages")
+    monkeypatch.setattr(messages_router, "UPLOAD_SESSION_DIR", tmp_path / "uploads" / "sessions")
+    monkeypatch.setattr(storage_module, "UPLOAD_SPOOL_DIR", tmp_path / "uploads" / "spool")
+
+
 @pytest.fixture
 def client():
     with TestClient(app) as test_client:
@@ -0,0 +1,125 @@
+import io
+
+from sqlalchemy import create_engine, func
+from sqlalchemy.pool import QueuePool
+
+from app.db.models import Message
+from app.db.session import SessionLocal
+from app.utils.admission import AdmissionController, TokenBucket, admission, take_from_buckets, upload_buckets
+from tests.helpers import login_user, register_user, upload_x3dh_keys
+from tests.test_websocket_messages import HISTORY_COMPLETE, receive_json_with_timeout, receive_until_type
+
+
+def start_direct_chat(client, second_client) -> int:
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_x3dh_keys(
+        second_client,
+        identity_key="public-key-user2",
+        identity_signing_key="identity-signing-user2",
+        signed_prekey="signed-prekey-user2",
+        signed_prekey_signature="signed-prekey-signature-user2",
+        signed_prekey_key_id=101,
+        one_time_prekeys=[],
+    ).status_code == 200
+    response = client.post("/messages/start", data={"username": "user2"})
+    assert response.status_code == 200
+    return response.json()["chat_id"]
+
+
+def test_token_buckets_refuse_together_and_report_the_wait():
+    connection = TokenBucket(1, 2, now=0.0)
+    user = TokenBucket(0.5, 1, now=0.0)
+
+    assert take_from_buckets([connection, user], now=0.0) == 0.0
+    # The user bucket is empty; the connection keeps the token it would otherwise have lost.
+    assert take_from_buckets([connection, user], now=0.0) == 2.0
+    assert connection.tokens == 1.0
+    assert take_from_buckets([connection, user], now=2.0) == 0.0
+
+
+def test_admission_sheds_on_loop_lag_and_pool_pressure():
+    engine = create_engine("sqlite://", poolclass=QueuePool, pool_size=2, max_overflow=0)
+    controller = AdmissionController(
+        [engine], max_loop_lag_ms=100, max_db_pool_usage=1.0, retry_after_seconds=3, enabled=True
+    )
+
+    assert controller.admit("frames", [TokenBucket(1, 1)]) is None
+    controller.record_loop_lag(250)
+    assert controller.admit("frames", [TokenBucket(1, 1)]) == ("overloaded", 3)
+    controller.record_loop_lag(5)
+
+    first, second = engine.connect(), engine.connect()
+    try:
+        assert controller.db_pool_usage() == 1.0
+        assert controller.check() == ("overloaded", 3)
+    finally:
+        first.close()
+        second.close()
+    assert controller.check() is None
+    assert controller.get_metrics() | {"admission_max_loop_lag_ms": 250.0} == {
+        "admission_loop_lag_ms": 5.0,
+        "admission_db_pool_usage": 0.0,
+        "admission_shed_loop_lag": 1,
+        "admission_shed_db_pool": 1,
+        "admission_max_loop_lag_ms": 250.0,
+        "admission_overloaded_frames": 1,
+    }
+
+
+def test_chat_frames_over_the_limit_get_a_rate_limited_frame(client, second_client, monkeypatch):
+    chat_id = start_direct_chat(client, second_client)
+    monkeypatch.setattr("app.routers.messages.new_connection_frame_bucket", lambda: TokenBucket(0.01, 2))
+
+    with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
+        assert receive_json_with_timeout(sender_ws)["type"] == "status"
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
+        for index in range(3):
+            sender_ws.send_text(f'{{"msg":"burst-{index}"}}')
+        assert receive_until_type(sender_ws, "message")["content"] == '{"msg":"burst-0"}'
+        assert receive_until_type(sender_ws, "message")["content"] == '{"msg":"burst-1"}'
+        refused = receive_until_type(sender_ws, "rate_limited")
+
+    assert refused["reason"] == "rate_limited"
+    assert 90_000 <= refused["retry_after_ms"] <= 100_000
+    with SessionLocal() as db:
+        assert db.query(func.count(Message.id)).scalar() == 2
+
+
+def test_uploads_over_the_limit_are_refused_with_retry_after(client, second_client, monkeypatch):
+    chat_id = start_direct_chat(client, second_client)
+    monkeypatch.setattr(upload_buckets, "burst", 1)
+
+    def upload():
+        return client.post(
+            "/messages/upload",
+            data={"chat_id": str(chat_id)},
+            files={"file": ("photo.png", io.BytesIO(b"fake-image-bytes"), "image/png")},
+        )
+
+    assert upload().status_code == 200
+
+    async def body_read(*args, **kwargs):
+        raise AssertionError("a refused upload must not be received")
+
+    monkeypatch.setattr("app.routers.messages.receive_message_attachment", body_read)
+    refused = upload()
+    assert refused.status_code == 429
+    assert 1 <= int(refused.headers["retry-after"]) <= 2
+
+
+def test_upload_chunks_are_shed_under_load(client, second_client, monkeypatch, tmp_path):
+    chat_id = start_direct_chat(client, second_client)
+    monkeypatch.setattr("app.routers.messages.UPLOAD_SESSION_DIR", tmp_path)
+    session = client.post("/messages/uploads", data={"chat_id": str(chat_id), "size": "4"}).json()
+    monkeypatch.setattr(admission, "enabled", True)
+    admission.record_loop_lag(admission.max_loop_lag_ms + 1)
+
+    refused = client.put(f"/messages/uploads/{session['upload_id']}/chunks/0", content=b"data")
+    assert refused.status_code == 503
+    assert refused.headers["retry-after"] == "1"
+
+    admission.record_loop_lag(0)
+    assert client.put(f"/messages/uploads/{session['upload_id']}/chunks/0", content=b"data").status_code == 200
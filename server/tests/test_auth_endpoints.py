@@ -266,3 +266,32 @@ def test_forgot_password_rate_limit(client, monkeypatch):
 
     response = client.post("/forgot-password", data={"email": "user1@example.com"})
     assert response.status_code == 429
+
+
+def test_authenticated_user_is_cached_until_profile_update(client):
+    from sqlalchemy import event
+
+    from app.db.session import async_engine
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+
+    user_lookups = []
+
+    def record_user_lookup(_conn, _cursor, statement, *_args):
+        if "FROM users" in statement:
+            user_lookups.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record_user_lookup)
+    try:
+        assert client.get("/profile").status_code == 200
+        assert client.get("/profile").status_code == 200
+        assert len(user_lookups) == 1
+
+        assert client.post("/profile", data={"name": "alice"}, follow_redirects=False).status_code == 303
+        response = client.get("/profile")
+        assert response.status_code == 200
+        assert "alice" in response.text
+        assert len(user_lookups) == 2
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record_user_lookup)
@@ -0,0 +1,101 @@
+import asyncio
+
+from sqlalchemy import event
+
+from app.utils.chat_roster import ChatRosterCache
+from tests.helpers import login_user, register_user, upload_x3dh_keys
+from tests.test_websocket_messages import receive_until_type
+
+
+def test_roster_is_reused_until_its_version_is_bumped():
+    async def scenario():
+        loads = []
+        members = {5: (1, 2)}
+
+        async def loader(chat_id):
+            loads.append(chat_id)
+            return True, members[chat_id]
+
+        rosters = ChatRosterCache(loader)
+        first = await rosters.get(5)
+        again = await rosters.get(5)
+        assert again is first
+        assert 2 in first
+
+        members[5] = (1,)
+        rosters.bump(5)
+        refreshed = await rosters.get(5)
+        return loads, first, refreshed, rosters.version(5)
+
+    loads, first, refreshed, version = asyncio.run(scenario())
+
+    assert loads == [5, 5]
+    assert first.version == 0
+    assert refreshed.version == version == 1
+    assert 2 not in refreshed
+
+
+def test_bump_during_load_is_not_hidden_by_the_cached_result():
+    async def scenario():
+        rosters = None
+        calls = []
+
+        async def loader(chat_id):
+            calls.append(chat_id)
+            if len(calls) == 1:
+                # A participant is removed while the first read is still in flight.
+                rosters.bump(chat_id)
+                return True, (1, 2)
+            return True, (1,)
+
+        rosters = ChatRosterCache(loader)
+        stale = await rosters.get(9)
+        fresh = await rosters.get(9)
+        return stale, fresh, rosters.version(9), calls
+
+    stale, fresh, version, calls = asyncio.run(scenario())
+
+    assert stale.version != version
+    assert fresh.version == version
+    assert fresh.user_ids == (1,)
+    assert calls == [9, 9]
+
+
+def test_open_connection_does_not_reload_roster_per_message(client, second_client):
+    from app.db.session import async_engine
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_x3dh_keys(
+        second_client,
+        identity_key="public-key-user2",
+        identity_signing_key="identity-signing-user2",
+        signed_prekey="signed-prekey-user2",
+        signed_prekey_signature="signed-prekey-signature-user2",
+        signed_prekey_key_id=101,
+        one_time_prekeys=[],
+    ).status_code == 200
+    chat_id = client.post("/messages/start", data={"username": "user2"}).json()["chat_id"]
+
+    roster_reads = []
+
+    def record_roster_read(_conn, _cursor, statement, *_args):
+        if statement.lstrip().upper().startswith("SELECT") and "FROM chat_participants" in statement:
+            roster_reads.append(statement)
+
+    with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
+        receive_until_type(sender_ws, "history_complete")
+        sender_ws.send_text('{"msg":"warm-up"}')
+        receive_until_type(sender_ws, "message")
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", record_roster_read)
+        try:
+            for index in range(5):
+                sender_ws.send_text(f'{{"msg":"cached-{index}"}}')
+                assert receive_until_type(sender_ws, "message")["content"] == f'{{"msg":"cached-{index}"}}'
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", record_roster_read)
+
+    assert roster_reads == []
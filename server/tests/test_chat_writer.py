@@ -0,0 +1,122 @@
+import asyncio
+
+from app.utils.chat_writer import ChatWriteQueue
+
+
+def test_concurrent_writes_are_group_committed_in_submission_order():
+    async def scenario():
+        batches = []
+        first_batch_started = asyncio.Event()
+        release_first_batch = asyncio.Event()
+
+        async def write_batch(chat_id, jobs):
+            batches.append((chat_id, list(jobs)))
+            if len(batches) == 1:
+                first_batch_started.set()
+                await release_first_batch.wait()
+            return [f"saved-{job}" for job in jobs], None
+
+        writer = ChatWriteQueue(write_batch)
+        first = asyncio.create_task(writer.submit(7, "a"))
+        await first_batch_started.wait()
+
+        # Everything that arrives while a commit is in flight rides along in the next one.
+        queued = [asyncio.create_task(writer.submit(7, job)) for job in ["b", "c", "d"]]
+        await asyncio.sleep(0)
+        assert not any(task.done() for task in queued)
+
+        release_first_batch.set()
+        results = await asyncio.gather(first, *queued)
+        return batches, results, writer
+
+    batches, results, writer = asyncio.run(scenario())
+
+    assert batches == [(7, ["a"]), (7, ["b", "c", "d"])]
+    assert results == ["saved-a", "saved-b", "saved-c", "saved-d"]
+    assert writer.stats == {"batches": 2, "writes": 4, "max_batch_size": 3}
+    assert writer.is_idle()
+
+
+def test_failed_batch_is_reported_to_each_sender_and_writer_recovers():
+    async def scenario():
+        calls = []
+
+        async def write_batch(chat_id, jobs):
+            calls.append(list(jobs))
+            if "boom" in jobs:
+                raise RuntimeError("database unavailable")
+            return list(jobs), None
+
+        writer = ChatWriteQueue(write_batch, max_batch=2)
+        outcomes = await asyncio.gather(
+            writer.submit(1, "boom"),
+            writer.submit(1, "lost"),
+            writer.submit(1, "kept"),
+            return_exceptions=True,
+        )
+        return calls, outcomes
+
+    calls, outcomes = asyncio.run(scenario())
+
+    assert calls == [["boom", "lost"], ["kept"]]
+    assert [type(outcome) for outcome in outcomes[:2]] == [RuntimeError, RuntimeError]
+    assert outcomes[2] == "kept"
+
+
+def test_chats_are_written_independently():
+    async def scenario():
+        release_slow_chat = asyncio.Event()
+
+        async def write_batch(chat_id, jobs):
+            if chat_id == 1:
+                await release_slow_chat.wait()
+            return list(jobs), None
+
+        writer = ChatWriteQueue(write_batch)
+        slow = asyncio.create_task(writer.submit(1, "slow"))
+        fast = await asyncio.wait_for(writer.submit(2, "fast"), timeout=1)
+        assert not slow.done()
+        release_slow_chat.set()
+        return fast, await slow
+
+    assert asyncio.run(scenario()) == ("fast", "slow")
+
+
+def test_writer_restarts_after_going_idle():
+    async def scenario():
+        async def write_batch(chat_id, jobs):
+            return list(jobs), None
+
+        writer = ChatWriteQueue(write_batch)
+        first = await writer.submit(3, "x")
+        assert writer.is_idle()
+        second = await writer.submit(3, "y")
+        return first, second
+
+    assert asyncio.run(scenario()) == ("x", "y")
+
+
+
+def test_failed_fan_out_does_not_fail_committed_writes():
+    async def scenario():
+        delivered = []
+
+        async def fan_out(jobs):
+            if "unlucky" in jobs:
+                raise RuntimeError("socket exploded")
+            delivered.extend(jobs)
+
+        async def write_batch(chat_id, jobs):
+            return [f"saved-{job}" for job in jobs], fan_out(list(jobs))
+
+        writer = ChatWriteQueue(write_batch)
+        first = await writer.submit(5, "unlucky")
+        second = await writer.submit(5, "next")
+        return first, second, delivered, writer
+
+    first, second, delivered, writer = asyncio.run(scenario())
+
+    assert (first, second) == ("saved-unlucky", "saved-next")
+    assert delivered == ["next"]
+    assert writer.stats["writes"] == 2
+    assert writer.is_idle()
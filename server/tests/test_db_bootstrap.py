@@ -0,0 +1,65 @@
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect, text
+
+from app.db.base import Base
+from app.db.bootstrap import ALEMBIC_SCRIPT_DIR, get_current_revisions, get_head_revisions, prepare_schema
+
+
+def stamp(engine, revisions):
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL PRIMARY KEY)"))
+        for revision in revisions:
+            connection.execute(text("INSERT INTO alembic_version (version_num) VALUES (:revision)"), {"revision": revision})
+
+
+def test_current_stamp_skips_schema_introspection(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'stamped.db'}")
+    Base.metadata.create_all(engine)
+    stamp(engine, get_head_revisions())
+
+    def fail_bootstrap(_engine):
+        raise AssertionError("bootstrap should not run for a current schema")
+
+    monkeypatch.setattr("app.db.bootstrap.bootstrap_schema", fail_bootstrap)
+    assert prepare_schema(engine, "auto") == "current"
+    assert prepare_schema(engine, "false") == "current"
+    engine.dispose()
+
+
+def test_unstamped_schema_falls_back_to_bootstrap_unless_disabled(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, username TEXT, password TEXT)"))
+
+    assert prepare_schema(engine, "false") == "stale"
+    assert "chats" not in inspect(engine).get_table_names()
+
+    assert prepare_schema(engine, "auto") == "bootstrapped"
+    inspector = inspect(engine)
+    assert "chats" in inspector.get_table_names()
+    assert "account_instance_id" in {column["name"] for column in inspector.get_columns("users")}
+    engine.dispose()
+
+
+def test_bootstrapped_schema_is_stamped_so_migrations_can_take_over(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    assert prepare_schema(engine, "auto") == "bootstrapped"
+    assert get_current_revisions(engine) == get_head_revisions()
+
+    config = Config()
+    config.set_main_option("script_location", str(ALEMBIC_SCRIPT_DIR))
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        command.upgrade(config, "head")
+
+    assert get_current_revisions(engine) == get_head_revisions()
+    assert prepare_schema(engine, "auto") == "current"
+    engine.dispose()
+
+
+def test_health_probes(client):
+    assert client.get("/health/live").json() == {"status": "ok"}
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json()["database"] is True
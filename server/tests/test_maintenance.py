@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import time
+from datetime import timedelta
+
+from app.db.models import AttachmentBlob, OneTimePreKey, PasswordResetToken, RateLimitCounter, RefreshToken, User
+from app.main import maintenance
+from app.utils.maintenance import (
+    MaintenanceJob,
+    MaintenanceScheduler,
+    purge_expired_password_reset_tokens,
+    purge_expired_rate_limit_counters,
+    purge_expired_refresh_tokens,
+    purge_used_prekeys,
+)
+from app.utils.time import utc_now
+
+
+def add_user(db_session) -> User:
+    user = User(email="user1@example.com", password="hashed", username="user1")
+    db_session.add(user)
+    db_session.commit()
+    return user
+
+
+def test_prekey_purge_runs_in_batches_under_a_single_lease(db_session):
+    user = add_user(db_session)
+    now = utc_now()
+    old = now - timedelta(days=30)
+    db_session.add_all(
+        [OneTimePreKey(user_id=user.id, key_id=key_id, public_key="pk", used_at=old) for key_id in range(5)]
+        + [
+            OneTimePreKey(user_id=user.id, key_id=10, public_key="pk", used_at=now),
+            OneTimePreKey(user_id=user.id, key_id=11, public_key="pk"),
+        ]
+    )
+    db_session.commit()
+
+    batch_sizes = []
+
+    async def run(batch_size, max_batches):
+        batch_sizes.append((batch_size, max_batches))
+        return await purge_used_prekeys(batch_size, max_batches)
+
+    job = MaintenanceJob("used_prekeys", run, interval_seconds=600)
+    first = MaintenanceScheduler([job], owner="worker-a", batch_size=2, max_batches=2)
+    second = MaintenanceScheduler([job], owner="worker-b", batch_size=2, max_batches=2)
+
+    async def scenario():
+        return await first.run_job("used_prekeys"), await second.run_job("used_prekeys")
+
+    assert asyncio.run(scenario()) == (True, False)
+    # Two batches of two were allowed this run; the fifth row waits for the next interval.
+    db_session.expire_all()
+    assert db_session.query(OneTimePreKey).count() == 3
+    assert batch_sizes == [(2, 2)]
+
+    stats = first.stats["used_prekeys"]
+    assert (stats["runs"], stats["rows"], stats["last_rows"], stats["errors"]) == (1, 4, 4, 0)
+    assert stats["last_run_at"] > 0
+    assert second.stats["used_prekeys"]["skipped"] == 1
+    assert first.get_metrics()["maintenance_used_prekeys_rows"] == 4
+
+
+def test_expired_tokens_are_purged(db_session):
+    user = add_user(db_session)
+    now = utc_now()
+    db_session.add_all(
+        [
+            RefreshToken(token="expired", user_id=user.id, expires_at=now - timedelta(minutes=1)),
+            RefreshToken(token="valid", user_id=user.id, expires_at=now + timedelta(days=1)),
+            PasswordResetToken(token_id="expired", user_id=user.id, expires_at=now - timedelta(minutes=1), used_at=now),
+            PasswordResetToken(token_id="valid", user_id=user.id, expires_at=now + timedelta(hours=1)),
+            RateLimitCounter(key="login:expired", window_index=1, expires_at=now - timedelta(minutes=1)),
+            RateLimitCounter(key="login:valid", window_index=1, expires_at=now + timedelta(minutes=1)),
+        ]
+    )
+    db_session.commit()
+
+    async def scenario():
+        return (
+            await purge_expired_refresh_tokens(100, 1),
+            await purge_expired_password_reset_tokens(100, 1),
+            await purge_expired_rate_limit_counters(100, 1),
+        )
+
+    assert asyncio.run(scenario()) == (1, 1, 1)
+    db_session.expire_all()
+    assert [token.token for token in db_session.query(RefreshToken)] == ["valid"]
+    assert [token.token_id for token in db_session.query(PasswordResetToken)] == ["valid"]
+    assert [counter.key for counter in db_session.query(RateLimitCounter)] == ["login:valid"]
+
+
+def test_orphan_upload_purge_removes_unreferenced_blobs_sessions_and_spool_files(db_session, monkeypatch, tmp_path):
+    from app.routers import messages
+
+    upload_dir = tmp_path / "messages"
+    session_dir = tmp_path / "sessions"
+    monkeypatch.setattr(messages, "MESSAGE_UPLOAD_DIR", upload_dir)
+    monkeypatch.setattr(messages, "UPLOAD_SESSION_DIR", session_dir)
+    monkeypatch.setattr(messages, "ORPHAN_UPLOAD_GRACE_SECONDS", 3600)
+    monkeypatch.setattr(messages, "UPLOAD_SESSION_TTL_SECONDS", 3600)
+
+    now = utc_now()
+    blobs = {"orphan": (0, now - timedelta(days=2)), "fresh": (0, now), "referenced": (1, now - timedelta(days=2))}
+    for name, (ref_count, created_at) in blobs.items():
+        (upload_dir / "ab" / "cd").mkdir(parents=True, exist_ok=True)
+        (upload_dir / "ab" / "cd" / f"{name}.bin").write_bytes(b"blob")
+        db_session.add(
+            AttachmentBlob(
+                url=f"/static/uploads/messages/ab/cd/{name}.bin",
+                sha256="0" * 64,
+                size=4,
+                ref_count=ref_count,
+                created_at=created_at,
+            )
+        )
+    db_session.commit()
+
+    store = messages.get_upload_session_store()
+    stale = store.create(user_id=1, chat_id=1, size=10, max_size=100, details={})
+    fresh = store.create(user_id=1, chat_id=1, size=10, max_size=100, details={})
+    stale_metadata = session_dir / stale["upload_id"] / "session.json"
+    stale_metadata.write_text(json.dumps({**stale, "created_at": time.time() - 7200}), encoding="utf-8")
+
+    spool_dir = upload_dir / ".incoming"
+    spool_dir.mkdir()
+    (spool_dir / "abandoned.bin").write_bytes(b"partial")
+    (spool_dir / "in-flight.bin").write_bytes(b"partial")
+    two_hours_ago = time.time() - 7200
+    os.utime(spool_dir / "abandoned.bin", (two_hours_ago, two_hours_ago))
+
+    assert asyncio.run(messages.purge_orphan_uploads(100, 1)) == 3
+
+    db_session.expire_all()
+    assert sorted(blob.url.rsplit("/", 1)[1] for blob in db_session.query(AttachmentBlob)) == ["fresh.bin", "referenced.bin"]
+    assert sorted(path.name for path in (upload_dir / "ab" / "cd").iterdir()) == ["fresh.bin", "referenced.bin"]
+    assert [path.name for path in session_dir.iterdir()] == [fresh["upload_id"]]
+    assert [path.name for path in spool_dir.iterdir()] == ["in-flight.bin"]
+
+
+def test_maintenance_stats_are_exposed_with_websocket_metrics(client, monkeypatch):
+    from app import main
+
+    monkeypatch.setattr(main, "METRICS_TOKEN", "scrape-token")
+    response = client.get("/internal/metrics/websockets", headers={"Authorization": "Bearer scrape-token"})
+
+    assert response.status_code == 200
+    metrics = response.json()
+    assert set(maintenance.jobs) == {
+        "used_prekeys",
+        "used_device_prekeys",
+        "expired_refresh_tokens",
+        "expired_password_reset_tokens",
+        "expired_rate_limit_counters",
+        "orphan_uploads",
+    }
+    for name in maintenance.jobs:
+        assert f"maintenance_{name}_runs" in metrics
+        assert f"maintenance_{name}_last_duration_ms" in metrics
@@ -1,10 +1,14 @@
+import asyncio
+import hashlib
 import io
+from datetime import timedelta
 
 from fastapi.testclient import TestClient
 
-from app.db.models import Chat, DeletedMessage, Message
+from app.db.models import AttachmentBlob, Chat, DeletedMessage, Message, User
 from app.utils.time import utc_now
 from tests.helpers import login_user, register_user, upload_x3dh_keys
+from tests.test_websocket_messages import receive_until_type
 
 
 def test_protected_message_routes_require_authentication(client):
@@ -273,11 +277,341 @@ def test_encrypted_message_attachment_upload_hides_plain_metadata(client, second
         "name": "encrypted-media.bin",
         "mime_type": "application/octet-stream",
         "size": len(b"encrypted-media-bytes"),
+        "sha256": hashlib.sha256(b"encrypted-media-bytes").hexdigest(),
         "url": payload["attachment"]["url"],
     }
     assert payload["attachment"]["url"].startswith("/static/uploads/messages/")
 
 
+def test_message_attachment_upload_is_streamed_and_limited_while_reading(client, second_client, db_session, monkeypatch, tmp_path):
+    from starlette.requests import Request
+
+    from app.routers import messages as messages_router
+    from app.utils import uploads
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    chat = Chat(user1_id=1, user2_id=2)
+    db_session.add(chat)
+    db_session.commit()
+    chat_id = chat.id
+
+    monkeypatch.setattr(messages_router, "MESSAGE_UPLOAD_DIR", tmp_path)
+    monkeypatch.setattr(messages_router, "MAX_MESSAGE_UPLOAD_SIZE_BYTES", 10_000)
+    monkeypatch.setattr(uploads, "UPLOAD_FORM_OVERHEAD_BYTES", 1024)
+
+    async def spooled_form(self, *args, **kwargs):
+        raise AssertionError("the upload body was spooled by request.form()")
+
+    monkeypatch.setattr(Request, "form", spooled_form)
+
+    content = bytes(range(256)) * 39
+    accepted = client.post(
+        "/messages/upload",
+        data={"chat_id": str(chat_id)},
+        files={"file": ("voice.mp3", io.BytesIO(content), "audio/mpeg")},
+    )
+    assert accepted.status_code == 200
+    attachment = accepted.json()["attachment"]
+    assert attachment["size"] == len(content)
+    assert attachment["sha256"] == hashlib.sha256(content).hexdigest()
+    sha256 = hashlib.sha256(content).hexdigest()
+    assert attachment["url"] == f"/static/uploads/messages/{sha256[:2]}/{sha256[2:4]}/{sha256}.mp3"
+    stored = tmp_path / sha256[:2] / sha256[2:4] / f"{sha256}.mp3"
+    assert stored.read_bytes() == content
+
+    rejected = client.post(
+        "/messages/upload",
+        data={"chat_id": str(chat_id)},
+        files={"file": ("long.mp3", io.BytesIO(b"x" * 10_001), "audio/mpeg")},
+        headers={"Accept": "application/json"},
+    )
+    assert rejected.status_code == 400
+    assert rejected.json()["detail"] == "Attachment is too large"
+    # A declared length that cannot fit is refused without reading the body at all.
+    declared = client.post(
+        "/messages/upload",
+        content=b"",
+        headers={
+            "Accept": "application/json",
+            "Content-Type": "multipart/form-data; boundary=x",
+            "Content-Length": str(10_000 + 1024 + 1),
+        },
+    )
+    assert declared.status_code == 400
+    assert declared.json()["detail"] == "Attachment is too large"
+
+    unsupported = client.post(
+        "/messages/upload",
+        data={"chat_id": str(chat_id)},
+        files={"file": ("script.exe", io.BytesIO(b"MZ"), "application/octet-stream")},
+        headers={"Accept": "application/json"},
+    )
+    assert unsupported.status_code == 400
+    assert [path for path in tmp_path.rglob("*") if path.is_file()] == [stored]
+
+
+def test_resumable_upload_accepts_chunks_in_any_order_and_finalizes(client, second_client, db_session, monkeypatch, tmp_path):
+    from app.routers import messages as messages_router
+    from app.utils import resumable_uploads
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    chat = Chat(user1_id=1, user2_id=2)
+    db_session.add(chat)
+    db_session.commit()
+    chat_id = chat.id
+
+    upload_dir = tmp_path / "messages"
+    session_dir = tmp_path / "sessions"
+    monkeypatch.setattr(messages_router, "MESSAGE_UPLOAD_DIR", upload_dir)
+    monkeypatch.setattr(messages_router, "UPLOAD_SESSION_DIR", session_dir)
+    monkeypatch.setattr(resumable_uploads, "RESUMABLE_UPLOAD_CHUNK_SIZE_BYTES", 4)
+    json_headers = {"Accept": "application/json"}
+
+    content = b"0123456789"
+    created = client.post(
+        "/messages/uploads",
+        data={"chat_id": str(chat_id), "size": str(len(content)), "sha256": hashlib.sha256(content).hexdigest()},
+    )
+    assert created.status_code == 200
+    session = created.json()
+    upload_id = session["upload_id"]
+    assert session["chunk_count"] == 3
+    assert session["received_chunks"] == []
+
+    assert client.put(f"/messages/uploads/{upload_id}/chunks/2?offset=8", content=content[8:]).status_code == 200
+    assert client.put(f"/messages/uploads/{upload_id}/chunks/0", content=content[:4]).status_code == 200
+    # A retried chunk replaces the earlier copy.
+    assert client.put(f"/messages/uploads/{upload_id}/chunks/0", content=content[:4]).status_code == 200
+    status = client.get(f"/messages/uploads/{upload_id}").json()
+    assert status["received_chunks"] == [0, 2]
+    assert status["complete"] is False
+
+    incomplete = client.post(f"/messages/uploads/{upload_id}/finalize", headers=json_headers)
+    assert incomplete.status_code == 400
+    assert incomplete.json()["detail"] == "Upload is missing chunks"
+
+    misplaced = client.put(f"/messages/uploads/{upload_id}/chunks/1?offset=5", content=content[4:8], headers=json_headers)
+    assert misplaced.status_code == 400
+    oversized = client.put(f"/messages/uploads/{upload_id}/chunks/1", content=b"too-long", headers=json_headers)
+    assert oversized.status_code == 400
+    assert client.get(f"/messages/uploads/{upload_id}").json()["received_chunks"] == [0, 2]
+
+    assert second_client.get(f"/messages/uploads/{upload_id}", headers=json_headers).status_code == 404
+    assert second_client.put(f"/messages/uploads/{upload_id}/chunks/1", content=content[4:8], headers=json_headers).status_code == 404
+
+    assert client.put(f"/messages/uploads/{upload_id}/chunks/1", content=content[4:8]).status_code == 200
+    finalized = client.post(f"/messages/uploads/{upload_id}/finalize")
+    assert finalized.status_code == 200
+    attachment = finalized.json()["attachment"]
+    sha256 = hashlib.sha256(content).hexdigest()
+    stored_name = f"{sha256[:2]}/{sha256[2:4]}/{sha256}.bin"
+    assert attachment == {
+        "kind": "encrypted",
+        "url": f"/static/uploads/messages/{stored_name}",
+        "name": "encrypted-media.bin",
+        "mime_type": "application/octet-stream",
+        "size": len(content),
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+    assert (upload_dir / stored_name).read_bytes() == content
+    assert list(session_dir.iterdir()) == []
+    assert client.get(f"/messages/uploads/{upload_id}", headers=json_headers).status_code == 404
+
+
+def test_resumable_upload_requires_chat_membership_and_size_limit(client, second_client, db_session, monkeypatch, tmp_path):
+    from app.routers import messages as messages_router
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    chat = Chat(user1_id=2, user2_id=2)
+    own_chat = Chat(user1_id=1, user2_id=2)
+    db_session.add_all([chat, own_chat])
+    db_session.commit()
+
+    monkeypatch.setattr(messages_router, "UPLOAD_SESSION_DIR", tmp_path)
+    monkeypatch.setattr(messages_router, "MAX_MESSAGE_UPLOAD_SIZE_BYTES", 100)
+    json_headers = {"Accept": "application/json"}
+
+    outsider = client.post("/messages/uploads", data={"chat_id": str(chat.id), "size": "10"}, headers=json_headers)
+    assert outsider.status_code == 403
+    too_large = client.post("/messages/uploads", data={"chat_id": str(own_chat.id), "size": "101"}, headers=json_headers)
+    assert too_large.status_code == 400
+    assert too_large.json()["detail"] == "Attachment is too large"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_identical_attachments_share_one_blob_that_is_purged_once_unreferenced(client, second_client, db_session, monkeypatch, tmp_path):
+    from app.routers import messages as messages_router
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_x3dh_keys(
+        second_client,
+        identity_key="public-key-user2",
+        identity_signing_key="identity-signing-user2",
+        signed_prekey="signed-prekey-user2",
+        signed_prekey_signature="signed-prekey-signature-user2",
+        signed_prekey_key_id=101,
+        one_time_prekeys=[],
+    ).status_code == 200
+    chat_id = client.post("/messages/start", data={"username": "user2"}).json()["chat_id"]
+    monkeypatch.setattr(messages_router, "MESSAGE_UPLOAD_DIR", tmp_path)
+
+    content = b"same-track" * 100
+    urls = []
+    for _attempt in range(2):
+        response = client.post(
+            "/messages/upload",
+            data={"chat_id": str(chat_id)},
+            files={"file": ("track.mp3", io.BytesIO(content), "audio/mpeg")},
+        )
+        assert response.status_code == 200
+        urls.append(response.json()["attachment"]["url"])
+    assert urls[0] == urls[1]
+    stored_files = [path for path in tmp_path.rglob("*") if path.is_file()]
+    assert len(stored_files) == 1
+    assert db_session.get(AttachmentBlob, urls[0]).ref_count == 0
+
+    attachment = {"kind": "audio", "url": urls[0], "name": "track.mp3", "mime_type": "audio/mpeg", "size": len(content)}
+    with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
+        receive_until_type(sender_ws, "history_complete")
+        for caption in ("first", "again"):
+            sender_ws.send_json({"type": "media_message", "caption": caption, "attachment": attachment})
+            receive_until_type(sender_ws, "message")
+
+    db_session.expire_all()
+    assert db_session.get(AttachmentBlob, urls[0]).ref_count == 2
+    first_message, second_message = db_session.query(Message).filter(Message.chat_id == chat_id).order_by(Message.id).all()
+
+    assert client.post(f"/messages/{first_message.id}/delete-all").status_code == 200
+    db_session.expire_all()
+    assert db_session.get(AttachmentBlob, urls[0]).ref_count == 1
+    assert stored_files[0].exists()
+
+    assert client.post(f"/chats/{chat_id}/delete-all").status_code == 200
+    db_session.expire_all()
+    blob = db_session.get(AttachmentBlob, urls[0])
+    assert blob.ref_count == 0
+    assert db_session.get(Message, second_message.id).attachment_url is None
+    # Dropping the last reference leaves the file to the purge job and its grace period.
+    assert stored_files[0].exists()
+    assert asyncio.run(messages_router.purge_orphan_uploads(100, 1)) == 0
+    assert stored_files[0].exists()
+
+    blob.created_at = utc_now() - timedelta(days=2)
+    db_session.commit()
+    assert asyncio.run(messages_router.purge_orphan_uploads(100, 1)) == 1
+    db_session.expire_all()
+    assert db_session.get(AttachmentBlob, urls[0]) is None
+    assert not stored_files[0].exists()
+
+
+def test_reuploaded_blob_restarts_its_grace_period_and_purged_blobs_are_not_referenced(db_session):
+    from app.db.session import AsyncSessionLocal
+    from app.utils.blob_store import acquire_attachment_refs, register_attachment_blob
+
+    url = "/static/uploads/messages/ab/cd/abcd.bin"
+    user = User(email="user1@example.com", password="hash", username="user1")
+    db_session.add(user)
+    db_session.commit()
+    db_session.add(AttachmentBlob(url=url, sha256="ab" * 32, size=4, ref_count=0, created_at=utc_now() - timedelta(days=2)))
+    db_session.commit()
+
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            await register_attachment_blob(db, url, "ab" * 32, 4, uploaded_by=user.id)
+            await db.commit()
+        async with AsyncSessionLocal() as db:
+            missing = await acquire_attachment_refs(db, [url, url, "/static/uploads/messages/ef/gh/purged.bin", None])
+            await db.commit()
+        return missing
+
+    assert asyncio.run(scenario()) == {"/static/uploads/messages/ef/gh/purged.bin"}
+    db_session.expire_all()
+    blob = db_session.get(AttachmentBlob, url)
+    assert blob.ref_count == 2
+    assert blob.created_at > utc_now() - timedelta(minutes=1)
+
+
+def test_blob_store_rejects_urls_outside_its_directory(tmp_path):
+    from app.utils.blob_store import ContentAddressedBlobStore
+    from app.utils.storage import LocalStorage
+
+    prefix = "/static/uploads/messages/"
+    store = ContentAddressedBlobStore(LocalStorage(tmp_path, prefix), prefix)
+    assert store.key_for_url("/static/uploads/messages/ab/cd/abcd.bin") == "ab/cd/abcd.bin"
+    assert store.key_for_url("/static/uploads/messages/legacy.mp3") == "legacy.mp3"
+    assert store.key_for_url("/static/uploads/messages/../avatars/me.png") is None
+    assert store.key_for_url("/static/uploads/messages/.incoming/upload.bin") is None
+    assert store.key_for_url("/static/uploads/avatars/me.png") is None
+    assert store.key_for_url(None) is None
+
+
+def test_attachment_download_checks_membership_and_supports_ranges(client, second_client, db_session, monkeypatch, tmp_path):
+    from app.routers import messages as messages_router
+    from app.utils import attachment_download
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    monkeypatch.setattr(messages_router, "MESSAGE_UPLOAD_DIR", tmp_path)
+
+    content = bytes(range(256)) * 4
+    sha256 = hashlib.sha256(content).hexdigest()
+    blob_path = f"{sha256[:2]}/{sha256[2:4]}/{sha256}.bin"
+    (tmp_path / sha256[:2] / sha256[2:4]).mkdir(parents=True)
+    (tmp_path / blob_path).write_bytes(content)
+    (tmp_path / "unshared.bin").write_bytes(b"not in this chat")
+
+    chat = Chat(user1_id=1, user2_id=2)
+    other_chat = Chat(user1_id=2, user2_id=2)
+    db_session.add_all([chat, other_chat])
+    db_session.commit()
+    for chat_row in (chat, other_chat):
+        db_session.add(Message(
+            chat_id=chat_row.id,
+            sender_id=2,
+            content="cipher",
+            attachment_kind="encrypted",
+            attachment_url=f"/static/uploads/messages/{blob_path}",
+        ))
+    db_session.commit()
+    download_url = f"/messages/{chat.id}/attachments/{blob_path}"
+    json_headers = {"Accept": "application/json"}
+
+    full = client.get(download_url)
+    assert full.status_code == 200
+    assert full.content == content
+    assert full.headers["etag"] == f'"{sha256}"'
+    assert "immutable" in full.headers["cache-control"]
+
+    partial = client.get(download_url, headers={"Range": "bytes=100-199"})
+    assert partial.status_code == 206
+    assert partial.content == content[100:200]
+    assert partial.headers["content-range"] == f"bytes 100-199/{len(content)}"
+
+    assert client.get(download_url, headers={"If-None-Match": f'"{sha256}"'}).status_code == 304
+    assert client.head(download_url).headers["content-length"] == str(len(content))
+
+    assert client.get(f"/messages/{other_chat.id}/attachments/{blob_path}", headers=json_headers).status_code == 403
+    assert client.get(f"/messages/{chat.id}/attachments/unshared.bin", headers=json_headers).status_code == 404
+    assert client.get(f"/static/uploads/messages/{blob_path}", headers=json_headers).status_code == 404
+
+    monkeypatch.setattr(attachment_download, "ATTACHMENT_OFFLOAD_MODE", "x-accel-redirect")
+    offloaded = client.get(download_url)
+    assert offloaded.status_code == 200
+    assert offloaded.content == b""
+    assert offloaded.headers["x-accel-redirect"] == f"/internal/uploads/messages/{blob_path}"
+
+
 def test_security_headers_present_on_messages_page(client):
     response = client.get("/")
     assert response.status_code == 200
@@ -696,3 +1030,59 @@ def test_direct_chat_restart_after_delete_all_returns_fresh_session_bootstrap(cl
     forced_keys_payload = forced_keys_response.json()
     assert forced_keys_payload["status"] == "ok"
     assert forced_keys_payload["prekey_bundle"]["one_time_prekey"] is None
+
+
+def test_messages_page_chat_list_is_cached_and_uses_constant_queries(client, second_client):
+    from sqlalchemy import event
+
+    from app.db.session import engine
+
+    partner_clients = [second_client]
+    for _ in range(3, 6):
+        partner_client = TestClient(client.app)
+        partner_client.get("/")
+        partner_client.headers["X-CSRF-Token"] = partner_client.cookies.get("csrf_token", "")
+        partner_clients.append(partner_client)
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    for index, partner_client in enumerate(partner_clients, start=2):
+        assert register_user(partner_client, f"user{index}@example.com").status_code == 303
+        assert login_user(partner_client, f"user{index}@example.com").status_code == 303
+        assert upload_x3dh_keys(
+            partner_client,
+            identity_key=f"public-key-user{index}",
+            identity_signing_key=f"identity-signing-user{index}",
+            signed_prekey=f"signed-prekey-user{index}",
+            signed_prekey_signature=f"signed-prekey-signature-user{index}",
+            signed_prekey_key_id=100 + index,
+            one_time_prekeys=[],
+        ).status_code == 200
+    assert login_user(client, "user1@example.com").status_code == 303
+
+    statements = []
+
+    def count_statement(*_args):
+        statements.append(True)
+
+    def load_messages_page():
+        statements.clear()
+        event.listen(engine, "before_cursor_execute", count_statement)
+        try:
+            response = client.get("/messages")
+        finally:
+            event.remove(engine, "before_cursor_execute", count_statement)
+        assert response.status_code == 200
+        return response, len(statements)
+
+    assert client.post("/messages/start", data={"username": "user2"}).json()["status"] == "ok"
+    first_page, one_chat_statements = load_messages_page()
+    assert "user2" in first_page.text
+
+    for username in ["user3", "user4", "user5"]:
+        assert client.post("/messages/start", data={"username": username}).json()["status"] == "ok"
+    refreshed_page, many_chats_statements = load_messages_page()
+    assert all(username in refreshed_page.text for username in ["user3", "user4", "user5"])
+    assert many_chats_statements == one_chat_statements
+
+    _cached_page, cached_statements = load_messages_page()
+    assert cached_statements < many_chats_statements
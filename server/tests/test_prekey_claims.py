@@ -0,0 +1,148 @@
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from app.db.models import Device, DeviceOneTimePreKey, User
+from app.db.session import AsyncSessionLocal, async_engine
+from app.utils.prekeys import claim_device_prekeys
+from tests.helpers import login_user, register_user, upload_x3dh_keys
+
+
+def upload_device_keys(test_client, device_id: str, key_ids: range):
+    return upload_x3dh_keys(
+        test_client,
+        device_id=device_id,
+        identity_key=f"identity-{device_id}",
+        identity_signing_key=f"signing-{device_id}",
+        signed_prekey=f"signed-prekey-{device_id}",
+        signed_prekey_signature=f"signature-{device_id}",
+        signed_prekey_key_id=1,
+        one_time_prekeys=[{"key_id": key_id, "public_key": f"otpk-{key_id}"} for key_id in key_ids],
+    )
+
+
+def test_concurrent_claims_never_issue_a_prekey_twice(client, second_client):
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_device_keys(second_client, "device-a", range(100, 115)).status_code == 200
+    assert upload_device_keys(second_client, "device-b", range(200, 215)).status_code == 200
+
+    def fetch(path):
+        response = client.get(path, params={"username": "user2"})
+        assert response.status_code == 200
+        return response.json()
+
+    requests = ["/users/device-prekey-bundles", "/users/prekey-bundle"] * 20
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        responses = list(pool.map(fetch, requests))
+
+    device_claims = Counter()
+    user_claims = Counter()
+    for payload in responses:
+        assert payload["status"] == "ok"
+        for bundle in payload.get("devices", []):
+            if bundle["one_time_prekey"]:
+                device_claims[(bundle["device_id"], bundle["one_time_prekey"]["key_id"])] += 1
+        if "bundle" in payload and payload["bundle"]["one_time_prekey"]:
+            user_claims[payload["bundle"]["one_time_prekey"]["key_id"]] += 1
+
+    # Twenty claims per device against fifteen keys each: every key goes out exactly once.
+    assert set(device_claims.values()) == {1}
+    assert sorted(key for device, key in device_claims if device == "device-a") == list(range(100, 115))
+    assert sorted(key for device, key in device_claims if device == "device-b") == list(range(200, 215))
+    # The account-level keys were replaced by the second upload.
+    assert set(user_claims.values()) == {1}
+    assert sorted(user_claims) == list(range(200, 215))
+
+
+def test_batched_claim_takes_one_key_per_device_in_one_statement(db_session):
+    user = User(email="user1@example.com", password="hashed", username="user1")
+    db_session.add(user)
+    db_session.commit()
+    db_session.add_all([Device(user_id=user.id, device_id=device_id) for device_id in ("a", "b", "empty")])
+    db_session.add_all(
+        DeviceOneTimePreKey(device_id=device_id, key_id=key_id, public_key=f"{device_id}-{key_id}")
+        for device_id in ("a", "b")
+        for key_id in (1, 2)
+    )
+    db_session.commit()
+
+    statements = []
+
+    def record(_conn, _cursor, statement, _parameters, _context, _executemany):
+        statements.append(statement)
+
+    async def scenario():
+        async with AsyncSessionLocal() as db:
+            event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+            try:
+                first = await claim_device_prekeys(db, ["a", "b", "empty", "a"])
+            finally:
+                event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+            second = await claim_device_prekeys(db, ["a", "b"])
+            third = await claim_device_prekeys(db, ["a", "b"])
+            await db.commit()
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+
+    assert len(statements) == 1
+    assert first == {"a": {"key_id": 1, "public_key": "a-1"}, "b": {"key_id": 1, "public_key": "b-1"}}
+    assert second == {"a": {"key_id": 2, "public_key": "a-2"}, "b": {"key_id": 2, "public_key": "b-2"}}
+    assert third == {}
+
+
+def test_group_bundles_take_the_same_statements_for_any_number_of_devices(client):
+    from fastapi.testclient import TestClient
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    for index in range(2, 6):
+        partner_client = TestClient(client.app)
+        partner_client.get("/")
+        partner_client.headers["X-CSRF-Token"] = partner_client.cookies.get("csrf_token", "")
+        assert register_user(partner_client, f"user{index}@example.com").status_code == 303
+        assert login_user(partner_client, f"user{index}@example.com").status_code == 303
+        for device in ("a", "b"):
+            key_ids = range(index * 100 + (10 if device == "b" else 0), index * 100 + (13 if device == "b" else 3))
+            assert upload_device_keys(partner_client, f"user{index}-{device}", key_ids).status_code == 200
+    assert login_user(client, "user1@example.com").status_code == 303
+    # Loads the requesting user into the user cache, so only the group's own queries are counted.
+    assert client.get("/users/me").status_code == 200
+
+    statements = []
+
+    def record(_conn, _cursor, statement, *_args):
+        statements.append(statement)
+
+    def counted(method, path, **kwargs):
+        statements.clear()
+        event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+        try:
+            response = getattr(client, method)(path, **kwargs)
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+        assert response.status_code == 200
+        assert response.json()["status"] == "ok"
+        return response.json(), len(statements)
+
+    small, small_statements = counted("post", "/messages/start-group", data={"title": "Small", "usernames": '["user2"]'})
+    large, large_statements = counted(
+        "post", "/messages/start-group", data={"title": "Large", "usernames": '["user3","user4","user5"]'}
+    )
+    assert len(small["device_bundles"]) == 2
+    assert len(large["device_bundles"]) == 6
+    assert large_statements == small_statements
+    assert [
+        [bundle["one_time_prekey"]["key_id"] for bundle in participant["device_bundles"]]
+        for participant in large["participants"]
+    ] == [[300, 310], [400, 410], [500, 510]]
+
+    _small_keys, small_peek_statements = counted("get", "/messages/device-keys", params={"chat_id": small["chat_id"]})
+    large_keys, large_peek_statements = counted("get", "/messages/device-keys", params={"chat_id": large["chat_id"]})
+    assert large_peek_statements == small_peek_statements
+    # Peeking shows the next key without using it up.
+    assert [bundle["one_time_prekey"]["key_id"] for bundle in large_keys["device_bundles"]] == [301, 311, 401, 411, 501, 511]
@@ -0,0 +1,84 @@
+import asyncio
+
+from app.utils.presence import ContactGraph
+from app.utils.websocket_manager import ConnectionManager
+from tests.test_websocket_broker import FakeWebSocket
+
+
+CHAT_MEMBERS = {
+    1: {10: {1, 2}},
+    2: {10: {1, 2}},
+    3: {11: {3}},
+}
+
+
+def build_manager(loads):
+    async def loader(user_id):
+        loads.append(user_id)
+        return CHAT_MEMBERS.get(user_id, {})
+
+    return ConnectionManager(contact_graph=ContactGraph(loader), presence_debounce_seconds=0.05)
+
+
+def status_events(websocket):
+    return [event for event in websocket.sent if event["type"] == "status"]
+
+
+def test_presence_reaches_only_contacts_once_per_interval():
+    async def scenario():
+        loads = []
+        manager = build_manager(loads)
+        contact_socket = FakeWebSocket()
+        stranger_socket = FakeWebSocket()
+        chat_socket = FakeWebSocket()
+        other_chat_socket = FakeWebSocket()
+        await manager.connect_user(2, contact_socket)
+        await manager.connect_user(3, stranger_socket)
+        await manager.connect_chat(10, 2, chat_socket)
+        await manager.connect_chat(11, 3, other_chat_socket)
+        await asyncio.sleep(0.1)
+        contact_socket.sent.clear()
+        stranger_socket.sent.clear()
+        chat_socket.sent.clear()
+        other_chat_socket.sent.clear()
+
+        flapping_socket = FakeWebSocket()
+        await manager.connect_user(1, flapping_socket)
+        manager.disconnect_user(1, flapping_socket)
+        await asyncio.sleep(0)
+        flapping_socket = FakeWebSocket()
+        await manager.connect_user(1, flapping_socket)
+        await asyncio.sleep(0.1)
+
+        online = {"type": "status", "user_id": 1, "is_online": True}
+        assert status_events(contact_socket) == [online]
+        assert status_events(chat_socket) == [online]
+        assert status_events(stranger_socket) == []
+        assert status_events(other_chat_socket) == []
+
+        manager.disconnect_user(1, flapping_socket)
+        await asyncio.sleep(0.1)
+        assert status_events(contact_socket)[-1] == {"type": "status", "user_id": 1, "is_online": False}
+        assert loads.count(1) == 1
+
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_contact_graph_invalidation_reloads_members():
+    async def scenario():
+        loads = []
+        manager = build_manager(loads)
+        graph = manager.contact_graph
+
+        assert await graph.get_chat_members(1) == {10: {1, 2}}
+        assert await graph.get_chat_members(1) == {10: {1, 2}}
+        await manager.invalidate_contacts([4], chat_id=10)
+        assert await graph.get_chat_members(1) == {10: {1, 2}}
+        await manager.invalidate_contacts([3])
+        await graph.get_chat_members(3)
+
+        assert loads == [1, 1, 3]
+
+    asyncio.run(scenario())
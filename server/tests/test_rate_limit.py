@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from app.core.rate_limit import (
+    DatabaseRateLimitBackend,
+    MemoryRateLimitBackend,
+    RateLimit,
+    RateLimiter,
+)
+from app.db.models import RateLimitCounter
+
+
+def test_memory_backend_slides_the_window_and_stays_bounded():
+    rule = RateLimit("test", 4, 10)
+    backend = MemoryRateLimitBackend(max_keys=3)
+
+    assert [backend.hit(rule, "ip", 100.0 + offset)[0] for offset in range(5)] == [True, True, True, True, False]
+    # 80% of the previous window still overlaps: 4 * 0.8 leaves room for one more.
+    assert backend.hit(rule, "ip", 112.0) == (True, 0.0)
+    allowed, retry_after = backend.hit(rule, "ip", 112.0)
+    assert not allowed
+    assert retry_after == 0.5
+    # Rejected hits are not counted, so waiting out the hint is enough.
+    assert backend.hit(rule, "ip", 112.51)[0]
+
+    for key in ("a", "b", "c"):
+        backend.hit(rule, key, 113.0)
+    assert backend.get_metrics() == {"keys": 3, "evicted": 1}
+    # "ip" was least recently used, so it went first and starts over.
+    assert backend.hit(rule, "ip", 113.0)[0]
+    # Expired keys are dropped as soon as they reach the front.
+    backend.hit(rule, "d", 500.0)
+    assert backend.get_metrics()["keys"] == 1
+
+
+def test_database_backend_shares_one_allowance_between_workers(db_session):
+    rule = RateLimit("login", 5, 60)
+    workers = [RateLimiter(DatabaseRateLimitBackend(), clock=lambda: 1_000_000.0) for _ in range(4)]
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(lambda index: workers[index % 4].hit(rule, "10.0.0.1")[0], range(12)))
+
+    assert results.count(True) == 5
+    assert workers[0].hit(rule, "10.0.0.2") == (True, 0.0)
+    counter = db_session.get(RateLimitCounter, "login:10.0.0.1")
+    assert (counter.current_count, counter.previous_count, counter.last_hit_allowed) == (5, 0, False)
+
+    later = RateLimiter(DatabaseRateLimitBackend(), clock=lambda: 1_000_050.0)
+    # Halfway through the next window the five earlier hits weigh 2.5, leaving room for three.
+    assert [later.hit(rule, "10.0.0.1")[0] for _ in range(4)] == [True, True, True, False]
+    assert 0 < later.hit(rule, "10.0.0.1")[1] <= 60
+
+
+def test_login_rate_limit_answers_with_retry_after(client):
+    for _ in range(5):
+        response = client.post("/login", data={"email": "user1@example.com", "password": "wrong"})
+        assert response.status_code != 429
+
+    response = client.post("/login", data={"email": "user1@example.com", "password": "wrong"})
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["retry-after"]) <= 60
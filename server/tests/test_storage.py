@@ -0,0 +1,222 @@
+import hashlib
+import io
+import re
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+import pytest
+from botocore.awsrequest import AWSResponse
+
+from app.db.models import Chat, Message
+from app.utils.storage import S3Client, S3Storage, StorageError
+from tests.helpers import login_user, register_user
+
+
+class RawBody:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def stream(self, **_kwargs):
+        yield self.content
+
+
+class FakeS3:
+    """In-process stand-in for an S3-compatible server: objects, multipart uploads and deletes.
+
+    Requests are answered from botocore's ``before-send`` hook, after boto3 has signed them.
+    """
+
+    def __init__(self, bucket: str = "uploads"):
+        self.bucket = bucket
+        self.objects: dict[str, bytes] = {}
+        self.content_types: dict[str, str | None] = {}
+        self.uploads: dict[str, dict[int, bytes]] = {}
+        self.calls: list[tuple[str, str]] = []
+        self.headers: list[dict[str, str]] = []
+        self.fail_part: int | None = None
+        self.fail_part_times: int | None = None
+
+    def attach(self, client: S3Client) -> S3Client:
+        client.client.meta.events.register("before-send.s3", self.handle)
+        return client
+
+    def respond(self, request, status_code: int, content: bytes = b"", headers: dict | None = None) -> AWSResponse:
+        return AWSResponse(request.url, status_code, headers or {}, RawBody(content))
+
+    def handle(self, request, **_kwargs) -> AWSResponse:
+        body = request.body or b""
+        if hasattr(body, "read"):
+            body = body.read()
+        headers = {name.lower(): value.decode() if isinstance(value, bytes) else value for name, value in request.headers.items()}
+        self.headers.append(headers)
+        assert headers["authorization"].startswith("AWS4-HMAC-SHA256 Credential=test-key/")
+        split = urlsplit(request.url)
+        bucket, _, key = unquote(split.path).lstrip("/").partition("/")
+        assert bucket == self.bucket
+        query = dict(parse_qsl(split.query, keep_blank_values=True))
+        self.calls.append((request.method, "&".join(sorted(query)) or "object"))
+
+        if request.method == "POST" and "uploads" in query:
+            upload_id = f"upload-{len(self.uploads) + 1}"
+            self.uploads[upload_id] = {}
+            self.content_types[key] = headers.get("content-type")
+            return self.respond(request, 200, f"<InitiateMultipartUploadResult><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>".encode())
+        if request.method == "PUT" and "uploadId" in query:
+            part_number = int(query["partNumber"])
+            if part_number == self.fail_part and self.fail_part_times != 0:
+                if self.fail_part_times is not None:
+                    self.fail_part_times -= 1
+                return self.respond(request, 500, b"<Error><Code>InternalError</Code><Message>try again</Message></Error>")
+            self.uploads[query["uploadId"]][part_number] = body
+            return self.respond(request, 200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+        if request.method == "POST" and "uploadId" in query:
+            parts = self.uploads.pop(query["uploadId"])
+            numbers = [int(number) for number in re.findall(rb"<PartNumber>(\d+)</PartNumber>", body)]
+            self.objects[key] = b"".join(parts[number] for number in numbers)
+            return self.respond(request, 200, b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+        if request.method == "DELETE" and "uploadId" in query:
+            if self.uploads.pop(query["uploadId"], None) is None:
+                return self.respond(request, 404, b"<Error><Code>NoSuchUpload</Code></Error>")
+            return self.respond(request, 204)
+        if request.method == "PUT":
+            self.objects[key] = body
+            self.content_types[key] = headers.get("content-type")
+            return self.respond(request, 200)
+        if request.method == "DELETE":
+            self.objects.pop(key, None)
+            return self.respond(request, 204)
+        return self.respond(request, 405)
+
+
+@pytest.fixture
+def fake_s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def s3_client(fake_s3):
+    return fake_s3.attach(
+        S3Client(
+            "http://storage.test:9000",
+            fake_s3.bucket,
+            region="us-east-1",
+            access_key_id="test-key",
+            secret_access_key="test-secret",
+        )
+    )
+
+
+def test_large_files_are_uploaded_in_parts_and_small_ones_in_one_request(fake_s3, s3_client, tmp_path):
+    storage = S3Storage(s3_client, "messages", spool_dir=tmp_path, part_size=4)
+
+    small = storage.spool_path(".bin")
+    small.write_bytes(b"tiny")
+    storage.put_file("ab/cd/small.bin", small, content_type="application/octet-stream")
+    assert fake_s3.objects["messages/ab/cd/small.bin"] == b"tiny"
+    assert fake_s3.calls == [("PUT", "object")]
+    assert not small.exists()
+
+    fake_s3.calls.clear()
+    large = storage.spool_path(".bin")
+    large.write_bytes(b"0123456789")
+    storage.put_file("ab/cd/large.bin", large, content_type="application/octet-stream")
+    assert fake_s3.objects["messages/ab/cd/large.bin"] == b"0123456789"
+    assert fake_s3.calls == [("POST", "uploads"), ("PUT", "partNumber&uploadId"), ("PUT", "partNumber&uploadId"), ("PUT", "partNumber&uploadId"), ("POST", "uploadId")]
+    assert fake_s3.content_types["messages/ab/cd/large.bin"] == "application/octet-stream"
+
+    storage.delete("ab/cd/large.bin")
+    assert "messages/ab/cd/large.bin" not in fake_s3.objects
+
+
+def test_failed_part_aborts_the_multipart_upload(fake_s3, s3_client, tmp_path):
+    storage = S3Storage(s3_client, "messages", spool_dir=tmp_path, part_size=4)
+    fake_s3.fail_part = 2
+    source = storage.spool_path(".bin")
+    source.write_bytes(b"0123456789")
+
+    with pytest.raises(StorageError):
+        storage.put_file("ab/cd/broken.bin", source)
+
+    # The failing part is retried before the upload is given up and aborted.
+    assert fake_s3.calls.count(("PUT", "partNumber&uploadId")) == 1 + 3
+    assert fake_s3.calls[-1] == ("DELETE", "uploadId")
+    assert fake_s3.uploads == {}
+    assert "messages/ab/cd/broken.bin" not in fake_s3.objects
+    assert not source.exists()
+
+
+def test_transient_errors_are_retried(fake_s3, s3_client, tmp_path):
+    storage = S3Storage(s3_client, "messages", spool_dir=tmp_path, part_size=4)
+    fake_s3.fail_part, fake_s3.fail_part_times = 2, 1
+    source = storage.spool_path(".bin")
+    source.write_bytes(b"0123456789")
+
+    storage.put_file("ab/cd/flaky.bin", source)
+
+    assert fake_s3.objects["messages/ab/cd/flaky.bin"] == b"0123456789"
+    assert ("DELETE", "uploadId") not in fake_s3.calls
+
+
+def test_temporary_credentials_send_their_session_token(fake_s3, tmp_path):
+    client = fake_s3.attach(
+        S3Client(
+            "http://storage.test:9000",
+            fake_s3.bucket,
+            region="us-east-1",
+            access_key_id="test-key",
+            secret_access_key="test-secret",
+            session_token="session-token",
+        )
+    )
+    storage = S3Storage(client, "avatars", spool_dir=tmp_path)
+
+    storage.put_bytes("me.png", b"png-bytes", content_type="image/png")
+    assert fake_s3.headers[-1]["x-amz-security-token"] == "session-token"
+    assert "X-Amz-Security-Token=session-token" in storage.download_url("me.png")
+
+
+def test_s3_backend_stores_uploads_and_redirects_downloads(client, second_client, db_session, fake_s3, s3_client, monkeypatch, tmp_path):
+    from app.utils import storage
+
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "s3")
+    monkeypatch.setattr(storage, "UPLOAD_SPOOL_DIR", tmp_path)
+    monkeypatch.setattr(storage, "_s3_client", s3_client)
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    chat = Chat(user1_id=1, user2_id=2)
+    db_session.add(chat)
+    db_session.commit()
+
+    content = b"encrypted-bytes" * 10
+    uploaded = client.post(
+        "/messages/upload",
+        data={"chat_id": str(chat.id), "encrypted": "true"},
+        files={"file": ("attachment.bin", io.BytesIO(content), "application/octet-stream")},
+    )
+    assert uploaded.status_code == 200
+    attachment = uploaded.json()["attachment"]
+    sha256 = hashlib.sha256(content).hexdigest()
+    blob_path = f"{sha256[:2]}/{sha256[2:4]}/{sha256}.bin"
+    assert attachment["url"] == f"/static/uploads/messages/{blob_path}"
+    assert fake_s3.objects[f"messages/{blob_path}"] == content
+    assert list(tmp_path.iterdir()) == []
+
+    db_session.add(Message(chat_id=chat.id, sender_id=1, content="cipher", attachment_kind="encrypted", attachment_url=attachment["url"]))
+    db_session.commit()
+    download = client.get(f"/messages/{chat.id}/attachments/{blob_path}", follow_redirects=False)
+    assert download.status_code == 302
+    location = download.headers["location"]
+    assert location.startswith(f"http://storage.test:9000/uploads/messages/{blob_path}?")
+    assert "X-Amz-Signature=" in location
+
+    avatar = client.post(
+        "/profile",
+        data={"name": "user1"},
+        files={"avatar": ("me.png", io.BytesIO(b"png-bytes"), "image/png")},
+        follow_redirects=False,
+    )
+    assert avatar.status_code == 303
+    avatar_keys = [key for key in fake_s3.objects if key.startswith("avatars/")]
+    assert len(avatar_keys) == 1
+    assert fake_s3.objects[avatar_keys[0]] == b"png-bytes"
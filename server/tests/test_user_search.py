@@ -0,0 +1,49 @@
+from app.db.models import User
+from tests.helpers import login_user, register_user
+
+
+def add_users(db_session, *usernames):
+    db_session.add_all(User(email=f"{name}@example.com", password="hashed", username=name) for name in usernames)
+    db_session.commit()
+
+
+def search(client, query):
+    response = client.get("/messages/search", params={"query": query})
+    assert response.status_code == 200
+    return [result["username"] for result in response.json()]
+
+
+def test_search_ranks_prefix_matches_before_substring_matches(client, db_session):
+    assert register_user(client, "owner@example.com").status_code == 303
+    assert login_user(client, "owner@example.com").status_code == 303
+    add_users(db_session, "joanna", "Anna", "hannah", "annabel", "an_drew", "andrew", "zanna")
+
+    assert search(client, "ann") == ["Anna", "annabel", "zanna", "hannah", "joanna"]
+    assert search(client, "AN") == ["an_drew", "andrew", "Anna", "annabel"]
+    # Underscores are literal, not LIKE wildcards.
+    assert search(client, "n_d") == ["an_drew"]
+    assert search(client, "   ") == []
+    # The searcher never finds themselves.
+    assert search(client, "user1") == []
+
+
+def test_search_cache_is_invalidated_by_new_and_renamed_users(client, db_session):
+    from app.utils.user_search import user_search_cache
+
+    assert register_user(client, "owner@example.com").status_code == 303
+    assert login_user(client, "owner@example.com").status_code == 303
+    add_users(db_session, "marta")
+
+    assert search(client, "mar") == ["marta"]
+    assert user_search_cache.get("mar") is not None
+
+    # A result served from the cache, not the database.
+    db_session.query(User).filter(User.username == "marta").update({"username": "martina"})
+    db_session.commit()
+    assert search(client, "mar") == ["marta"]
+
+    response = client.post("/profile", data={"name": "marko"}, follow_redirects=False)
+    assert response.status_code == 303
+    # The searcher's new name answers "mar", so the entry goes even though it never listed them.
+    assert user_search_cache.get("mar") is None
+    assert search(client, "mar") == ["martina"]
@@ -0,0 +1,171 @@
+import asyncio
+import json
+
+from app.utils.websocket_broker import PostgresNotifyBroker
+from app.utils.websocket_manager import ConnectionManager
+
+
+class FakeNotifyHub:
+    def __init__(self):
+        self.connections = []
+
+    async def connect(self, _dsn):
+        connection = FakeNotifyConnection(self)
+        self.connections.append(connection)
+        return connection
+
+
+class FakeNotifyConnection:
+    def __init__(self, hub: FakeNotifyHub):
+        self.hub = hub
+        self.listeners = {}
+        self.closed = False
+
+    async def add_listener(self, channel, callback):
+        self.listeners.setdefault(channel, []).append(callback)
+
+    async def remove_listener(self, channel, callback):
+        self.listeners.get(channel, []).remove(callback)
+
+    async def execute(self, query, channel, payload):
+        assert query == "SELECT pg_notify($1, $2)"
+        assert len(payload.encode()) < 8000
+        for connection in list(self.hub.connections):
+            for callback in list(connection.listeners.get(channel, [])):
+                callback(connection, 1, channel, payload)
+
+    async def close(self):
+        self.closed = True
+        self.hub.connections.remove(self)
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        return None
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def test_postgres_notify_broker_fans_out_events_and_presence_across_nodes():
+    async def scenario():
+        hub = FakeNotifyHub()
+        node_a = ConnectionManager(PostgresNotifyBroker("postgresql://stand-in", node_id="node-a", connect=hub.connect))
+        node_b = ConnectionManager(PostgresNotifyBroker("postgresql://stand-in", node_id="node-b", connect=hub.connect, chunk_size=64))
+        await node_a.start()
+        await node_b.start()
+
+        user_socket = FakeWebSocket()
+        chat_socket = FakeWebSocket()
+        await node_b.connect_user(2, user_socket)
+        await node_b.connect_chat(10, 2, chat_socket, device_id="device-2")
+        await settle()
+
+        assert node_a.is_online(2)
+        assert node_a.has_chat_user(10, 2)
+        assert not node_a.has_chat_user(10, 3)
+
+        large_content = "x" * 500
+        await node_a.broadcast_chat(10, {"type": "message_status", "message_id": 1})
+        await node_a.notify_chat_device(10, "device-2", {"type": "message", "content": large_content})
+        await node_a.notify_user(2, {"type": "new_message", "chat_id": 10})
+        await settle()
+
+        assert chat_socket.sent == [
+            {"type": "message_status", "message_id": 1},
+            {"type": "message", "content": large_content},
+        ]
+        assert user_socket.sent == [{"type": "new_message", "chat_id": 10}]
+
+        await node_a.revoke_chat_user(10, 2, {"type": "chat_deleted", "chat_id": 10, "delete_for_all": False})
+        await settle()
+
+        assert chat_socket.closed_with == 1008
+        assert chat_socket.sent[-1]["type"] == "chat_deleted"
+        assert not node_a.has_chat_user(10, 2)
+
+        node_b.disconnect_user(2, user_socket)
+        await settle()
+        assert not node_a.is_online(2)
+
+        await node_b.stop()
+        await node_a.stop()
+
+    asyncio.run(scenario())
+
+
+def test_late_joining_node_learns_existing_presence():
+    async def scenario():
+        hub = FakeNotifyHub()
+        node_a = ConnectionManager(PostgresNotifyBroker("postgresql://stand-in", node_id="node-a", connect=hub.connect))
+        await node_a.start()
+        await node_a.connect_user(1, FakeWebSocket())
+        await settle()
+
+        node_b = ConnectionManager(PostgresNotifyBroker("postgresql://stand-in", node_id="node-b", connect=hub.connect))
+        await node_b.start()
+        await settle()
+
+        assert node_b.is_online(1)
+
+        await node_a.stop()
+        await settle()
+        assert not node_b.is_online(1)
+
+        await node_b.stop()
+
+    asyncio.run(scenario())
+
+
+def test_cache_invalidations_reach_other_nodes_from_sync_and_async_callers():
+    from app.db.models import User
+    from app.utils.chat_list_cache import ChatListCache
+    from app.utils.user_cache import UserCache
+
+    async def scenario():
+        hub = FakeNotifyHub()
+        nodes = []
+        for node_id in ("node-a", "node-b"):
+            node = ConnectionManager(
+                PostgresNotifyBroker("postgresql://stand-in", node_id=node_id, connect=hub.connect),
+                user_cache=UserCache(),
+                chat_list_cache=ChatListCache(),
+            )
+            await node.start()
+            nodes.append(node)
+        node_a, node_b = nodes
+
+        node_b.user_cache.set(("user1@example.com", "instance"), User(id=1, email="user1@example.com", username="user1"))
+        node_b.chat_list_cache.set(2, {"chats": []}, chat_ids=[10], user_ids=[1])
+        node_b.chat_list_cache.set(3, {"chats": []}, chat_ids=[11], user_ids=[3])
+
+        # Sync endpoints run on threadpool workers, away from the loop the broker lives on.
+        await asyncio.to_thread(node_a.invalidate_user, 1)
+        await asyncio.to_thread(node_a.invalidate_chat_lists, chat_id=10)
+        for _ in range(10):
+            await settle()
+
+        assert node_b.user_cache.get(("user1@example.com", "instance")) is None
+        assert node_b.chat_list_cache.get(2) is None
+        assert node_b.chat_list_cache.get(3) == {"chats": []}
+
+        node_a.invalidate_chat_lists(owner_ids=[3])
+        await settle()
+        assert node_b.chat_list_cache.get(3) is None
+
+        await node_b.stop()
+        await node_a.stop()
+
+    asyncio.run(scenario())
@@ -1,14 +1,32 @@
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import func
 from queue import Queue
 from threading import Thread
 from queue import Empty
 
-from app.db.models import Message, MessageDevicePayload
+from app.db.models import AttachmentBlob, AttachmentUpload, ChatParticipant, Message, MessageDevicePayload, User
 from app.db.session import SessionLocal
 from tests.helpers import login_user, register_user, upload_x3dh_keys
 
 
+HISTORY_COMPLETE = {
+    "type": "history_complete",
+    "has_more": False,
+    "before_message_id": None,
+    "since_message_id": None,
+}
+
+
+def record_upload(email: str, url: str, size: int):
+    """Register ``url`` as uploaded by ``email``, as the upload endpoints would."""
+    with SessionLocal() as db:
+        uploader = db.query(User).filter(User.email == email).one()
+        db.add(AttachmentBlob(url=url, sha256="", size=size, ref_count=0))
+        db.add(AttachmentUpload(url=url, user_id=uploader.id))
+        db.commit()
+
+
 def receive_json_with_timeout(websocket, timeout: float = 5.0):
     queue: Queue = Queue(maxsize=1)
 
@@ -86,12 +104,12 @@ def test_websocket_chat_delivery_and_message_persistence(client, second_client):
             sender_status = receive_json_with_timeout(sender_ws)
             assert sender_status["type"] == "status"
             assert sender_status["is_online"] is True
-            assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+            assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
 
             with second_client.websocket_connect(f"/ws/{chat_id}") as receiver_ws:
                 receiver_status = receive_json_with_timeout(receiver_ws)
                 assert receiver_status["type"] == "status"
-                assert receive_json_with_timeout(receiver_ws) == {"type": "history_complete"}
+                assert receive_json_with_timeout(receiver_ws) == HISTORY_COMPLETE
 
                 sender_ws.send_text(message_payload)
 
@@ -119,8 +137,9 @@ def test_websocket_chat_delivery_and_message_persistence(client, second_client):
         saved_message = db_session.query(Message).filter(Message.chat_id == chat_id).one()
         assert saved_message.sender_id == 1
         assert saved_message.content == message_payload
-        assert saved_message.delivered_at is not None
-        assert saved_message.read_at is not None
+        receiver_participant = db_session.query(ChatParticipant).filter_by(chat_id=chat_id, user_id=2).one()
+        assert receiver_participant.last_delivered_message_id == saved_message.id
+        assert receiver_participant.last_read_message_id == saved_message.id
     finally:
         db_session.close()
 
@@ -142,7 +161,7 @@ def test_websocket_chat_delivery_and_message_persistence(client, second_client):
         "attachment": None,
         "deleted_for_all": False,
     })
-    assert history_complete == {"type": "history_complete"}
+    assert history_complete == HISTORY_COMPLETE
 
 
 def test_websocket_chat_history_reconnect_preserves_order(client, second_client):
@@ -166,7 +185,7 @@ def test_websocket_chat_history_reconnect_preserves_order(client, second_client)
     with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
         sender_status = receive_json_with_timeout(sender_ws)
         assert sender_status["type"] == "status"
-        assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
 
         for expected_id, payload in enumerate(message_payloads, start=1):
             sender_ws.send_text(payload)
@@ -188,8 +207,9 @@ def test_websocket_chat_history_reconnect_preserves_order(client, second_client)
     try:
         saved_messages = db_session.query(Message).filter(Message.chat_id == chat_id).order_by(Message.id).all()
         assert [msg.content for msg in saved_messages] == message_payloads
-        assert all(msg.delivered_at is None for msg in saved_messages)
-        assert all(msg.read_at is None for msg in saved_messages)
+        receiver_participant = db_session.query(ChatParticipant).filter_by(chat_id=chat_id, user_id=2).one()
+        assert receiver_participant.last_delivered_message_id is None
+        assert receiver_participant.last_read_message_id is None
     finally:
         db_session.close()
 
@@ -241,7 +261,173 @@ def test_websocket_chat_history_reconnect_preserves_order(client, second_client)
             "attachment": None,
             "deleted_for_all": False,
         })
-    assert history_complete == {"type": "history_complete"}
+    assert history_complete == HISTORY_COMPLETE
+
+
+def test_opening_chat_with_unread_messages_sends_one_read_watermark(client, second_client):
+    from sqlalchemy import event
+
+    from app.db.session import async_engine
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_default_x3dh_bundle(second_client).status_code == 200
+
+    chat_id = client.post("/messages/start", data={"username": "user2"}).json()["chat_id"]
+    receipt_writes = []
+
+    def record_receipt_write(_conn, _cursor, statement, *_args):
+        if statement.lstrip().upper().startswith("UPDATE") and ("chat_participants" in statement or "messages" in statement):
+            receipt_writes.append(statement)
+
+    with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
+        receive_until_type(sender_ws, "history_complete")
+        for index in range(12):
+            sender_ws.send_text(f'{{"msg":"unread-{index}"}}')
+            assert receive_until_type(sender_ws, "message")["delivery_status"] == "sent"
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", record_receipt_write)
+        try:
+            with second_client.websocket_connect(f"/ws/{chat_id}") as receiver_ws:
+                receive_until_type(receiver_ws, "history_complete")
+                receipts = []
+                while not receipts:
+                    payload = receive_json_with_timeout(sender_ws)
+                    assert payload["type"] != "message_status"
+                    if payload["type"] == "messages_status":
+                        receipts.append(payload)
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", record_receipt_write)
+
+    assert receipts[0]["chat_id"] == chat_id
+    assert receipts[0]["user_id"] == 2
+    assert receipts[0]["delivery_status"] == "read"
+    assert receipts[0]["up_to_message_id"] == 12
+    assert receipts[0]["read_at"] is not None
+    assert len(receipt_writes) == 1
+    assert "chat_participants" in receipt_writes[0]
+
+
+def test_user_socket_marks_direct_and_group_chats_delivered_in_one_statement(client, second_client, monkeypatch):
+    import time
+
+    from sqlalchemy import event
+
+    from app.db.models import Chat
+    from app.db.session import async_engine
+    from app.utils.websocket_manager import manager
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_default_x3dh_bundle(second_client).status_code == 200
+    direct_chat_id = client.post("/messages/start", data={"username": "user2"}).json()["chat_id"]
+
+    db_session = SessionLocal()
+    try:
+        group_chat = Chat(user1_id=1, is_group=True, title="Weekend", creator_id=1)
+        db_session.add(group_chat)
+        db_session.flush()
+        group_chat_id = group_chat.id
+        db_session.add_all([
+            ChatParticipant(chat_id=group_chat_id, user_id=1),
+            ChatParticipant(chat_id=group_chat_id, user_id=2),
+        ])
+        db_session.add_all(
+            [Message(chat_id=direct_chat_id, sender_id=1, content=f"direct-{index}") for index in range(3)]
+            + [Message(chat_id=group_chat_id, sender_id=1, content=f"group-{index}") for index in range(4)]
+            + [Message(chat_id=group_chat_id, sender_id=2, content="own-message")]
+        )
+        db_session.commit()
+        latest_ids = {
+            chat_id: db_session.query(func.max(Message.id)).filter(Message.chat_id == chat_id, Message.sender_id == 1).scalar()
+            for chat_id in (direct_chat_id, group_chat_id)
+        }
+    finally:
+        db_session.close()
+
+    broadcasts = []
+
+    async def record_broadcast(chat_id, data):
+        broadcasts.append((chat_id, data))
+
+    receipt_writes = []
+
+    def record_receipt_write(_conn, _cursor, statement, *_args):
+        if statement.lstrip().upper().startswith("UPDATE"):
+            receipt_writes.append(statement)
+
+    monkeypatch.setattr(manager, "broadcast_chat", record_broadcast)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record_receipt_write)
+    try:
+        with second_client.websocket_connect("/ws/user"):
+            deadline = time.monotonic() + 5
+            while len(broadcasts) < 2 and time.monotonic() < deadline:
+                time.sleep(0.02)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record_receipt_write)
+
+    assert len(receipt_writes) == 1
+    assert sorted((chat_id, data["up_to_message_id"]) for chat_id, data in broadcasts) == sorted(latest_ids.items())
+    assert all(data["type"] == "messages_status" and data["delivery_status"] == "delivered" for _chat_id, data in broadcasts)
+
+    db_session = SessionLocal()
+    try:
+        watermarks = dict(
+            db_session.query(ChatParticipant.chat_id, ChatParticipant.last_delivered_message_id)
+            .filter(ChatParticipant.user_id == 2)
+            .all()
+        )
+    finally:
+        db_session.close()
+    assert watermarks == latest_ids
+
+
+def test_websocket_chat_history_is_paginated_by_message_cursor(client, second_client):
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_default_x3dh_bundle(second_client).status_code == 200
+
+    create_chat_response = client.post("/messages/start", data={"username": "user2"})
+    chat_id = create_chat_response.json()["chat_id"]
+
+    with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
+        receive_until_type(sender_ws, "history_complete")
+        for index in range(1, 6):
+            sender_ws.send_text(f'{{"msg":"message-{index}"}}')
+            receive_until_type(sender_ws, "message")
+
+    with second_client.websocket_connect(f"/ws/{chat_id}?limit=2") as latest_ws:
+        latest_page = [receive_until_type(latest_ws, "message"), receive_until_type(latest_ws, "message")]
+        latest_complete = receive_json_with_timeout(latest_ws)
+
+    assert [event["message_id"] for event in latest_page] == [4, 5]
+    assert latest_complete == {**HISTORY_COMPLETE, "has_more": True, "before_message_id": 4}
+
+    with second_client.websocket_connect(f"/ws/{chat_id}?since_message_id=2&limit=2") as since_ws:
+        since_page = [receive_until_type(since_ws, "message"), receive_until_type(since_ws, "message")]
+        since_complete = receive_json_with_timeout(since_ws)
+
+    assert [event["message_id"] for event in since_page] == [3, 4]
+    assert since_complete == {**HISTORY_COMPLETE, "has_more": True, "since_message_id": 4}
+
+    older_page = second_client.get(f"/chats/{chat_id}/messages", params={"before": 4, "limit": 2})
+    assert older_page.status_code == 200
+    assert [event["message_id"] for event in older_page.json()["messages"]] == [2, 3]
+    assert older_page.json()["has_more"] is True
+    assert older_page.json()["before_message_id"] == 2
+
+    oldest_page = second_client.get(f"/chats/{chat_id}/messages", params={"before": 2, "limit": 2})
+    assert [event["message_id"] for event in oldest_page.json()["messages"]] == [1]
+    assert oldest_page.json()["has_more"] is False
+    assert oldest_page.json()["before_message_id"] is None
+    assert oldest_page.json()["messages"][0]["historical"] is True
 
 
 def test_websocket_media_message_persists_attachment(client, second_client):
@@ -267,11 +453,12 @@ def test_websocket_media_message_persists_attachment(client, second_client):
             "size": 12345,
         },
     }
+    record_upload("user1@example.com", "/static/uploads/messages/test-track.mp3", 12345)
 
     with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
         sender_status = receive_json_with_timeout(sender_ws)
         assert sender_status["type"] == "status"
-        assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
 
         sender_ws.send_json(media_payload)
         echoed_message = receive_until_type(sender_ws, "message")
@@ -287,7 +474,7 @@ def test_websocket_media_message_persists_attachment(client, second_client):
         "delivery_status": "sent",
         "attachment": {
             "kind": "audio",
-            "url": "/static/uploads/messages/test-track.mp3",
+            "url": f"/messages/{chat_id}/attachments/test-track.mp3",
             "name": "track.mp3",
             "mime_type": "audio/mpeg",
             "size": 12345,
@@ -308,6 +495,54 @@ def test_websocket_media_message_persists_attachment(client, second_client):
         db_session.close()
 
 
+
+def test_websocket_refuses_attachments_the_sender_has_no_access_to(client, second_client, monkeypatch, tmp_path):
+    import io
+
+    from app.routers import messages as messages_router
+
+    assert register_user(client, "user1@example.com").status_code == 303
+    assert register_user(second_client, "user2@example.com").status_code == 303
+    assert login_user(client, "user1@example.com").status_code == 303
+    assert login_user(second_client, "user2@example.com").status_code == 303
+    assert upload_default_x3dh_bundle(second_client).status_code == 200
+    chat_id = client.post("/messages/start", data={"username": "user2"}).json()["chat_id"]
+    monkeypatch.setattr(messages_router, "MESSAGE_UPLOAD_DIR", tmp_path)
+
+    uploaded = client.post(
+        "/messages/upload",
+        data={"chat_id": str(chat_id)},
+        files={"file": ("photo.png", io.BytesIO(b"private-bytes"), "image/png")},
+    )
+    assert uploaded.status_code == 200
+
+    def media_message(url):
+        attachment = {**uploaded.json()["attachment"], "url": url}
+        return {"type": "media_message", "caption": "look", "attachment": attachment}
+
+    # Not yet shared in the chat, so only the uploader may attach it.
+    for url in (uploaded.json()["attachment"]["url"], "/static/uploads/../../etc/passwd", "/static/uploads/messages/ab/cd/unknown.bin"):
+        with second_client.websocket_connect(f"/ws/{chat_id}") as receiver_ws:
+            receive_until_type(receiver_ws, "history_complete")
+            with pytest.raises(Exception):
+                receiver_ws.send_json(media_message(url))
+                receive_until_type(receiver_ws, "message")
+
+    with client.websocket_connect(f"/ws/{chat_id}") as sender_ws:
+        receive_until_type(sender_ws, "history_complete")
+        sender_ws.send_json(media_message(uploaded.json()["attachment"]["url"]))
+        receive_until_type(sender_ws, "message")
+
+    # Once it is in the chat, the other participant can send it on as well.
+    with second_client.websocket_connect(f"/ws/{chat_id}") as receiver_ws:
+        receive_until_type(receiver_ws, "history_complete")
+        receiver_ws.send_json(media_message(uploaded.json()["attachment"]["url"]))
+        assert receive_until_type(receiver_ws, "message")["sender"] == "user2"
+
+    with SessionLocal() as db:
+        assert db.query(func.count(Message.id)).filter(Message.chat_id == chat_id).scalar() == 2
+
+
 def test_websocket_group_media_caption_uses_device_payloads(client, second_client):
     third_client = TestClient(client.app)
     third_client.get("/")
@@ -403,13 +638,15 @@ def test_websocket_group_media_caption_uses_device_payloads(client, second_clien
         },
     }
 
+    record_upload("user1@example.com", "/static/uploads/messages/group-image.bin", 512)
+
     with client.websocket_connect(f"/ws/{chat_id}?device_id=sender-device-1") as sender_ws:
-        assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
         sender_ws.send_json(media_payload)
         sender_message = receive_until_type(sender_ws, "message")
 
     assert sender_message["content"] == sender_payload
-    assert sender_message["attachment"]["url"] == "/static/uploads/messages/group-image.bin"
+    assert sender_message["attachment"]["url"] == f"/messages/{chat_id}/attachments/group-image.bin"
 
     with second_client.websocket_connect(f"/ws/{chat_id}?device_id=receiver-device-1") as receiver_ws:
         receiver_message = receive_until_type(receiver_ws, "message")
@@ -417,7 +654,7 @@ def test_websocket_group_media_caption_uses_device_payloads(client, second_clien
 
     assert receiver_message["content"] == receiver_payload_1
     assert receiver_message["historical"] is True
-    assert receiver_complete == {"type": "history_complete"}
+    assert receiver_complete == HISTORY_COMPLETE
 
     db_session = SessionLocal()
     try:
@@ -504,7 +741,7 @@ def test_websocket_delete_for_self_hides_message_on_reconnect(client, second_cli
         receive_json_with_timeout(sender_reconnect_ws)
         history_complete = receive_json_with_timeout(sender_reconnect_ws)
 
-    assert history_complete == {"type": "history_complete"}
+    assert history_complete == HISTORY_COMPLETE
 
     with second_client.websocket_connect(f"/ws/{chat_id}") as receiver_ws:
         receive_json_with_timeout(receiver_ws)
@@ -513,7 +750,7 @@ def test_websocket_delete_for_self_hides_message_on_reconnect(client, second_cli
 
     assert receiver_message["content"] == "delete-me"
     assert receiver_message["historical"] is True
-    assert history_complete == {"type": "history_complete"}
+    assert history_complete == HISTORY_COMPLETE
 
 
 def test_websocket_device_specific_payload_delivery_and_history(client, second_client):
@@ -565,7 +802,7 @@ def test_websocket_device_specific_payload_delivery_and_history(client, second_c
     with client.websocket_connect(f"/ws/{chat_id}?device_id=sender-device-1") as sender_ws:
         sender_status = receive_json_with_timeout(sender_ws)
         assert sender_status["type"] == "status"
-        assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
 
         sender_ws.send_json(fanout_payload)
         sender_message = receive_until_type(sender_ws, "message")
@@ -583,7 +820,7 @@ def test_websocket_device_specific_payload_delivery_and_history(client, second_c
     assert history_message["content"] == recipient_payload
     assert history_message["sender_device_id"] == "sender-device-1"
     assert history_message["historical"] is True
-    assert history_complete == {"type": "history_complete"}
+    assert history_complete == HISTORY_COMPLETE
 
 
 def test_websocket_group_chat_device_fanout(client, second_client):
@@ -668,7 +905,7 @@ def test_websocket_group_chat_device_fanout(client, second_client):
     }
 
     with client.websocket_connect(f"/ws/{chat_id}?device_id=sender-device-1") as sender_ws:
-        assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
 
         sender_ws.send_json(fanout_payload)
 
@@ -685,7 +922,7 @@ def test_websocket_group_chat_device_fanout(client, second_client):
     assert receiver_message_1["content"] == receiver_payload_1
     assert receiver_message_1["sender_device_id"] == "sender-device-1"
     assert receiver_message_1["historical"] is True
-    assert receiver_1_complete == {"type": "history_complete"}
+    assert receiver_1_complete == HISTORY_COMPLETE
 
     with third_client.websocket_connect(f"/ws/{chat_id}?device_id=receiver-device-2") as receiver_ws_2:
         receiver_message_2 = receive_until_type(receiver_ws_2, "message")
@@ -694,7 +931,7 @@ def test_websocket_group_chat_device_fanout(client, second_client):
     assert receiver_message_2["content"] == receiver_payload_2
     assert receiver_message_2["sender_device_id"] == "sender-device-1"
     assert receiver_message_2["historical"] is True
-    assert history_complete == {"type": "history_complete"}
+    assert history_complete == HISTORY_COMPLETE
 
 
 def test_websocket_group_chat_multidevice_history_sync(client, second_client):
@@ -792,7 +1029,7 @@ def test_websocket_group_chat_multidevice_history_sync(client, second_client):
     }
 
     with client.websocket_connect(f"/ws/{chat_id}?device_id=sender-device-1") as sender_ws:
-        assert receive_json_with_timeout(sender_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(sender_ws) == HISTORY_COMPLETE
 
         sender_ws.send_json(fanout_payload)
 
@@ -809,7 +1046,7 @@ def test_websocket_group_chat_multidevice_history_sync(client, second_client):
     assert receiver_message["content"] == receiver_payload_1
     assert receiver_message["sender_device_id"] == "sender-device-1"
     assert receiver_message["historical"] is True
-    assert receiver_complete == {"type": "history_complete"}
+    assert receiver_complete == HISTORY_COMPLETE
 
     with client.websocket_connect(f"/ws/{chat_id}?device_id=sender-device-2") as sender_device_2_ws:
         sender_device_2_message = receive_until_type(sender_device_2_ws, "message")
@@ -818,7 +1055,7 @@ def test_websocket_group_chat_multidevice_history_sync(client, second_client):
     assert sender_device_2_message["content"] == sender_payload_2
     assert sender_device_2_message["sender_device_id"] == "sender-device-1"
     assert sender_device_2_message["historical"] is True
-    assert sender_device_2_complete == {"type": "history_complete"}
+    assert sender_device_2_complete == HISTORY_COMPLETE
 
     with third_client.websocket_connect(f"/ws/{chat_id}?device_id=receiver-device-2") as receiver_device_2_ws:
         receiver_device_2_message = receive_until_type(receiver_device_2_ws, "message")
@@ -827,7 +1064,7 @@ def test_websocket_group_chat_multidevice_history_sync(client, second_client):
     assert receiver_device_2_message["content"] == receiver_payload_2
     assert receiver_device_2_message["sender_device_id"] == "sender-device-1"
     assert receiver_device_2_message["historical"] is True
-    assert receiver_device_2_complete == {"type": "history_complete"}
+    assert receiver_device_2_complete == HISTORY_COMPLETE
 
 
 def test_removed_group_participant_loses_open_websocket_access(client, second_client):
@@ -900,10 +1137,10 @@ def test_removed_group_participant_loses_open_websocket_access(client, second_cl
     creator_payload = '{"version":5,"mode":"group_sender_key","sender_device_id":"creator-device-1","sender_key_id":1,"counter":0,"distribution":{"epk":"a","nonce":"b","message":"c"},"distribution_signature":"sig","algorithm":"AES-GCM","iv":"iv","ciphertext":"ct"}'
 
     with client.websocket_connect(f"/ws/{chat_id}?device_id=creator-device-1") as creator_ws:
-        assert receive_json_with_timeout(creator_ws) == {"type": "history_complete"}
+        assert receive_json_with_timeout(creator_ws) == HISTORY_COMPLETE
 
         with third_client.websocket_connect(f"/ws/{chat_id}?device_id=removed-device-1") as removed_ws:
-            assert receive_json_with_timeout(removed_ws) == {"type": "history_complete"}
+            assert receive_json_with_timeout(removed_ws) == HISTORY_COMPLETE
 
             remove_response = client.delete(
                 f"/chats/{chat_id}/participants/3",
@@ -0,0 +1,147 @@
+import asyncio
+import json
+
+from app.utils.websocket_outbox import SLOW_CONSUMER_CLOSE_CODE, SocketOutbox, new_outbox_stats
+
+
+class StalledWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.release = asyncio.Event()
+
+    async def send_text(self, text):
+        await self.release.wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def status_event(user_id, is_online):
+    return {"type": "status", "user_id": user_id, "is_online": is_online}
+
+
+def chat_event(message_id):
+    return {"type": "message", "message_id": message_id}
+
+
+def test_drop_oldest_policy_sheds_status_events_before_messages():
+    async def scenario():
+        websocket = StalledWebSocket()
+        stats = new_outbox_stats()
+        closed = []
+        outbox = SocketOutbox(websocket, on_closed=lambda: closed.append(True), stats=stats, max_size=3, policy="drop_oldest")
+
+        assert outbox.enqueue(chat_event(1))
+        await settle()
+        assert outbox.enqueue(status_event(2, True))
+        assert outbox.enqueue(chat_event(2))
+        assert outbox.enqueue(chat_event(3))
+        assert outbox.enqueue(chat_event(4))
+        assert outbox.depth == 3
+        assert stats["dropped"] == 1
+
+        websocket.release.set()
+        await outbox.drain(timeout=1)
+        assert [event["message_id"] for event in websocket.sent] == [1, 2, 3, 4]
+        assert not closed
+        outbox.stop()
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_policy_closes_slow_consumer():
+    async def scenario():
+        websocket = StalledWebSocket()
+        stats = new_outbox_stats()
+        closed = []
+        outbox = SocketOutbox(websocket, on_closed=lambda: closed.append(True), stats=stats, max_size=2, policy="disconnect")
+
+        assert outbox.enqueue(chat_event(1))
+        await settle()
+        assert outbox.enqueue(chat_event(2))
+        assert outbox.enqueue(chat_event(3))
+        assert not outbox.enqueue(chat_event(4))
+        await settle()
+
+        assert closed == [True]
+        assert websocket.closed_with == SLOW_CONSUMER_CLOSE_CODE
+        assert stats["slow_consumer_disconnects"] == 1
+        assert not outbox.enqueue(chat_event(5))
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_policy_keeps_latest_status_per_user():
+    async def scenario():
+        websocket = StalledWebSocket()
+        stats = new_outbox_stats()
+        outbox = SocketOutbox(websocket, on_closed=lambda: None, stats=stats, max_size=8, policy="coalesce")
+
+        assert outbox.enqueue(chat_event(1))
+        await settle()
+        assert outbox.enqueue(status_event(2, True))
+        assert outbox.enqueue(status_event(2, False))
+        assert outbox.enqueue(status_event(3, True))
+        assert outbox.depth == 2
+        assert stats["coalesced"] == 1
+
+        websocket.release.set()
+        await outbox.drain(timeout=1)
+        assert websocket.sent[1:] == [status_event(2, False), status_event(3, True)]
+        outbox.stop()
+
+    asyncio.run(scenario())
+
+
+def test_broadcast_encodes_frame_once_for_all_recipients(monkeypatch):
+    from app.utils import websocket_frame
+    from app.utils.websocket_manager import ConnectionManager
+
+    encoded = []
+    original_encode = websocket_frame.encode_json
+
+    def counting_encode(data):
+        encoded.append(data)
+        return original_encode(data)
+
+    monkeypatch.setattr(websocket_frame, "encode_json", counting_encode)
+
+    async def scenario():
+        manager = ConnectionManager()
+        sockets = [StalledWebSocket() for _ in range(3)]
+        for index, websocket in enumerate(sockets, start=1):
+            websocket.release.set()
+            websocket.accept = lambda: asyncio.sleep(0)
+            await manager.connect_chat(7, index, websocket)
+
+        await manager.broadcast_chat(7, chat_event(1))
+        for outbox in list(manager.outboxes.values()):
+            await outbox.drain(timeout=1)
+
+        assert encoded == [chat_event(1)]
+        assert all(websocket.sent == [chat_event(1)] for websocket in sockets)
+        for index, websocket in enumerate(sockets, start=1):
+            manager.disconnect_chat(7, websocket, index)
+
+    asyncio.run(scenario())
+
+
+def test_frames_encode_non_string_keys_with_and_without_orjson(monkeypatch):
+    import json
+
+    from app.utils import websocket_frame
+
+    data = {"type": "unread", "counts": {7: 2}, "name": "Олена"}
+    encoded = websocket_frame.encode_json(data)
+    monkeypatch.setattr(websocket_frame, "orjson", None)
+    fallback = websocket_frame.encode_json(data)
+
+    assert json.loads(encoded) == json.loads(fallback) == {"type": "unread", "counts": {"7": 2}, "name": "Олена"}
+    assert fallback == '{"type":"unread","counts":{"7":2},"name":"Олена"}'